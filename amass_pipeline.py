@@ -0,0 +1,419 @@
+"""
+Stream AMASS sequences straight to new_joints / new_joint_vecs.
+
+The documented flow writes every sequence twice before featurization:
+raw_pose_processing.ipynb saves the BodyModel joints to pose_data/, cuts and
+mirrors them into joints/, and build_vector.py reads them back. Here each
+source sequence stays in memory through the same steps,
+
+    reader thread   loads an AMASS .npz (or a humanact12 .npy) per index.csv source
+    main thread     runs the BodyModel, cuts the index.csv segments and mirrors them
+    process pool    featurizes the segments with build_vector.featurize
+    writer thread   saves the results with atomic renames
+
+with bounded queues in between, so reading and writing overlap the BodyModel
+and featurization, and memory stays bounded by the queue sizes. Segments whose
+outputs already exist are skipped, so an interrupted run can be resumed. The
+joints/ files of the old flow can still be dumped for debugging.
+With a MultiGenderBodyModel and pack_frames set, the sources waiting in the
+reader queue are packed into one BodyModel forward pass whatever their gender.
+"""
+
+import argparse
+import csv
+import os
+import queue
+import threading
+from collections import OrderedDict
+from multiprocessing import Pool
+from os.path import join as pjoin
+
+import numpy as np
+
+import build_vector
+from common import instrument
+from common.work_queue import WorkQueue, save_npy
+
+TRANS_MATRIX = np.array([[1.0, 0.0, 0.0],
+                         [0.0, 0.0, 1.0],
+                         [0.0, 1.0, 0.0]])
+EX_FPS = 20
+# seconds cut from the start of sequences of these datasets before the index.csv segment is taken
+TRIM_SECONDS = OrderedDict([('Eyes_Japan_Dataset', 3), ('MPI_HDM05', 3), ('TotalCapture', 1),
+                            ('MPI_Limits', 1), ('Transitions_mocap', 0.5)])
+NUM_BETAS = 10
+_DONE = None
+
+
+def swap_left_right(data: np.ndarray) -> np.ndarray:
+    """
+    Mirror joint positions of shape (seq_len, joints_num, 3) across the YZ plane, as in raw_pose_processing.ipynb.
+    """
+    assert len(data.shape) == 3 and data.shape[-1] == 3
+    data = data.copy()
+    data[..., 0] *= -1
+    right_chain = [2, 5, 8, 11, 14, 17, 19, 21]
+    left_chain = [1, 4, 7, 10, 13, 16, 18, 20]
+    left_hand_chain = [22, 23, 24, 34, 35, 36, 25, 26, 27, 31, 32, 33, 28, 29, 30]
+    right_hand_chain = [43, 44, 45, 46, 47, 48, 40, 41, 42, 37, 38, 39, 49, 50, 51]
+    tmp = data[:, right_chain]
+    data[:, right_chain] = data[:, left_chain]
+    data[:, left_chain] = tmp
+    if data.shape[1] > 24:
+        tmp = data[:, right_hand_chain]
+        data[:, right_hand_chain] = data[:, left_hand_chain]
+        data[:, left_hand_chain] = tmp
+    return data
+
+
+def cut_segment(data: np.ndarray, source_path: str, start_frame: int, end_frame: int, fps: int=EX_FPS) -> np.ndarray:
+    """
+    Cut one index.csv segment out of a sequence, as in raw_pose_processing.ipynb.
+
+    :param data:        joint positions of the whole sequence, (seq_len, joints_num, 3)
+    :param source_path: index.csv source path, decides the dataset specific trimming
+    :param start_frame: first frame of the segment
+    :param end_frame:   end frame of the segment, negative values count from the end
+    :return segment:    joint positions of the segment
+    """
+    if 'humanact12' in source_path:
+        return data.copy()
+    for (dataset, seconds) in TRIM_SECONDS.items():
+        if dataset in source_path:
+            data = data[int(seconds * fps):]
+    data = data[start_frame:end_frame].copy()
+    data[..., 0] *= -1
+    return data
+
+
+def read_index(index_path: str) -> 'OrderedDict[str, list[tuple[str, int, int]]]':
+    """
+    :param index_path:  string path to index.csv
+    :return segments:   ordered dictionary from source path to a list of (new_name, start_frame, end_frame)
+    """
+    segments = OrderedDict()
+    with open(index_path) as f:
+        for row in csv.DictReader(f):
+            segments.setdefault(row['source_path'], []).append(
+                (row['new_name'], int(row['start_frame']), int(row['end_frame'])))
+    return segments
+
+
+def load_source(source_path: str, amass_dir: str):
+    """
+    :param source_path: index.csv source path, e.g. ./pose_data/KIT/3/kick_high_left02_poses.npy
+    :param amass_dir:   string path to the extracted AMASS datasets
+    :return source:     dictionary of the AMASS parameters, or joint positions for humanact12 sources
+    """
+    with instrument.span('np.load'):
+        if 'humanact12' in source_path:
+            return np.load(source_path)
+        npz_path = source_path.replace('./pose_data', amass_dir)[:-3] + 'npz'
+        with np.load(npz_path, allow_pickle=True) as bdata:
+            return {key: bdata[key] for key in ('mocap_framerate', 'poses', 'trans', 'betas', 'gender')}
+
+
+def amass_to_pose(bdata: dict, body_models: dict, device) -> np.ndarray:
+    """
+    Joint positions of an AMASS sequence downsampled to EX_FPS, as in raw_pose_processing.ipynb.
+
+    :param bdata:       dictionary of AMASS parameters as returned by load_source
+    :param body_models: dictionary with a 'male' and a 'female' BodyModel
+    :param device:      torch device of the body models
+    :return joints:     array of shape (seq_len, 52, 3)
+    """
+    import torch
+
+    bm = body_models['male'] if str(bdata['gender']) == 'male' else body_models['female']
+    down_sample = int(bdata['mocap_framerate'] / EX_FPS)
+    bdata_poses = bdata['poses'][::down_sample, ...]
+    bdata_trans = bdata['trans'][::down_sample, ...]
+    body_parms = {
+        'root_orient': torch.Tensor(bdata_poses[:, :3]).to(device),
+        'pose_body': torch.Tensor(bdata_poses[:, 3:66]).to(device),
+        'pose_hand': torch.Tensor(bdata_poses[:, 66:]).to(device),
+        'trans': torch.Tensor(bdata_trans).to(device),
+        'betas': torch.Tensor(np.repeat(bdata['betas'][:NUM_BETAS][np.newaxis], repeats=len(bdata_trans), axis=0)).to(device),
+    }
+    with instrument.span('amass_to_pose.body_model'), torch.no_grad():
+        body = bm(**body_parms, joints_only=True)
+    with instrument.span('amass_to_pose.to_numpy'):
+        return np.dot(body.Jtr.detach().cpu().numpy(), TRANS_MATRIX)
+
+
+def amass_to_poses(bdatas: list, body_model, device) -> list:
+    """
+    Joint positions of several AMASS sequences of any gender with one forward pass of a MultiGenderBodyModel.
+
+    :param bdatas:      list of dictionaries of AMASS parameters as returned by load_source
+    :param body_model:  MultiGenderBodyModel with 'male' and 'female' models
+    :param device:      torch device of the body model
+    :return joints:     list of arrays of shape (seq_len, 52, 3), as amass_to_pose returns them
+    """
+    import torch
+
+    down_samples = [int(bdata['mocap_framerate'] / EX_FPS) for bdata in bdatas]
+    poses = [bdata['poses'][::down_sample] for (bdata, down_sample) in zip(bdatas, down_samples)]
+    trans = [bdata['trans'][::down_sample] for (bdata, down_sample) in zip(bdatas, down_samples)]
+    lengths = [len(t) for t in trans]
+    poses, trans = np.concatenate(poses), np.concatenate(trans)
+    betas = np.concatenate([np.repeat(bdata['betas'][:NUM_BETAS][np.newaxis], repeats=length, axis=0)
+                            for (bdata, length) in zip(bdatas, lengths)])
+    # like amass_to_pose, every gender but male takes the female model
+    gender = body_model.gender_index([bdata['gender'] for bdata in bdatas], fallback='female')
+    body_parms = {
+        'gender': torch.repeat_interleave(gender, torch.tensor(lengths, device=gender.device)),
+        'root_orient': torch.Tensor(poses[:, :3]).to(device),
+        'pose_body': torch.Tensor(poses[:, 3:66]).to(device),
+        'pose_hand': torch.Tensor(poses[:, 66:]).to(device),
+        'trans': torch.Tensor(trans).to(device),
+        'betas': torch.Tensor(betas).to(device),
+    }
+    with instrument.span('amass_to_pose.body_model'), torch.no_grad():
+        body = body_model(**body_parms, joints_only=True)
+    with instrument.span('amass_to_pose.to_numpy'):
+        joints = np.dot(body.Jtr.detach().cpu().numpy(), TRANS_MATRIX)
+    return np.split(joints, np.cumsum(lengths)[:-1])
+
+
+def _init_worker(rig, example_data):
+    import torch
+    # the pool already uses every core, more threads per worker only oversubscribe them
+    torch.set_num_threads(1)
+    build_vector.set_rig(rig, example_data)
+
+
+def _featurize(args):
+    new_name, data = args
+    try:
+        with instrument.clip(new_name):
+            rec_ric_data, new_data = build_vector.featurize(data, 0.002)
+    except Exception as e:
+        return new_name, None, None, e
+    return new_name, rec_ric_data, new_data, None
+
+
+class StreamingPipeline:
+    """
+    Run the stages described in the module docstring for all segments of an index.csv.
+    """
+
+    def __init__(self, index_path: str, amass_dir: str, save_dir: str, body_models, device='cpu',
+                 rig: dict=build_vector.T2M_RIG, num_workers: int=None, queue_size: int=8, debug_dir: str=None,
+                 pack_frames: int=None):
+        """
+        :param index_path:  string path to index.csv
+        :param amass_dir:   string path to the extracted AMASS datasets
+        :param save_dir:    string path to the output, new_joints/ and new_joint_vecs/ are created inside
+        :param body_models: dictionary with a 'male' and a 'female' BodyModel, or a MultiGenderBodyModel
+        :param device:      torch device of the body models
+        :param rig:         rig parameters for build_vector.set_rig
+        :param num_workers: number of featurization processes, defaults to the number of cpus
+        :param queue_size:  number of sources, and of segments per worker, in flight between stages
+        :param debug_dir:   optional directory to also save the cut joints in, like joints/ of the old flow
+        :param pack_frames: with a MultiGenderBodyModel, the sources already loaded are packed into one forward pass
+                            of up to about this many frames, None runs one source per forward pass
+        """
+        self.segments = read_index(index_path)
+        self.amass_dir = amass_dir
+        self.joints_dir = pjoin(save_dir, 'new_joints')
+        self.vecs_dir = pjoin(save_dir, 'new_joint_vecs')
+        self.body_models = body_models
+        self.device = device
+        self.rig = rig
+        self.num_workers = num_workers or os.cpu_count()
+        self.queue_size = queue_size
+        self.debug_dir = debug_dir
+        self.pack_frames = pack_frames
+        for folder in (self.joints_dir, self.vecs_dir, debug_dir):
+            if folder is not None:
+                os.makedirs(folder, exist_ok=True)
+        # build_vector.featurize writes absolute root channels
+        build_vector.write_root_convention(self.vecs_dir, 'abs')
+
+    def _done(self, new_name: str) -> bool:
+        return all(os.path.exists(pjoin(folder, name)) for folder in (self.joints_dir, self.vecs_dir)
+                   for name in (new_name, 'M' + new_name))
+
+    def cut_source(self, source_path: str, source) -> list[tuple[str, np.ndarray]]:
+        """
+        :return clips:  list of (file name, joint positions) of the segments of one source and their mirrored copies
+        """
+        if isinstance(source, np.ndarray):
+            data = source
+        elif isinstance(self.body_models, dict):
+            data = amass_to_pose(source, self.body_models, self.device)
+        else:
+            data = amass_to_poses([source], self.body_models, self.device)[0]
+        clips = []
+        for (new_name, start_frame, end_frame) in self.segments[source_path]:
+            segment = cut_segment(data, source_path, start_frame, end_frame)
+            clips.append((new_name, segment))
+            clips.append(('M' + new_name, swap_left_right(segment)))
+        return clips
+
+    def example_data(self) -> np.ndarray:
+        """
+        Extract the example clip of the rig, whose first frame sets the target skeleton offsets.
+        """
+        example_name = self.rig['example_id'] + '.npy'
+        for (source_path, segments) in self.segments.items():
+            if any(new_name == example_name for (new_name, _, _) in segments):
+                clips = dict(self.cut_source(source_path, load_source(source_path, self.amass_dir)))
+                return clips[example_name]
+        raise ValueError(f"Example clip {example_name} is not in the index")
+
+    def _read(self, sources: list[str], loaded: queue.Queue):
+        for source_path in sources:
+            try:
+                loaded.put((source_path, load_source(source_path, self.amass_dir), None))
+            except Exception as e:
+                loaded.put((source_path, None, e))
+        loaded.put(_DONE)
+
+    def _packs(self, loaded: queue.Queue):
+        # greedily groups the sources the reader has ready, never waits for more to fill a pack
+        pack, frames = [], 0
+        while True:
+            item = loaded.get()
+            if item is _DONE:
+                break
+            pack.append(item)
+            source = item[1]
+            if isinstance(source, dict):
+                frames += len(source['poses']) // int(source['mocap_framerate'] / EX_FPS)
+            if self.pack_frames is None or frames >= self.pack_frames or loaded.empty():
+                yield pack
+                pack, frames = [], 0
+        if pack:
+            yield pack
+
+    def _to_poses(self, pack: list, stats: dict) -> list:
+        """
+        :return sources:    list of (source path, source) of the loaded pack, AMASS sources replaced by their joints
+        """
+        amass = [i for (i, (_, source, error)) in enumerate(pack) if error is None and isinstance(source, dict)]
+        if len(amass) > 1 and not isinstance(self.body_models, dict):
+            try:
+                joints = amass_to_poses([pack[i][1] for i in amass], self.body_models, self.device)
+            except Exception:
+                # fall back to one source at a time, so a bad source fails alone
+                joints = [None] * len(amass)
+            for (i, data) in zip(amass, joints):
+                if data is not None:
+                    pack[i] = (pack[i][0], data, None)
+
+        sources = []
+        for (source_path, source, error) in pack:
+            if error is not None:
+                stats['failures'].append(f"{source_path}: {error}")
+            else:
+                sources.append((source_path, source))
+        return sources
+
+    def _write(self, results: queue.Queue, stats: dict):
+        while True:
+            item = results.get()
+            if item is _DONE:
+                return
+            new_name, rec_ric_data, new_data, error = item
+            if error is not None:
+                stats['failures'].append(f"{new_name}: {error}")
+                continue
+            save_npy(pjoin(self.joints_dir, new_name), rec_ric_data)
+            save_npy(pjoin(self.vecs_dir, new_name), new_data)
+            stats['clips'] += 1
+            stats['frames'] += len(new_data)
+
+    def run(self, sources: list[str]=None) -> dict:
+        """
+        :param sources: optional subset of the index.csv source paths to process, e.g. a claimed batch
+        :return stats:  dictionary with the number of clips and frames written and the list of failures
+        """
+        from tqdm import tqdm
+
+        sources = [source_path for source_path in (sources if sources is not None else self.segments)
+                   if not all(self._done(new_name) for (new_name, _, _) in self.segments[source_path])]
+        stats = {'clips': 0, 'frames': 0, 'failures': []}
+        if not sources:
+            return stats
+
+        loaded = queue.Queue(self.queue_size)
+        results = queue.Queue(self.queue_size * self.num_workers)
+        reader = threading.Thread(target=self._read, args=(sources, loaded), daemon=True)
+        writer = threading.Thread(target=self._write, args=(results, stats), daemon=True)
+        # bounds the segments submitted to the pool but not yet written
+        in_flight = threading.BoundedSemaphore(self.queue_size * self.num_workers)
+
+        def on_result(result):
+            results.put(result)
+            in_flight.release()
+
+        def on_error(error):
+            stats['failures'].append(str(error))
+            in_flight.release()
+
+        with Pool(self.num_workers, initializer=_init_worker, initargs=(self.rig, self.example_data())) as pool:
+            reader.start()
+            writer.start()
+            progress = tqdm(total=len(sources))
+            for pack in self._packs(loaded):
+                progress.update(len(pack))
+                for (source_path, source) in self._to_poses(pack, stats):
+                    try:
+                        clips = self.cut_source(source_path, source)
+                    except Exception as e:
+                        stats['failures'].append(f"{source_path}: {e}")
+                        continue
+                    for (new_name, data) in clips:
+                        if self.debug_dir is not None:
+                            save_npy(pjoin(self.debug_dir, new_name), data)
+                        in_flight.acquire()
+                        pool.apply_async(_featurize, ((new_name, data),), callback=on_result, error_callback=on_error)
+            progress.close()
+            pool.close()
+            pool.join()
+        results.put(_DONE)
+        writer.join()
+        return stats
+
+
+if __name__ == "__main__":
+    import torch
+    from human_body_prior.body_model.body_model import MultiGenderBodyModel, save_body_model_assets
+
+    parser = argparse.ArgumentParser()
+    # a directory on storage shared by several hosts splits the sources between them
+    parser.add_argument('--queue_dir', default=None, help='work queue directory shared by all hosts')
+    args = parser.parse_args()
+
+    comp_device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+    num_dmpls = 8 # number of DMPL parameters
+    # the models are converted once to memory-mapped assets, shared by all processes on the host
+    asset_dirs = {}
+    for gender in ('male', 'female'):
+        asset_dirs[gender] = f'./body_models/smplh/{gender}/assets'
+        if not os.path.isdir(asset_dirs[gender]):
+            save_body_model_assets(f'./body_models/smplh/{gender}/model.npz', asset_dirs[gender],
+                                   dmpl_fname=f'./body_models/dmpls/{gender}/model.npz')
+    # both genders in one model, so sequences of male and female subjects share forward passes
+    body_models = MultiGenderBodyModel(asset_dirs, num_betas=NUM_BETAS, num_dmpls=num_dmpls).to(comp_device)
+
+    pipeline = StreamingPipeline('./index.csv', './amass_data', './HumanML3D', body_models, comp_device,
+                                 pack_frames=2048)
+    if args.queue_dir is None:
+        batches = [None]
+    else:
+        work_queue = WorkQueue.create(args.queue_dir, list(pipeline.segments), batch_size=32)
+        batches = work_queue.claims(poll=60)
+
+    for batch in batches:
+        stats = pipeline.run(None if batch is None else batch.items)
+        if batch is not None:
+            batch.complete()
+        for failure in stats['failures']:
+            print(failure)
+        print('Total clips: %d, Frames: %d, Duration: %fm' %
+              (stats['clips'], stats['frames'], stats['frames'] / 20 / 60))
+    # only prints when HUMANML3D_PROFILE is set
+    instrument.print_summary()
@@ -3,10 +3,10 @@ Given a text file with raw descriptions of actions, tag each description with
 parts-of-speech tags, then write them in the training format to a new file.
 """
 
-import spacy
-from tqdm import tqdm
+from text_tagger import TagCache, tag_sentences, format_line
+
+TAG_CACHE_FILE = "cache/tag_cache.sqlite"
 
-nlp = spacy.load('en_core_web_sm')
 
 def process_text(sentence: str) -> tuple[list[str], list[str]]:
     """
@@ -17,20 +17,7 @@ def process_text(sentence: str) -> tuple[list[str], list[str]]:
     :return word_list:  list of tokens found in the sentence
     :return pos_list:   list of part-of-speech tags by token
     """
-    sentence = sentence.replace('-', '')
-    doc = nlp(sentence)
-    word_list = []
-    pos_list = []
-    for token in doc:
-        word = token.text
-        if not word.isalpha():
-            continue
-        if (token.pos_ in ("NOUN", "VERB")) and (word != 'left'):
-            word_list.append(token.lemma_)
-        else:
-            word_list.append(word)
-        pos_list.append(token.pos_)
-    return (word_list, pos_list)
+    return tag_sentences([sentence])[0]
 
 
 def read_text_from_file(input_file: str) -> list[str]:
@@ -59,8 +46,7 @@ def prepare_combined_line(sentence: str, start_time: float=0.0, end_time: float=
     :return combined_line:  string containing sentence#tagged_sentence#start_time#end_time
     """
     (words, tags) = process_text(sentence)
-    tagged_sentence = ' '.join([f"{n[0]}/{n[1]}" for n in zip(words, tags)])
-    combined_line = f"{sentence}#{tagged_sentence}#{start_time}#{end_time}\n"
+    combined_line = format_line(sentence, words, tags, start_time, end_time)
 
     return combined_line
 
@@ -83,16 +69,28 @@ def tag_one_file(input_file: str, output_file: str):
     :param input_file:      string path to file with untagged descriptions
     :param output_file:     string path to file for storing results
     """
-    output = []
-    strings = []
+    tag_files(input_files=[input_file], output_files=[output_file])
+
 
-    strings = read_text_from_file(input_file=input_file)
+def tag_files(input_files: list[str], output_files: list[str], batch_size: int=1000, n_process: int=1, cache: TagCache=None):
+    """
+    Tag the descriptions of many input files in one batched pass,
+    then write one output file per input file.
+
+    :param input_files:     list of string paths to files with untagged descriptions
+    :param output_files:    list of string paths to files for storing results
+    :param batch_size:      number of sentences handed to the tagger at a time
+    :param n_process:       number of tagging processes, -1 uses all cpus
+    :param cache:           optional TagCache so that previously tagged sentences are not tagged again
+    """
+    strings_per_file = [read_text_from_file(input_file=input_file) for input_file in input_files]
+    all_strings = [input_line for strings in strings_per_file for input_line in strings]
 
-    for input_line in strings:
-        output_line = prepare_combined_line(input_line)
-        output.append(output_line)
+    tagged = iter(tag_sentences(all_strings, batch_size=batch_size, n_process=n_process, cache=cache))
 
-    write_output_file(output_list=output, output_file=output_file)
+    for (strings, output_file) in zip(strings_per_file, output_files):
+        output = [format_line(input_line, *next(tagged)) for input_line in strings]
+        write_output_file(output_list=output, output_file=output_file)
 
 
 def main():
@@ -105,9 +103,14 @@ def main():
     data_dir = "Custom/texts/raw"
     save_dir = "Custom/texts"
 
-    for text_file in tqdm(listdir(data_dir)):
-        print(f"Processing {text_file}...")
-        tag_one_file(input_file=pjoin(data_dir, text_file), output_file=pjoin(save_dir, text_file))
+    text_files = listdir(data_dir)
+    print(f"Processing {len(text_files)} files...")
+    cache = TagCache(TAG_CACHE_FILE)
+    tag_files(input_files=[pjoin(data_dir, text_file) for text_file in text_files],
+              output_files=[pjoin(save_dir, text_file) for text_file in text_files],
+              n_process=-1, cache=cache)
+    print(f"Tag cache: {cache.stats()}")
+    cache.close()
 
 
 if __name__ == "__main__":
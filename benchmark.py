@@ -0,0 +1,330 @@
+"""
+Benchmarks for the skeleton, quaternion and featurization hot paths.
+
+Motions are synthesized for the 22 joint t2m rig (paramUtil.py) and the 27
+joint custom rig (custom_paramUtil.py) by forward kinematics of smoothly
+oscillating joint rotations, and BodyModel.forward runs on a synthetic model
+with the array shapes of SMPL-H, so no dataset or licensed model is needed.
+The scripted inference modules of BodyModel joints and VPoser decoding are
+timed next to eager mode at the small call sizes of interactive tools, and
+VPoser pose sampling with float and int8 decoder weights.
+Every case runs at several sequence lengths and batch sizes and reports
+frames per second and peak memory as JSON. Peak memory is the tracemalloc
+peak of a separate, untimed run, which covers NumPy but not torch buffers.
+Comparing against a stored baseline exits with code 1 when any case got
+slower than the tolerance allows.
+
+    python benchmark.py --output bench.json
+    python benchmark.py --baseline bench.json --tolerance 0.15
+"""
+
+import argparse
+import json
+import os
+import platform
+import resource
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+from common.lazy_import import lazy_import
+
+torch = lazy_import('torch')
+
+SEQ_LENS = [60, 200]
+BATCH_SIZES = [1, 16]
+# poses per call of the interactive tools, for the eager and scripted inference modules
+CALL_SIZES = [1, 8, 64]
+# untimed calls before timing, the TorchScript profiling executor only optimizes a graph after its first two runs
+WARMUP = 3
+FPS = 20
+
+# parents of the 52 SMPL-H joints, body first, then left and right hand
+SMPLH_PARENTS = [-1, 0, 0, 0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 9, 9, 12, 13, 14, 16, 17, 18, 19,
+                 20, 22, 23, 20, 25, 26, 20, 28, 29, 20, 31, 32, 20, 34, 35,
+                 21, 37, 38, 21, 40, 41, 21, 43, 44, 21, 46, 47, 21, 49, 50]
+
+
+def synthetic_motion(rig: dict, seq_len: int, seed: int=0) -> np.ndarray:
+    """
+    Joint positions of a rig walking forward while every joint oscillates around a random axis.
+
+    :param rig:     build_vector.T2M_RIG, build_vector.CUSTOM_RIG or a dict with the same keys
+    :param seq_len: number of frames
+    :param seed:    seed of the bone lengths and oscillations
+    :return joints: array of shape (seq_len, joints_num, 3)
+    """
+    from common.quaternion import qnormalize
+    from common.skeleton import Skeleton
+
+    rng = np.random.default_rng(seed)
+    raw_offsets = rig['raw_offsets']
+    joints_num = len(raw_offsets)
+    skel = Skeleton(torch.from_numpy(raw_offsets), rig['kinematic_chain'], 'cpu')
+    # the same bone lengths for every seed, so all synthetic clips share one skeleton
+    lengths = np.random.default_rng(0).uniform(0.08, 0.3, size=(joints_num, 1))
+    skel.set_offset(torch.from_numpy(raw_offsets * lengths))
+
+    t = np.arange(seq_len)[:, None] / FPS
+    axes = rng.normal(size=(joints_num, 3))
+    axes /= np.linalg.norm(axes, axis=-1, keepdims=True)
+    angles = rng.uniform(0.1, 0.5, joints_num) * np.sin(2 * np.pi * rng.uniform(0.3, 1.5, joints_num) * t
+                                                         + rng.uniform(0, 2 * np.pi, joints_num))
+    quat = np.concatenate([np.cos(angles / 2)[..., None], np.sin(angles / 2)[..., None] * axes], axis=-1)
+    quat = qnormalize(torch.from_numpy(quat)).numpy()
+
+    root_pos = np.zeros((seq_len, 3))
+    root_pos[:, 1] = 1.0 + 0.03 * np.sin(4 * np.pi * t[:, 0])
+    root_pos[:, 2] = t[:, 0]
+    return skel.forward_kinematics_np(quat, root_pos)
+
+
+def write_synthetic_body_model(bm_fname: str, num_verts: int=6890, seed: int=0):
+    """
+    Save random arrays with the shapes of an SMPL-H model.npz, enough to run BodyModel.forward.
+    Every vertex is skinned to four joints, as in the real model.
+
+    :param bm_fname:    string path to the .npz file to write
+    :param num_verts:   number of vertices
+    :param seed:        seed of the random arrays
+    """
+    rng = np.random.default_rng(seed)
+    num_joints = len(SMPLH_PARENTS)
+    weights = np.zeros((num_verts, num_joints))
+    for i in range(4):
+        weights[np.arange(num_verts), rng.integers(0, num_joints, num_verts)] += rng.uniform(0.1, 1.0, num_verts)
+    weights /= weights.sum(axis=-1, keepdims=True)
+    J_regressor = np.zeros((num_joints, num_verts))
+    for j in range(num_joints):
+        J_regressor[j, rng.choice(num_verts, 10, replace=False)] = 0.1
+    kintree_table = np.stack([np.array(SMPLH_PARENTS, dtype=np.int64) % 2 ** 32, np.arange(num_joints)])
+    np.savez(bm_fname,
+             v_template=rng.normal(scale=0.3, size=(num_verts, 3)),
+             f=rng.integers(0, num_verts, size=(2 * num_verts, 3)).astype(np.uint32),
+             shapedirs=rng.normal(scale=0.01, size=(num_verts, 3, 16)),
+             posedirs=rng.normal(scale=0.01, size=(num_verts, 3, (num_joints - 1) * 9)),
+             J_regressor=J_regressor,
+             kintree_table=kintree_table,
+             weights=weights)
+
+
+def _measure(fn, repeats: int, warmup: int=WARMUP) -> tuple[float, float]:
+    """
+    :param warmup:      untimed calls before the timed ones
+    :return seconds:    median wall time of one call
+    :return peak_mb:    tracemalloc peak of one extra call
+    """
+    for _ in range(warmup):
+        fn()
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    tracemalloc.start()
+    fn()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return float(np.median(times)), peak / 2 ** 20
+
+
+def rig_cases(rig: dict, seq_len: int, batch: int) -> dict:
+    """
+    :return cases:  dictionary from case name to a function running it once on batch clips of seq_len frames
+    """
+    import build_vector
+    from common.quaternion import qbetween_np, quaternion_to_cont6d
+    from common.skeleton import Skeleton
+
+    build_vector.set_rig(rig, synthetic_motion(rig, 2, seed=0))
+    clips = [synthetic_motion(rig, seq_len, seed=i + 1) for i in range(batch)]
+    frames = np.concatenate(clips, axis=0)
+    face_joint_indx = rig['face_joint_indx']
+
+    skel = Skeleton(torch.from_numpy(rig['raw_offsets']), rig['kinematic_chain'], 'cpu')
+    skel.set_offset(build_vector.tgt_offsets)
+    quat = skel.inverse_kinematics_np(frames, face_joint_indx)
+    cont6d = quaternion_to_cont6d(torch.from_numpy(quat).float())
+    root_pos = frames[:, 0]
+    features = np.stack([build_vector.featurize(clip)[1] for clip in clips])
+    v0 = frames[:, 1] - frames[:, 0]
+    v1 = frames[:, 2] - frames[:, 0]
+
+    return {
+        'qbetween_np': lambda: qbetween_np(v0, v1),
+        'inverse_kinematics_np': lambda: [skel.inverse_kinematics_np(clip, face_joint_indx) for clip in clips],
+        'forward_kinematics_np': lambda: skel.forward_kinematics_np(quat, root_pos),
+        'forward_kinematics_cont6d': lambda: skel.forward_kinematics_cont6d(cont6d, torch.from_numpy(root_pos).float()),
+        'process_file_abs_root': lambda: [build_vector.process_file_abs_root(clip, 0.002) for clip in clips],
+        'recover_from_ric': lambda: build_vector.recover_from_ric(torch.from_numpy(features).float(), len(rig['raw_offsets'])),
+    }
+
+
+def body_model_case(body_model, seq_len: int, batch: int):
+    num_frames = seq_len * batch
+    rng = np.random.default_rng(0)
+    body_parms = {
+        'root_orient': torch.Tensor(rng.normal(scale=0.3, size=(num_frames, 3))),
+        'pose_body': torch.Tensor(rng.normal(scale=0.3, size=(num_frames, 63))),
+        'pose_hand': torch.Tensor(rng.normal(scale=0.3, size=(num_frames, 90))),
+        'trans': torch.Tensor(rng.normal(size=(num_frames, 3))),
+        'betas': torch.Tensor(rng.normal(size=(num_frames, 10))),
+    }
+
+    def run():
+        with torch.no_grad():
+            body_model(**body_parms)
+    return run
+
+
+def inference_cases(body_model, num_poses: int) -> dict:
+    """
+    Eager BodyModel joints and VPoser decoding next to their scripted inference modules, and pose sampling with
+    float and int8 decoder weights.
+    """
+    from human_body_prior.models.inference_modules import BodyJointsModule, VPoserDecodeAA, VPoserSampler, \
+        export_inference_module
+    from human_body_prior.models.vposer_model import VPoser
+    from human_body_prior.tools.configurations import load_config
+
+    rng = np.random.default_rng(0)
+    body_parms = {
+        'root_orient': torch.Tensor(rng.normal(scale=0.3, size=(num_poses, 3))),
+        'pose_body': torch.Tensor(rng.normal(scale=0.3, size=(num_poses, 63))),
+        'pose_hand': torch.Tensor(rng.normal(scale=0.3, size=(num_poses, 90))),
+        'betas': torch.Tensor(rng.normal(size=(num_poses, 10))),
+        'trans': torch.Tensor(rng.normal(size=(num_poses, 3))),
+    }
+    torch.manual_seed(0)
+    vposer = VPoser(load_config(model_params={'num_neurons': 512, 'latentD': 32})).eval()
+    latent = torch.Tensor(rng.normal(size=(num_poses, 32)))
+    body_joints = export_inference_module(BodyJointsModule(body_model))
+    vposer_decode = export_inference_module(VPoserDecodeAA(vposer))
+    sampler_fp32 = VPoserSampler(vposer, batch_size=min(num_poses, 1024), seed=0)
+    sampler_int8 = VPoserSampler(vposer, batch_size=min(num_poses, 1024), seed=0, quantize=True)
+    pose_samples = torch.empty([num_poses, vposer.num_joints, 3])
+
+    def no_grad(fn):
+        def run():
+            with torch.no_grad():
+                fn()
+        return run
+
+    return {
+        'body_joints_eager': no_grad(lambda: body_model(**body_parms, joints_only=True)),
+        'body_joints_scripted': no_grad(lambda: body_joints(**body_parms)),
+        'vposer_decode_eager': no_grad(lambda: vposer.decode(latent)),
+        'vposer_decode_scripted': no_grad(lambda: vposer_decode(latent)),
+        'vposer_sample_fp32': lambda: sampler_fp32.sample(num_poses, out=pose_samples),
+        'vposer_sample_int8': lambda: sampler_int8.sample(num_poses, out=pose_samples),
+    }
+
+
+def run_benchmarks(seq_lens: list[int]=SEQ_LENS, batch_sizes: list[int]=BATCH_SIZES, repeats: int=5,
+                   cases: list[str]=None, warmup: int=WARMUP) -> dict:
+    """
+    :param seq_lens:    sequence lengths in frames
+    :param batch_sizes: numbers of clips processed per call
+    :param repeats:     timed calls per case, the median is reported
+    :param cases:       optional list of case names to run, all by default
+    :param warmup:      untimed calls per case before the timed ones
+    :return report:     dictionary with the environment under 'meta' and one entry per case under 'results'
+    """
+    import tempfile
+    import build_vector
+    from human_body_prior.body_model.body_model import BodyModel
+
+    results = []
+
+    def record(name, rig_name, seq_len, batch, fn):
+        if cases is not None and name not in cases:
+            return
+        seconds, peak_mb = _measure(fn, repeats, warmup)
+        results.append({'name': name, 'rig': rig_name, 'seq_len': seq_len, 'batch': batch,
+                        'seconds': seconds, 'frames_per_sec': seq_len * batch / seconds, 'peak_mb': peak_mb})
+        print('%-28s %-7s len %4d  batch %3d  %12.1f frames/s  %8.1f MB' %
+              (name, rig_name, seq_len, batch, results[-1]['frames_per_sec'], peak_mb))
+
+    for (rig_name, rig) in (('t2m', build_vector.T2M_RIG), ('custom', build_vector.CUSTOM_RIG)):
+        for seq_len in seq_lens:
+            for batch in batch_sizes:
+                for (name, fn) in rig_cases(rig, seq_len, batch).items():
+                    record(name, rig_name, seq_len, batch, fn)
+
+    body_cases = ['body_model_forward', 'body_joints_eager', 'body_joints_scripted', 'vposer_decode_eager',
+                  'vposer_decode_scripted', 'vposer_sample_fp32', 'vposer_sample_int8']
+    if cases is None or set(cases) & set(body_cases):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            bm_fname = os.path.join(tmp_dir, 'model.npz')
+            write_synthetic_body_model(bm_fname)
+            body_model = BodyModel(bm_fname=bm_fname, num_betas=10)
+        for seq_len in seq_lens:
+            for batch in batch_sizes:
+                record('body_model_forward', 'smplh', seq_len, batch, body_model_case(body_model, seq_len, batch))
+        # one pose per frame, so frames per second are poses per second
+        for num_poses in CALL_SIZES:
+            for (name, fn) in inference_cases(body_model, num_poses).items():
+                record(name, 'smplh', 1, num_poses, fn)
+
+    meta = {
+        'python': sys.version.split()[0],
+        'numpy': np.__version__,
+        'torch': torch.__version__,
+        'platform': platform.platform(),
+        'processor': platform.processor(),
+        'cpu_count': os.cpu_count(),
+        'torch_threads': torch.get_num_threads(),
+        'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'warmup': warmup,
+        # process wide, including torch buffers that the per case peaks miss
+        'max_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2 ** 10,
+    }
+    return {'meta': meta, 'results': results}
+
+
+def compare(report: dict, baseline: dict, tolerance: float=0.1) -> list[dict]:
+    """
+    :param report:      report of run_benchmarks
+    :param baseline:    stored report to compare with
+    :param tolerance:   allowed relative drop in frames per second
+    :return changes:    one entry per case found in both reports, with the speed ratio and a regression flag
+    """
+    key = lambda result: (result['name'], result['rig'], result['seq_len'], result['batch'])
+    baseline_results = {key(result): result for result in baseline['results']}
+    changes = []
+    for result in report['results']:
+        if key(result) not in baseline_results:
+            continue
+        ratio = result['frames_per_sec'] / baseline_results[key(result)]['frames_per_sec']
+        changes.append({'name': result['name'], 'rig': result['rig'], 'seq_len': result['seq_len'],
+                        'batch': result['batch'], 'speedup': ratio, 'regression': ratio < 1 - tolerance})
+    return changes
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--output', default=None, help='path to write the JSON report to')
+    parser.add_argument('--baseline', default=None, help='path to a stored JSON report to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='allowed relative drop in frames per second')
+    parser.add_argument('--seq_lens', type=int, nargs='+', default=SEQ_LENS)
+    parser.add_argument('--batch_sizes', type=int, nargs='+', default=BATCH_SIZES)
+    parser.add_argument('--repeats', type=int, default=5)
+    parser.add_argument('--warmup', type=int, default=WARMUP, help='untimed calls per case before timing')
+    parser.add_argument('--cases', nargs='+', default=None, help='case names to run, all by default')
+    args = parser.parse_args()
+
+    report = run_benchmarks(args.seq_lens, args.batch_sizes, args.repeats, args.cases, args.warmup)
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            changes = compare(report, json.load(f), args.tolerance)
+        for change in changes:
+            print('%-28s %-7s len %4d  batch %3d  x%.2f%s' % (change['name'], change['rig'], change['seq_len'],
+                  change['batch'], change['speedup'], '  REGRESSION' if change['regression'] else ''))
+        if any(change['regression'] for change in changes):
+            sys.exit(1)
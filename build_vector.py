@@ -1,13 +1,66 @@
+import argparse
+import warnings
 from os.path import join as pjoin
 
 from common.skeleton import Skeleton
 import numpy as np
 import os
-from common.quaternion import *
+from common.quaternion import qbetween_np, qrot_np, qmul_np, qinv_np, qfix, qrot, qinv
+from common.quaternion import quaternion_to_cont6d_np, quaternion_to_cont6d
+from common import instrument
+from common.lazy_import import lazy_import
+from common.work_queue import WorkQueue, save_npy
 from custom_paramUtil import custom_kinematic_chain, custom_raw_offsets, custom_tgt_skel_id
+from paramUtil import t2m_kinematic_chain, t2m_raw_offsets
+
+torch = lazy_import('torch')
+
+## data for existing rig
+## orig. 5, 8; [8, 11], [7, 10]; [2, 1, 17, 16]; 2, 1; 22 (000021)
+## cf. 6, 1; [9, 10], [4, 5]; [6, 1, 23, 18]; 6, 1; 27 (003)
+T2M_RIG = {
+    'raw_offsets': t2m_raw_offsets,
+    'kinematic_chain': t2m_kinematic_chain,
+    'example_id': "000021",
+    # Lower legs
+    'lower_legs': (5, 8),
+    # Right/Left foot
+    'feet': ([8, 11], [7, 10]),
+    # Face direction, r_hip, l_hip, sdr_r, sdr_l
+    'face_joint_indx': [2, 1, 17, 16],
+}
+
+CUSTOM_RIG = {
+    'raw_offsets': custom_raw_offsets,
+    'kinematic_chain': custom_kinematic_chain,
+    'example_id': custom_tgt_skel_id,
+    'lower_legs': (6, 1),
+    'feet': ([9, 10], [4, 5]),
+    'face_joint_indx': [6, 1, 23, 18],
+}
+
+
+def set_rig(rig, example_data):
+    '''
+    Set the module level rig parameters that the functions below read, as the __main__ block does.
+    Worker processes call this once before featurizing.
+
+    rig:            T2M_RIG, CUSTOM_RIG or a dict with the same keys
+    example_data:   joint positions of the example clip of the rig, (seq_len, joints_num, 3)
+    '''
+    global n_raw_offsets, kinematic_chain, tgt_offsets, l_idx1, l_idx2, fid_r, fid_l, face_joint_indx, joints_num
+    n_raw_offsets = torch.from_numpy(rig['raw_offsets'])
+    kinematic_chain = rig['kinematic_chain']
+    joints_num = len(rig['raw_offsets'])
+    l_idx1, l_idx2 = rig['lower_legs']
+    fid_r, fid_l = rig['feet']
+    face_joint_indx = rig['face_joint_indx']
+
+    # Get offsets of target skeleton
+    example_data = example_data.reshape(len(example_data), -1, 3)[:, :joints_num]
+    tgt_skel = Skeleton(n_raw_offsets, kinematic_chain, 'cpu')
+    tgt_offsets = tgt_skel.get_offsets_joints(torch.from_numpy(example_data[0]))
 
-import torch
-from tqdm import tqdm
 
 def uniform_skeleton(positions, target_offset):
     src_skel = Skeleton(n_raw_offsets, kinematic_chain, 'cpu')
@@ -26,19 +79,22 @@ def uniform_skeleton(positions, target_offset):
     tgt_root_pos = src_root_pos * scale_rt
 
     '''Inverse Kinematics'''
-    quat_params = src_skel.inverse_kinematics_np(positions, face_joint_indx)
+    with instrument.span('uniform_skeleton.ik'):
+        quat_params = src_skel.inverse_kinematics_np(positions, face_joint_indx)
     # print(quat_params.shape)
 
     '''Forward Kinematics'''
     src_skel.set_offset(target_offset)
-    new_joints = src_skel.forward_kinematics_np(quat_params, tgt_root_pos)
+    with instrument.span('uniform_skeleton.fk'):
+        new_joints = src_skel.forward_kinematics_np(quat_params, tgt_root_pos)
     return new_joints
 
 
 def process_file_abs_root(positions, feet_thre):
 
     '''Uniform Skeleton'''
-    positions = uniform_skeleton(positions, tgt_offsets)
+    with instrument.span('uniform_skeleton'):
+        positions = uniform_skeleton(positions, tgt_offsets)
 
     '''Put on Floor'''
     floor_height = positions.min(axis=0).min(axis=0)[1]
@@ -88,7 +144,8 @@ def process_file_abs_root(positions, feet_thre):
         feet_r = (((feet_r_x + feet_r_y + feet_r_z) < velfactor)).astype(np.float32)
         return feet_l, feet_r
 
-    feet_l, feet_r = foot_detect(positions, feet_thre)
+    with instrument.span('process_file.foot_detect'):
+        feet_l, feet_r = foot_detect(positions, feet_thre)
 
     '''Quaternion and Cartesian representation'''
     r_rot = None
@@ -106,7 +163,8 @@ def process_file_abs_root(positions, feet_thre):
         quat_params = skel.inverse_kinematics_np(positions, face_joint_indx, smooth_forward=False)
 
         '''Fix Quaternion Discontinuity'''
-        quat_params = qfix(quat_params)
+        with instrument.span('process_file.qfix'):
+            quat_params = qfix(quat_params)
         r_rot = quat_params[:, 0].copy()
         '''Root Linear Velocity'''
         velocity = (positions[1:, 0] - positions[:-1, 0]).copy()
@@ -130,8 +188,10 @@ def process_file_abs_root(positions, feet_thre):
         r_velocity = qmul_np(r_rot[1:], qinv_np(r_rot[:-1]))
         return cont_6d_params, r_velocity, velocity, r_rot
 
-    cont_6d_params, r_velocity, velocity, r_rot = get_cont6d_params(positions)
-    positions = get_rifke(positions)
+    with instrument.span('process_file.cont6d_params'):
+        cont_6d_params, r_velocity, velocity, r_rot = get_cont6d_params(positions)
+    with instrument.span('process_file.rifke'):
+        positions = get_rifke(positions)
 
     '''Root height'''
     root_y = positions[:, 0, 1:2]
@@ -148,8 +208,9 @@ def process_file_abs_root(positions, feet_thre):
     ric_data = positions[:, 1:].reshape(len(positions), -1)
 
     '''Get Joint Velocity Representation'''
-    local_vel = qrot_np(np.repeat(r_rot[:-1, None], global_positions.shape[1], axis=1),
-                        global_positions[1:] - global_positions[:-1])
+    with instrument.span('process_file.local_velocity'):
+        local_vel = qrot_np(np.repeat(r_rot[:-1, None], global_positions.shape[1], axis=1),
+                            global_positions[1:] - global_positions[:-1])
     local_vel = local_vel.reshape(len(local_vel), -1)
 
     data = root_data
@@ -229,22 +290,140 @@ def recover_from_ric(data, joints_num):
     return positions
 
 
+def featurize(source_data, feet_thre=0.002):
+    '''
+    Turn the joint positions of one clip into its new_joints and new_joint_vecs arrays, set_rig must be called first.
+    Root information (first 3 values) is absolute instead of relative, as in the __main__ block.
+    '''
+    source_data = source_data[:, :joints_num]
+    with instrument.span('process_file_abs_root'):
+        data, ground_positions, positions, l_velocity = process_file_abs_root(source_data, feet_thre)
+    with instrument.span('recover_from_ric'):
+        rec_ric_data = recover_from_ric(torch.from_numpy(data).unsqueeze(0).float(), joints_num)
+    r_rot_quat, r_pos, rot_ang = recover_root_rot_pos(torch.from_numpy(data), return_rot_ang=True)
+    instrument.count('frames', len(data))
+    new_data = data.copy()
+    new_data[:, 0] = rot_ang
+    new_data[:, [1, 2]] = r_pos[:, [0,2]]
+    return rec_ric_data.squeeze().numpy(), new_data
+
+
+# Root conventions of the first 3 feature channels:
+#   'rel'   root rotation velocity and local XZ root velocity, as process_file_abs_root returns them and as
+#           recover_root_rot_pos and recover_from_ric read them (rel_motion_representation.ipynb)
+#   'abs'   root rotation angle and XZ root position, as featurize and the __main__ block write them
+#   'auto'  the convention recorded next to the features by write_root_convention, detected per clip otherwise
+ROOT_CONVENTIONS = ['auto', 'abs', 'rel']
+# written into new_joint_vecs/ by the scripts that create it, so readers decide once per corpus
+ROOT_CONVENTION_FILE = 'root_convention.txt'
+
+
+def write_root_convention(vec_dir, root):
+    '''
+    :param vec_dir: directory of the feature files, e.g. ./HumanML3D/new_joint_vecs/
+    :param root:    'abs' or 'rel', the convention of every clip in vec_dir
+    '''
+    if root not in ROOT_CONVENTIONS[1:]:
+        raise ValueError(f'root must be one of {ROOT_CONVENTIONS[1:]}, got {root}')
+    with open(pjoin(vec_dir, ROOT_CONVENTION_FILE), 'w') as f:
+        f.write(root + '\n')
+
+
+def read_root_convention(vec_dir, root='auto'):
+    '''
+    :param vec_dir: directory of the feature files, e.g. ./HumanML3D/new_joint_vecs/
+    :param root:    one of ROOT_CONVENTIONS, anything but 'auto' is returned as is
+    :return:        the convention recorded in vec_dir, or 'auto' when there is none
+    '''
+    if root not in ROOT_CONVENTIONS:
+        raise ValueError(f'root must be one of {ROOT_CONVENTIONS}, got {root}')
+    path = pjoin(vec_dir, ROOT_CONVENTION_FILE)
+    if root != 'auto' or not os.path.exists(path):
+        return root
+    with open(path) as f:
+        recorded = f.read().strip()
+    if recorded not in ROOT_CONVENTIONS[1:]:
+        raise ValueError(f'{path} holds {recorded}, not one of {ROOT_CONVENTIONS[1:]}')
+    return recorded
+
+
+def root_convention(vec, root='auto'):
+    '''
+    Detection of 'auto': featurize writes a zero first frame, so any other clip is 'rel'. Otherwise the local velocity
+    of the root joint, stored further on in every feature vector, matches the XZ root velocity of the 'rel'
+    convention, and whichever reading of the root channels agrees with it wins. A warning is issued when neither
+    clearly does although the readings differ, the clip is then read as 'abs'.
+
+    :param vec:     feature array of shape (seq_len, dim)
+    :param root:    one of ROOT_CONVENTIONS
+    :return:        'abs' or 'rel'
+    '''
+    if root not in ROOT_CONVENTIONS:
+        raise ValueError(f'root must be one of {ROOT_CONVENTIONS}, got {root}')
+    if root != 'auto':
+        return root
+    first_zero = len(vec) > 0 and not np.any(vec[0, :3])
+    if not first_zero:
+        # featurize writes a zero first frame, so the features can only be 'rel'
+        return 'rel'
+    if len(vec) < 3:
+        return 'abs'
+
+    # dim = 4 + (joints_num - 1) * 9 + joints_num * 3 + 4, the root joint comes first in the local velocities
+    offset = 4 + ((vec.shape[1] + 1) // 12 - 1) * 9
+    root_vel = vec[:-1, [offset, offset + 2]]
+    rel_reading, abs_reading = vec[:-1, 1:3], _abs_to_rel(vec)[:-1, 1:3]
+    if np.abs(rel_reading - abs_reading).mean() < 1e-3:
+        # a clip that barely moves, both readings give the same trajectory to a millimeter per frame
+        return 'abs'
+    rel_error = np.abs(rel_reading - root_vel).mean()
+    abs_error = np.abs(abs_reading - root_vel).mean()
+    if min(rel_error, abs_error) > 0.5 * max(rel_error, abs_error):
+        warnings.warn(f'root convention of a clip is ambiguous (velocity error {abs_error:.4f} as abs, '
+                      f'{rel_error:.4f} as rel), read as abs, record it with write_root_convention')
+        return 'abs'
+    return 'abs' if abs_error < rel_error else 'rel'
+
+
+def relative_root(vec, root='auto'):
+    '''
+    Features with the 'rel' root convention, so that recover_from_ric and recover_root_rot_pos read them.
+
+    :param vec:     feature array of shape (seq_len, dim)
+    :param root:    convention of vec, one of ROOT_CONVENTIONS
+    :return:        vec itself for 'rel' features, a converted copy for 'abs' features
+    '''
+    if root_convention(vec, root) == 'rel':
+        return vec
+    return _abs_to_rel(vec)
+
+
+def _abs_to_rel(vec):
+    rot_ang = vec[:, 0]
+    rel = vec.copy()
+    rel[:-1, 0] = rot_ang[1:] - rot_ang[:-1]
+    rel[-1, 0] = 0
+
+    '''The velocity of frame t moves the root to frame t + 1, turned into the facing direction of frame t + 1,
+    the rotation of the quaternion (cos(angle), 0, sin(angle), 0) about Y written out so no torch is needed'''
+    cos, sin = np.cos(2 * rot_ang[1:]), np.sin(2 * rot_ang[1:])
+    delta_x, delta_z = vec[1:, 1] - vec[:-1, 1], vec[1:, 2] - vec[:-1, 2]
+    rel[:-1, 1] = cos * delta_x + sin * delta_z
+    rel[:-1, 2] = -sin * delta_x + cos * delta_z
+    rel[-1, 1:3] = 0
+    return rel
+
 
 if __name__ == "__main__":
+    from tqdm import tqdm
 
-    ## data for existing rig
-    ## orig. 5, 8; [8, 11], [7, 10]; [2, 1, 17, 16]; 2, 1; 22 (000021)
-    ## cf. 6, 1; [9, 10], [4, 5]; [6, 1, 23, 18]; 6, 1; 27 (003)
-    example_id = custom_tgt_skel_id
-    # Lower legs
-    l_idx1, l_idx2 = 6, 1
-    # Right/Left foot
-    fid_r, fid_l = [9, 10], [4, 5]
-    # Face direction, r_hip, l_hip, sdr_r, sdr_l
-    face_joint_indx = [6, 1, 23, 18]
-    # l_hip, r_hip
-    r_hip, l_hip = 6, 1
-    joints_num = 27
+    parser = argparse.ArgumentParser()
+    # a directory on storage shared by several hosts splits the clips between them,
+    # each host running this script claims batches of clips until all are done
+    parser.add_argument('--queue_dir', default=None, help='work queue directory shared by all hosts')
+    args = parser.parse_args()
+
+    rig = CUSTOM_RIG
     # ds_num = 8
     data_dir = './cjoints/'
     save_dir1 = './Custom/new_joints/'
@@ -252,39 +431,43 @@ if __name__ == "__main__":
     
     os.makedirs(save_dir1, exist_ok=True)
     os.makedirs(save_dir2, exist_ok=True)
+    write_root_convention(save_dir2, 'abs')
 
-    n_raw_offsets = torch.from_numpy(custom_raw_offsets)
-    kinematic_chain = custom_kinematic_chain
+    example_data = np.load(os.path.join(data_dir, rig['example_id'] + '.npy'))
+    set_rig(rig, example_data)
 
-    # Get offsets of target skeleton
-    example_data = np.load(os.path.join(data_dir, example_id + '.npy'))
-    example_data = example_data.reshape(len(example_data), -1, 3)
-    example_data = torch.from_numpy(example_data)
-    tgt_skel = Skeleton(n_raw_offsets, kinematic_chain, 'cpu')
-    # (joints_num, 3)
-    tgt_offsets = tgt_skel.get_offsets_joints(example_data[0])
-    # print(tgt_offsets)
+    source_list = sorted(f for f in os.listdir(data_dir) if f.endswith('.npy'))
+    if args.queue_dir is None:
+        batches = [None]
+    else:
+        work_queue = WorkQueue.create(args.queue_dir, source_list, batch_size=64)
+        batches = work_queue.claims(poll=60)
 
-    source_list = os.listdir(data_dir)
     frame_num = 0
-    for source_file in tqdm(source_list):
-        source_data = np.load(os.path.join(data_dir, source_file))[:, :joints_num]
-        try:
-            ### compute absolute root information instead of relative, ignore rec_ric_data
-            data, ground_positions, positions, l_velocity = process_file_abs_root(source_data, 0.002)
-            rec_ric_data = recover_from_ric(torch.from_numpy(data).unsqueeze(0).float(), joints_num)
-            r_rot_quat, r_pos, rot_ang = recover_root_rot_pos(torch.from_numpy(data), return_rot_ang=True)
-            new_data = data.copy()
-            new_data[:, 0] = rot_ang
-            new_data[:, [1, 2]] = r_pos[:, [0,2]]
-
-            np.save(pjoin(save_dir1, source_file), rec_ric_data.squeeze().numpy())
-            np.save(pjoin(save_dir2, source_file), new_data)
-            frame_num += data.shape[0]
-            
-        except Exception as e:
-            print(source_file)
-            print(e)
+    clip_num = 0
+    for batch in batches:
+        for source_file in tqdm(source_list if batch is None else batch.items):
+            with instrument.clip(source_file):
+                with instrument.span('np.load'):
+                    source_data = np.load(os.path.join(data_dir, source_file))
+                instrument.count('bytes_read', source_data.nbytes)
+                try:
+                    rec_ric_data, new_data = featurize(source_data, 0.002)
+
+                    with instrument.span('np.save'):
+                        save_npy(pjoin(save_dir1, source_file), rec_ric_data)
+                        save_npy(pjoin(save_dir2, source_file), new_data)
+                    instrument.count('bytes_written', rec_ric_data.nbytes + new_data.nbytes)
+                    frame_num += new_data.shape[0]
+                    clip_num += 1
+
+                except Exception as e:
+                    print(source_file)
+                    print(e)
+        if batch is not None:
+            batch.complete()
 
     print('Total clips: %d, Frames: %d, Duration: %fm' %
-          (len(source_list), frame_num, frame_num / 20 / 60))
+          (clip_num, frame_num, frame_num / 20 / 60))
+    # only prints when HUMANML3D_PROFILE is set
+    instrument.print_summary()
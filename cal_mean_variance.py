@@ -21,6 +21,8 @@ import os
 from os.path import join as pjoin
 import numpy as np
 
+from common import instrument
+
 
 def mean_variance(data_dir: str, save_dir: str, joints_num: int):
     """
@@ -34,19 +36,22 @@ def mean_variance(data_dir: str, save_dir: str, joints_num: int):
     data_list = []
 
     for file in file_list:
-        data = np.load(pjoin(data_dir, file))
+        with instrument.span('np.load'):
+            data = np.load(pjoin(data_dir, file))
         if np.isnan(data).any():
             print(file)
             continue
         data_list.append(data)
 
-    data = np.concatenate(data_list, axis=0)
+    with instrument.span('mean_variance.concatenate'):
+        data = np.concatenate(data_list, axis=0)
     print(data.shape)
     section_one = 4 + (joints_num - 1) * 3
     section_two = 4 + (joints_num - 1) * 9
     section_three = section_two + joints_num * 3
-    Mean = data.mean(axis=0)
-    Std = data.std(axis=0)
+    with instrument.span('mean_variance.stats'):
+        Mean = data.mean(axis=0)
+        Std = data.std(axis=0)
     Std[0:1] = Std[0:1].mean() / 1.0
     Std[1:3] = Std[1:3].mean() / 1.0
     Std[3:4] = Std[3:4].mean() / 1.0
@@ -66,3 +71,5 @@ if __name__ == '__main__':
     data_dir = './Custom/new_joint_vecs/'
     save_dir = './Custom/'
     mean, std = mean_variance(data_dir=data_dir, save_dir=save_dir, joints_num=27)
+    # only prints when HUMANML3D_PROFILE is set
+    instrument.print_summary()
@@ -0,0 +1,248 @@
+"""
+Inverted index over the caption#tokens#from#to lines of a texts directory.
+
+Every word/POS token of every line is stored in an SQLite file as a posting
+(term, clip, line, position), once under its lowercased lemma and once under
+its POS tag, next to the caption and frame range of the line. Files are
+re-indexed only when their modification time or size changed, and files
+that disappeared are dropped, so updating the index after text_process.py
+or annotate_texts.py rewrote a few files is cheap.
+
+Queries combine terms with AND (the default between terms), OR and NOT:
+    cartwheel                       lemma
+    pos:VERB                        POS tag
+    kick/VERB                       lemma with a given POS tag
+    "turn counterclockwise"         phrase, consecutive tokens of one line
+    jump AND NOT pos:PROPN          boolean combination, OR binds weakest
+Query words are reduced to lemmas by the same spaCy tagger that wrote the
+texts, so "kicks" finds kick/VERB, and a whole query is answered by one SQL
+statement: phrases are joins on the token positions, AND, NOT and OR are
+INTERSECT, EXCEPT and UNION.
+"""
+
+import codecs as cs
+import math
+import os
+import re
+import sqlite3
+from collections import defaultdict
+from os.path import join as pjoin
+
+FPS = 20
+
+
+class CaptionIndex:
+    """
+    Persistent inverted index mapping lemmas and POS tags to caption lines.
+    """
+
+    def __init__(self, index_file: str, lemmatize: bool=True):
+        """
+        :param index_file:  string path to the SQLite file, created if missing
+        :param lemmatize:   reduce query words to lemmas with text_tagger, words are only lowercased when False
+                            or when the spaCy model is not installed
+        """
+        self.lemmatize = lemmatize
+        self._lemmas = {}
+        index_dir = os.path.dirname(index_file)
+        if index_dir:
+            os.makedirs(index_dir, exist_ok=True)
+        self.connection = sqlite3.connect(index_file)
+        with self.connection:
+            self.connection.executescript("""
+                CREATE TABLE IF NOT EXISTS files (clip TEXT PRIMARY KEY, mtime REAL, size INTEGER);
+                CREATE TABLE IF NOT EXISTS lines (clip TEXT, line INTEGER, caption TEXT, start_frame INTEGER, end_frame INTEGER,
+                                                  PRIMARY KEY (clip, line));
+                CREATE TABLE IF NOT EXISTS postings (term TEXT, clip TEXT, line INTEGER, position INTEGER);
+                CREATE INDEX IF NOT EXISTS postings_term_position ON postings (term, clip, line, position);
+                CREATE INDEX IF NOT EXISTS postings_clip ON postings (clip);
+            """)
+
+    def update(self, text_dir: str) -> dict:
+        """
+        Bring the index in line with a texts directory.
+
+        :param text_dir:    string path to the text files, e.g. ./HumanML3D/texts/
+        :return counts:     dictionary with the number of added, updated and removed files
+        """
+        indexed = {clip: (mtime, size) for (clip, mtime, size) in self.connection.execute("SELECT clip, mtime, size FROM files")}
+        on_disk = {}
+        for entry in os.scandir(text_dir):
+            if entry.name.endswith('.txt'):
+                stat = entry.stat()
+                on_disk[entry.name[:-4]] = (stat.st_mtime, stat.st_size)
+
+        changed = [clip for (clip, state) in on_disk.items() if indexed.get(clip) != state]
+        removed = [clip for clip in indexed if clip not in on_disk]
+        with self.connection:
+            self._remove(removed + [clip for clip in changed if clip in indexed])
+            for clip in changed:
+                self._add(clip, pjoin(text_dir, clip + '.txt'), *on_disk[clip])
+        num_updated = sum(clip in indexed for clip in changed)
+        return {'added': len(changed) - num_updated, 'updated': num_updated, 'removed': len(removed)}
+
+    def _remove(self, clips: list[str]):
+        for table in ('files', 'lines', 'postings'):
+            self.connection.executemany(f"DELETE FROM {table} WHERE clip = ?", [(clip,) for clip in clips])
+
+    def _add(self, clip: str, path: str, mtime: float, size: int):
+        lines, postings = [], []
+        with cs.open(path) as f:
+            for (line_id, line) in enumerate(f.readlines()):
+                parts = line.strip().split('#')
+                if len(parts) < 4:
+                    continue
+                caption, tokens = parts[0], parts[1].split(' ')
+                start, end = float(parts[2]), float(parts[3])
+                # HumanML3D writes nan for captions of the whole clip
+                if math.isnan(start) or math.isnan(end):
+                    start, end = 0.0, 0.0
+                lines.append((clip, line_id, caption, int(start * FPS), int(end * FPS)))
+                for (position, token) in enumerate(tokens):
+                    word, _, pos = token.rpartition('/')
+                    postings.append((word.lower(), clip, line_id, position))
+                    postings.append(('pos:' + pos, clip, line_id, position))
+        self.connection.executemany("INSERT INTO lines VALUES (?, ?, ?, ?, ?)", lines)
+        self.connection.executemany("INSERT INTO postings VALUES (?, ?, ?, ?)", postings)
+        self.connection.execute("INSERT INTO files VALUES (?, ?, ?)", (clip, mtime, size))
+
+    def _lemmatize(self, words: list[str]) -> list[str]:
+        """
+        :param words:   words of one phrase, tagged together so that they get the lemmas they have in captions
+        :return words:  lowercased lemmas
+        """
+        key = tuple(words)
+        if words and key not in self._lemmas:
+            lemmas = words
+            if self.lemmatize:
+                from text_tagger import load_nlp, words_and_tags
+                try:
+                    nlp = load_nlp()
+                except (ImportError, OSError) as e:
+                    print(f"Query words are not lemmatized, the spaCy model could not be loaded: {e}")
+                    self.lemmatize = False
+                else:
+                    tagged, _ = words_and_tags(nlp(' '.join(words)))
+                    # words_and_tags drops tokens that are not alphabetic, keep the words then
+                    if len(tagged) == len(words):
+                        lemmas = tagged
+            self._lemmas[key] = [lemma.lower() for lemma in lemmas]
+        return self._lemmas.get(key, [])
+
+    def _phrase_sql(self, terms: list[str]) -> tuple[str, list[str]]:
+        """
+        :param terms:   list of terms that have to follow each other in one line
+        :return sql:    SELECT of the distinct (clip, line) of the phrase and its parameters
+        """
+        word_ids = [i for (i, term) in enumerate(terms) if not term.startswith('pos:')]
+        lemmas = dict(zip(word_ids, self._lemmatize([terms[i].rpartition('/')[0] or terms[i] for i in word_ids])))
+
+        # one (term, offset) per posting that has to exist, lemma/TAG needs both at the same position
+        conditions = []
+        for (offset, term) in enumerate(terms):
+            if term.startswith('pos:'):
+                conditions.append((term, offset))
+                continue
+            conditions.append((lemmas[offset], offset))
+            if '/' in term:
+                conditions.append(('pos:' + term.rpartition('/')[2], offset))
+
+        joins = ' '.join(f"JOIN postings p{k} ON p{k}.clip = p0.clip AND p{k}.line = p0.line "
+                         f"AND p{k}.position = p0.position + {offset}"
+                         for (k, (_, offset)) in enumerate(conditions) if k > 0)
+        where = ' AND '.join(f"p{k}.term = ?" for k in range(len(conditions)))
+        return f"SELECT DISTINCT p0.clip, p0.line FROM postings p0 {joins} WHERE {where}", [t for (t, _) in conditions]
+
+    def phrase(self, terms: list[str]) -> set[tuple[str, int]]:
+        """
+        :param terms:   list of terms that have to follow each other in one line
+        :return lines:  set of (clip, line)
+        """
+        sql, params = self._phrase_sql(terms)
+        return set(self.connection.execute(sql, params))
+
+    def _query_sql(self, query: str) -> tuple[str, list[str]]:
+        """
+        :param query:   query string
+        :return sql:    one compound SELECT of the matching (clip, line) and its parameters, None for an empty query
+        """
+        items = re.findall(r'"[^"]*"|\S+', query)
+        clauses, clause = [], []
+        for item in items:
+            if item == 'OR':
+                clauses.append(clause)
+                clause = []
+            elif item != 'AND':
+                clause.append(item)
+        clauses.append(clause)
+
+        selects, params = [], []
+        for clause in clauses:
+            # compound operators of SQLite apply left to right, (A EXCEPT B) INTERSECT C is A AND NOT B AND C
+            parts, negate = [], False
+            for item in clause:
+                if item == 'NOT':
+                    negate = True
+                    continue
+                sql, item_params = self._phrase_sql(item.strip('"').split() if item.startswith('"') else [item])
+                if not parts and negate:
+                    parts.append("SELECT clip, line FROM lines")
+                parts.append(('EXCEPT ' if negate else 'INTERSECT ' if parts else '') + sql)
+                params.extend(item_params)
+                negate = False
+            if parts:
+                selects.append(f"SELECT clip, line FROM ({' '.join(parts)})")
+        if not selects:
+            return None, []
+        return ' UNION '.join(selects), params
+
+    def search(self, query: str) -> set[tuple[str, int]]:
+        """
+        Evaluate a boolean query, see the module docstring for the syntax.
+
+        :param query:   query string
+        :return lines:  set of matching (clip, line)
+        """
+        sql, params = self._query_sql(query)
+        return set() if sql is None else set(self.connection.execute(sql, params))
+
+    def lookup(self, query: str) -> list[tuple[str, int, str, int, int]]:
+        """
+        Search and return the matching lines in clip order.
+
+        :param query:   query string
+        :return lines:  list of (clip, line, caption, start_frame, end_frame),
+                        start_frame and end_frame are 0 when the caption describes the whole clip
+        """
+        matches = self.search(query)
+        by_clip = defaultdict(list)
+        for (clip, line) in matches:
+            by_clip[clip].append(line)
+        result = []
+        for clip in sorted(by_clip):
+            rows = self.connection.execute(
+                f"SELECT clip, line, caption, start_frame, end_frame FROM lines WHERE clip = ? AND line IN ({','.join('?' * len(by_clip[clip]))}) ORDER BY line",
+                [clip] + by_clip[clip])
+            result.extend(rows)
+        return result
+
+    def clips(self, query: str) -> list[str]:
+        """
+        :param query:   query string
+        :return clips:  sorted list of clips with at least one matching line, e.g. to build a training split
+        """
+        return sorted({clip for (clip, _) in self.search(query)})
+
+    def close(self):
+        self.connection.close()
+
+
+if __name__ == "__main__":
+    import sys
+
+    index = CaptionIndex('./cache/caption_index.sqlite')
+    print(index.update('./HumanML3D/texts/'))
+    for query in sys.argv[1:]:
+        for (clip, line, caption, start_frame, end_frame) in index.lookup(query):
+            print(f"{clip}\t{line}\t{start_frame}-{end_frame}\t{caption}")
+    index.close()
@@ -0,0 +1,205 @@
+"""
+Opt-in timing and memory instrumentation of the preprocessing scripts.
+
+Set HUMANML3D_PROFILE=<path>.jsonl (or call enable(path)) to record
+    span(name)      wall time of a named step, summed per clip
+    clip(name)      one JSONL record per clip with its step times, counters and peak RSS
+    count(name, n)  per-clip counters such as frames and bytes read or written
+Spans outside of any clip are written as records of their own. Worker
+processes inherit the environment variables and append to the same file.
+Every record carries the id of the run that wrote it, HUMANML3D_PROFILE_RUN,
+so earlier runs in the same file are left out of summarize() and
+print_summary() of the current one. While disabled, span()
+and clip() return a shared no-op context manager, so the instrumented code
+pays one function call per step.
+"""
+
+import json
+import os
+import resource
+import time
+
+ENV_VAR = 'HUMANML3D_PROFILE'
+RUN_ENV_VAR = 'HUMANML3D_PROFILE_RUN'
+
+_path = os.environ.get(ENV_VAR) or None
+_run = None
+_file = None
+_file_pid = None
+_current = None
+
+
+def _start_run():
+    # the first process of a run picks the id, the processes it starts inherit it
+    global _run
+    _run = os.environ.get(RUN_ENV_VAR) or '%s-%d' % (time.strftime('%Y%m%d-%H%M%S'), os.getpid())
+    os.environ[RUN_ENV_VAR] = _run
+
+
+def enable(path):
+    '''
+    Record to path from now on, in this process and in processes it starts later.
+    '''
+    global _path
+    _path = path
+    os.environ[ENV_VAR] = path
+    if _run is None:
+        _start_run()
+
+
+def enabled():
+    return _path is not None
+
+
+def _write(record):
+    global _file, _file_pid
+    if _file is None or _file_pid != os.getpid():
+        _file = open(_path, 'a')
+        _file_pid = os.getpid()
+    record['run'] = _run
+    # one write per line, so lines of concurrent processes do not interleave
+    _file.write(json.dumps(record) + '\n')
+    _file.flush()
+
+
+if _path is not None:
+    _start_run()
+
+
+def _peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class _NullContext(object):
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL = _NullContext()
+
+
+class _Span(object):
+    __slots__ = ('name', 'start')
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        seconds = time.perf_counter() - self.start
+        if _current is not None:
+            _current['stages'][self.name] = _current['stages'].get(self.name, 0.0) + seconds
+        else:
+            _write({'kind': 'span', 'name': self.name, 'seconds': seconds, 'pid': os.getpid()})
+        return False
+
+
+class _Clip(object):
+    __slots__ = ('record', 'start', 'outer')
+
+    def __init__(self, name):
+        self.record = {'kind': 'clip', 'name': name, 'stages': {}, 'counters': {}, 'pid': os.getpid()}
+
+    def __enter__(self):
+        global _current
+        self.outer = _current
+        _current = self.record
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        global _current
+        self.record['seconds'] = time.perf_counter() - self.start
+        self.record['peak_rss_mb'] = _peak_rss_mb()
+        if exc_type is not None:
+            self.record['error'] = exc_type.__name__
+        _current = self.outer
+        _write(self.record)
+        return False
+
+
+def span(name):
+    '''
+    Time the enclosed step, e.g. with span('np.load'): ...
+    '''
+    if _path is None:
+        return _NULL
+    return _Span(name)
+
+
+def clip(name):
+    '''
+    Collect the spans and counters of the enclosed processing of one clip into one record.
+    '''
+    if _path is None:
+        return _NULL
+    return _Clip(name)
+
+
+def count(name, value=1):
+    '''
+    Add value to a counter of the current clip, e.g. count('bytes_read', os.path.getsize(path)).
+    '''
+    if _path is None or _current is None:
+        return
+    _current['counters'][name] = _current['counters'].get(name, 0) + value
+
+
+def summarize(path=None, run=None):
+    '''
+    :param path: JSONL file to read, the enabled one by default
+    :param run: id of the run to summarize, by default the current run when reading the enabled file
+                and every run in the file otherwise
+    :return: dictionary from stage to its number of samples and p50 / p95 / total seconds,
+             a stage sample is its total time within one clip, or one span outside of clips
+    '''
+    import numpy as np
+
+    if run is None and path is None:
+        run = _run
+    samples = {}
+    counters = {}
+    with open(path or _path) as f:
+        for line in f:
+            record = json.loads(line)
+            if run is not None and record.get('run') != run:
+                continue
+            if record['kind'] == 'span':
+                samples.setdefault(record['name'], []).append(record['seconds'])
+                continue
+            samples.setdefault('clip', []).append(record['seconds'])
+            for (stage, seconds) in record['stages'].items():
+                samples.setdefault(stage, []).append(seconds)
+            for (name, value) in record['counters'].items():
+                counters[name] = counters.get(name, 0) + value
+            counters['peak_rss_mb'] = max(counters.get('peak_rss_mb', 0), record['peak_rss_mb'])
+
+    stages = {}
+    for (stage, values) in samples.items():
+        values = np.array(values)
+        stages[stage] = {'n': len(values), 'p50': float(np.percentile(values, 50)),
+                         'p95': float(np.percentile(values, 95)), 'total': float(values.sum())}
+    return {'stages': stages, 'counters': counters}
+
+
+def print_summary(path=None, run=None):
+    '''
+    Print the p50 / p95 table of summarize(), slowest stages in total first. Does nothing while disabled.
+    '''
+    if path is None and _path is None:
+        return
+    summary = summarize(path, run)
+    print('%-36s %8s %12s %12s %12s' % ('stage', 'n', 'p50 (ms)', 'p95 (ms)', 'total (s)'))
+    for (stage, stats) in sorted(summary['stages'].items(), key=lambda item: -item[1]['total']):
+        print('%-36s %8d %12.2f %12.2f %12.2f' % (stage, stats['n'], stats['p50'] * 1000, stats['p95'] * 1000, stats['total']))
+    for (name, value) in sorted(summary['counters'].items()):
+        print('%-36s %s' % (name, value))
@@ -0,0 +1,38 @@
+import importlib
+
+
+class LazyModule(object):
+    """
+    Stand-in for a heavy module that is only imported on first attribute access.
+    The real module is imported once and shared by every user of the stand-in.
+    """
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def _load(self):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return self._module
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+    def __dir__(self):
+        return dir(self._load())
+
+    def __repr__(self):
+        state = 'loaded' if self._module is not None else 'not loaded'
+        return "<lazy module '%s' (%s)>" % (self._name, state)
+
+
+_lazy_modules = {}
+
+
+def lazy_import(name):
+    """
+    Return the shared stand-in for module `name`, e.g. torch = lazy_import('torch').
+    """
+    if name not in _lazy_modules:
+        _lazy_modules[name] = LazyModule(name)
+    return _lazy_modules[name]
@@ -5,12 +5,21 @@
 # LICENSE file in the root directory of this source tree.
 #
 
-import torch
 import numpy as np
 
+from common.lazy_import import lazy_import
+
+# torch is only imported once a quaternion function is actually called
+torch = lazy_import('torch')
+# closed form conversions shared with VPoser, see human_body_prior/tools/rotation_tools.py. This makes common depend
+# on the human_body_prior package of this repository, in one direction only: human_body_prior never imports common,
+# and rotation_tools needs nothing but numpy and torch. Like torch, it is imported on the first call, so scripts that
+# import common without converting rotations never load it. tests/test_rotation_tools.py checks both sides against scipy
+rotation_tools = lazy_import('human_body_prior.tools.rotation_tools')
+
 _EPS4 = np.finfo(float).eps * 4.0
 
-_FLOAT_EPS = np.finfo(np.float).eps
+_FLOAT_EPS = np.finfo(float).eps
 
 # PyTorch-backed implementations
 def qinv(q):
@@ -284,24 +293,7 @@ def quaternion_to_matrix(quaternions):
     Returns:
         Rotation matrices as tensor of shape (..., 3, 3).
     """
-    r, i, j, k = torch.unbind(quaternions, -1)
-    two_s = 2.0 / (quaternions * quaternions).sum(-1)
-
-    o = torch.stack(
-        (
-            1 - two_s * (j * j + k * k),
-            two_s * (i * j - k * r),
-            two_s * (i * k + j * r),
-            two_s * (i * j + k * r),
-            1 - two_s * (i * i + k * k),
-            two_s * (j * k - i * r),
-            two_s * (i * k - j * r),
-            two_s * (j * k + i * r),
-            1 - two_s * (i * i + j * j),
-        ),
-        -1,
-    )
-    return o.reshape(quaternions.shape[:-1] + (3, 3))
+    return rotation_tools.quat2matrot(quaternions)
 
 
 def quaternion_to_matrix_np(quaternions):
@@ -323,21 +315,7 @@ def quaternion_to_cont6d(quaternions):
 
 def cont6d_to_matrix(cont6d):
     assert cont6d.shape[-1] == 6, "The last dimension must be 6"
-    x_raw = cont6d[..., 0:3]
-    y_raw = cont6d[..., 3:6]
-
-    x = x_raw / torch.norm(x_raw, dim=-1, keepdim=True)
-    z = torch.cross(x, y_raw, dim=-1)
-    z = z / torch.norm(z, dim=-1, keepdim=True)
-
-    y = torch.cross(z, x, dim=-1)
-
-    x = x[..., None]
-    y = y[..., None]
-    z = z[..., None]
-
-    mat = torch.cat([x, y, z], dim=-1)
-    return mat
+    return rotation_tools.cont6d2matrot(cont6d)
 
 
 def cont6d_to_matrix_np(cont6d):
@@ -345,10 +323,13 @@ def cont6d_to_matrix_np(cont6d):
     return cont6d_to_matrix(q).numpy()
 
 
-def qpow(q0, t, dtype=torch.float):
+def qpow(q0, t, dtype=None):
     ''' q0 : tensor of quaternions
     t: tensor of powers
+    dtype: defaults to torch.float
     '''
+    if dtype is None:
+        dtype = torch.float
     q0 = qnormalize(q0)
     theta0 = torch.acos(q0[..., 0])
 
@@ -426,94 +407,12 @@ def lerp(p0, p1, t):
 
     return p0 + t * (p1 - p0)
 
-def matrix_to_quat(R) -> torch.Tensor:
+def matrix_to_quat(R) -> 'torch.Tensor':
     '''
-    https://github.com/duolu/pyrotation/blob/master/pyrotation/pyrotation.py
-    Convert a rotation matrix to a unit quaternion.
+    Convert a rotation matrix to a unit quaternion with a non negative real part.
     This uses the Shepperd’s method for numerical stability.
     '''
-
-    # The rotation matrix must be orthonormal
-
-    w2 = (1 + R[..., 0, 0] + R[..., 1, 1] + R[..., 2, 2])
-    x2 = (1 + R[..., 0, 0] - R[..., 1, 1] - R[..., 2, 2])
-    y2 = (1 - R[..., 0, 0] + R[..., 1, 1] - R[..., 2, 2])
-    z2 = (1 - R[..., 0, 0] - R[..., 1, 1] + R[..., 2, 2])
-
-    yz = (R[..., 1, 2] + R[..., 2, 1])
-    xz = (R[..., 2, 0] + R[..., 0, 2])
-    xy = (R[..., 0, 1] + R[..., 1, 0])
-
-    wx = (R[..., 2, 1] - R[..., 1, 2])
-    wy = (R[..., 0, 2] - R[..., 2, 0])
-    wz = (R[..., 1, 0] - R[..., 0, 1])
-
-    w = torch.empty_like(x2)
-    x = torch.empty_like(x2)
-    y = torch.empty_like(x2)
-    z = torch.empty_like(x2)
-
-    flagA = (R[..., 2, 2] < 0) * (R[..., 0, 0] > R[..., 1, 1])
-    flagB = (R[..., 2, 2] < 0) * (R[..., 0, 0] <= R[..., 1, 1])
-    flagC = (R[..., 2, 2] >= 0) * (R[..., 0, 0] < -R[..., 1, 1])
-    flagD = (R[..., 2, 2] >= 0) * (R[..., 0, 0] >= -R[..., 1, 1])
-
-    x[flagA] = torch.sqrt(x2[flagA])
-    w[flagA] = wx[flagA] / x[flagA]
-    y[flagA] = xy[flagA] / x[flagA]
-    z[flagA] = xz[flagA] / x[flagA]
-
-    y[flagB] = torch.sqrt(y2[flagB])
-    w[flagB] = wy[flagB] / y[flagB]
-    x[flagB] = xy[flagB] / y[flagB]
-    z[flagB] = yz[flagB] / y[flagB]
-
-    z[flagC] = torch.sqrt(z2[flagC])
-    w[flagC] = wz[flagC] / z[flagC]
-    x[flagC] = xz[flagC] / z[flagC]
-    y[flagC] = yz[flagC] / z[flagC]
-
-    w[flagD] = torch.sqrt(w2[flagD])
-    x[flagD] = wx[flagD] / w[flagD]
-    y[flagD] = wy[flagD] / w[flagD]
-    z[flagD] = wz[flagD] / w[flagD]
-
-    # if R[..., 2, 2] < 0:
-    #
-    #     if R[..., 0, 0] > R[..., 1, 1]:
-    #
-    #         x = torch.sqrt(x2)
-    #         w = wx / x
-    #         y = xy / x
-    #         z = xz / x
-    #
-    #     else:
-    #
-    #         y = torch.sqrt(y2)
-    #         w = wy / y
-    #         x = xy / y
-    #         z = yz / y
-    #
-    # else:
-    #
-    #     if R[..., 0, 0] < -R[..., 1, 1]:
-    #
-    #         z = torch.sqrt(z2)
-    #         w = wz / z
-    #         x = xz / z
-    #         y = yz / z
-    #
-    #     else:
-    #
-    #         w = torch.sqrt(w2)
-    #         x = wx / w
-    #         y = wy / w
-    #         z = wz / w
-
-    res = [w, x, y, z]
-    res = [z.unsqueeze(-1) for z in res]
-
-    return torch.cat(res, dim=-1) / 2
+    return rotation_tools.matrot2quat(R)
 
 def cont6d_to_quat(cont6d):
     return matrix_to_quat(cont6d_to_matrix(cont6d))
@@ -1,5 +1,5 @@
 from common.quaternion import *
-import scipy.ndimage.filters as filters
+from common import instrument
 
 class Skeleton(object):
     def __init__(self, offset, kinematic_tree, device):
@@ -65,7 +65,9 @@ class Skeleton(object):
         # forward (batch_size, 3)
         forward = np.cross(np.array([[0, 1, 0]]), across, axis=-1)
         if smooth_forward:
-            forward = filters.gaussian_filter1d(forward, 20, axis=0, mode='nearest')
+            from scipy.ndimage import gaussian_filter1d
+            with instrument.span('skeleton.gaussian_filter'):
+                forward = gaussian_filter1d(forward, 20, axis=0, mode='nearest')
             # forward (batch_size, 3)
         forward = forward / np.sqrt((forward**2).sum(axis=-1))[..., np.newaxis]
 
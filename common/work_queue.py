@@ -0,0 +1,230 @@
+"""
+Work queue for several hosts that mount the same storage, built on lock files.
+
+A queue directory holds
+    batches/<id>.json   the items of every batch, written once when the queue is created
+    claims/<id>.lock    created with O_EXCL by the worker that owns the batch, touched as heartbeat
+    done/<id>           marker written once the batch is finished
+
+Creating a file with O_EXCL and renaming a file are atomic on the usual
+shared filesystems (NFS v3+, Lustre, CephFS), SQLite locking often is not,
+so these two operations are all the workers agree on. A claim whose file
+was not touched for stale_after seconds belongs to a crashed host: it is
+removed and the batch is claimed again. Claims are only ever removed under
+claims/<id>.lock.drop, created with O_EXCL, after checking their owner, so
+a worker never removes a claim that another worker has just taken.
+Work must therefore be idempotent, which save_npy makes it for .npy outputs
+by committing them with an atomic rename.
+"""
+
+import json
+import os
+import socket
+import threading
+import time
+import uuid
+from os.path import join as pjoin
+
+import numpy as np
+
+
+def save_npy(save_path, array):
+    """
+    Save an array through a temporary file unique to this process, so no host ever sees a half-written .npy.
+    """
+    tmp_path = '%s.%s.%d.tmp' % (save_path, socket.gethostname(), os.getpid())
+    with open(tmp_path, 'wb') as f:
+        np.save(f, array)
+    os.replace(tmp_path, save_path)
+
+
+class Batch(object):
+    """
+    A claimed batch, keeps its claim alive with a heartbeat thread until complete() or release().
+    """
+    def __init__(self, queue, batch_id, items, token):
+        self.queue = queue
+        self.batch_id = batch_id
+        self.items = items
+        self.token = token
+        self.lost = False
+        self._stop = threading.Event()
+        self._heartbeat = threading.Thread(target=self._beat, daemon=True)
+        self._heartbeat.start()
+
+    def _beat(self):
+        claim_path = self.queue.claim_path(self.batch_id)
+        while not self._stop.wait(self.queue.heartbeat):
+            try:
+                with open(claim_path) as f:
+                    owner = f.read()
+                if owner != self.token:
+                    raise FileNotFoundError(claim_path)
+                os.utime(claim_path)
+            except FileNotFoundError:
+                # another worker took the batch over, our results are still valid since work is idempotent
+                self.lost = True
+                return
+
+    def _stop_heartbeat(self):
+        self._stop.set()
+        self._heartbeat.join()
+
+    def complete(self):
+        self._stop_heartbeat()
+        tmp_path = '%s.%s.tmp' % (self.queue.done_path(self.batch_id), self.token)
+        with open(tmp_path, 'w') as f:
+            f.write(self.token)
+        os.replace(tmp_path, self.queue.done_path(self.batch_id))
+        self.release()
+
+    def release(self):
+        """
+        Give the batch back without finishing it.
+        """
+        self._stop_heartbeat()
+        if not self.lost:
+            self.queue._drop_claim(self.batch_id, self.token)
+
+
+class WorkQueue(object):
+    """
+    Queue of item batches in a directory on a shared mount.
+    """
+    def __init__(self, queue_dir, heartbeat=30.0, stale_after=300.0):
+        '''
+        :param queue_dir: path to an existing queue, see create()
+        :param heartbeat: seconds between touches of a held claim
+        :param stale_after: seconds without heartbeat after which a claim is released
+        '''
+        self.queue_dir = queue_dir
+        self.heartbeat = heartbeat
+        self.stale_after = stale_after
+        with open(pjoin(queue_dir, 'batches', 'index.json')) as f:
+            self.batch_ids = json.load(f)
+
+    @classmethod
+    def create(cls, queue_dir, items, batch_size=64, **kwargs):
+        '''
+        Create the queue unless it exists, safe to call from every host at once.
+
+        :param queue_dir: path of the queue directory
+        :param items: list of json serializable work items, e.g. file names
+        :param batch_size: number of items claimed at a time
+        '''
+        if not os.path.exists(queue_dir):
+            tmp_dir = '%s.%s.tmp' % (queue_dir.rstrip('/'), uuid.uuid4().hex)
+            for sub_dir in ('batches', 'claims', 'done'):
+                os.makedirs(pjoin(tmp_dir, sub_dir))
+            batch_ids = []
+            for start in range(0, len(items), batch_size):
+                batch_id = '%06d' % (start // batch_size)
+                with open(pjoin(tmp_dir, 'batches', batch_id + '.json'), 'w') as f:
+                    json.dump(items[start:start + batch_size], f)
+                batch_ids.append(batch_id)
+            with open(pjoin(tmp_dir, 'batches', 'index.json'), 'w') as f:
+                json.dump(batch_ids, f)
+            try:
+                os.rename(tmp_dir, queue_dir.rstrip('/'))
+            except OSError:
+                # another host created the queue first
+                import shutil
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+        return cls(queue_dir, **kwargs)
+
+    def claim_path(self, batch_id):
+        return pjoin(self.queue_dir, 'claims', batch_id + '.lock')
+
+    def done_path(self, batch_id):
+        return pjoin(self.queue_dir, 'done', batch_id)
+
+    def _drop_claim(self, batch_id, token):
+        # every removal of a claim happens while holding the drop lock, so the owner read below is still the owner
+        # when the claim is removed: a new claim can only be created once the old one is gone
+        claim_path = self.claim_path(batch_id)
+        lock_path = claim_path + '.drop'
+        try:
+            fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            try:
+                if time.time() - os.stat(lock_path).st_mtime > self.stale_after:
+                    # left behind by a host that crashed while dropping
+                    os.remove(lock_path)
+            except FileNotFoundError:
+                pass
+            return False
+        try:
+            with open(claim_path) as f:
+                owner = f.read()
+            if token is not None and owner != token:
+                # the claim changed hands in the meantime
+                return False
+            os.remove(claim_path)
+            return True
+        except FileNotFoundError:
+            return False
+        finally:
+            os.close(fd)
+            os.remove(lock_path)
+
+    def _release_if_stale(self, batch_id):
+        try:
+            with open(self.claim_path(batch_id)) as f:
+                owner = f.read()
+            age = time.time() - os.stat(self.claim_path(batch_id)).st_mtime
+        except FileNotFoundError:
+            return
+        if age > self.stale_after:
+            self._drop_claim(batch_id, owner)
+
+    def try_claim(self, batch_id):
+        '''
+        :return: the claimed Batch, or None if it is done or held by another worker
+        '''
+        if os.path.exists(self.done_path(batch_id)):
+            return None
+        self._release_if_stale(batch_id)
+        token = '%s:%d:%s' % (socket.gethostname(), os.getpid(), uuid.uuid4().hex)
+        try:
+            fd = os.open(self.claim_path(batch_id), os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return None
+        with os.fdopen(fd, 'w') as f:
+            f.write(token)
+        # the batch may have been finished between the done check and the claim
+        if os.path.exists(self.done_path(batch_id)):
+            self._drop_claim(batch_id, token)
+            return None
+        with open(pjoin(self.queue_dir, 'batches', batch_id + '.json')) as f:
+            items = json.load(f)
+        return Batch(self, batch_id, items, token)
+
+    def claims(self, poll=None):
+        '''
+        Yield claimed batches until every batch is done. The caller calls complete() on each.
+
+        :param poll: seconds to wait before looking again for batches held by other workers,
+                     None stops as soon as nothing can be claimed
+        '''
+        while True:
+            pending = [batch_id for batch_id in self.batch_ids if not os.path.exists(self.done_path(batch_id))]
+            if not pending:
+                return
+            claimed_any = False
+            for batch_id in pending:
+                batch = self.try_claim(batch_id)
+                if batch is not None:
+                    claimed_any = True
+                    yield batch
+            if not claimed_any:
+                if poll is None:
+                    return
+                time.sleep(poll)
+
+    def progress(self):
+        '''
+        :return: dictionary with the number of done, claimed and total batches
+        '''
+        done = sum(os.path.exists(self.done_path(batch_id)) for batch_id in self.batch_ids)
+        claimed = sum(os.path.exists(self.claim_path(batch_id)) for batch_id in self.batch_ids)
+        return {'done': done, 'claimed': claimed, 'total': len(self.batch_ids)}
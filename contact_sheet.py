@@ -0,0 +1,194 @@
+"""
+Keyframe contact sheets for reviewing the whole corpus in a browser.
+
+For every clip K keyframes are picked, either uniformly in time or spread over
+the accumulated motion energy, rendered as small thumbnails with the
+MotionRenderer and tiled into one row per clip. Rows of N clips make up one
+sheet. Sheets are named by a hash of their clips' contents and the rendering
+settings, so re-running only renders what changed, and paginated HTML index
+pages with lazily loaded images link them all. A clip that cannot be rendered
+becomes a light red row of its sheet, named on the index page, and the sheet is
+kept as .partial.png so that the next run renders it again.
+"""
+
+import hashlib
+import html
+import os
+from multiprocessing import Pool
+from os.path import join as pjoin
+
+import numpy as np
+
+from render_motion import MotionRenderer, write_png
+
+PAD = 2
+
+
+def clip_hash(npy_path: str) -> str:
+    """
+    :param npy_path:    string path to a joint positions file
+    :return digest:     hex digest of the file contents
+    """
+    with open(npy_path, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+def select_keyframes(joints: np.ndarray, k: int, mode: str='uniform') -> np.ndarray:
+    """
+    Pick k frames of a motion.
+
+    :param joints:  array of shape (seq_len, joints_num, 3)
+    :param k:       number of keyframes
+    :param mode:    'uniform' spaces the frames evenly in time,
+                    'energy' spaces them evenly over the summed joint speed, so busy parts get more frames
+    :return frame_ids: sorted array of k frame indices, repeated when the clip is shorter than k
+    """
+    seq_len = len(joints)
+    if mode == 'uniform':
+        return np.rint(np.linspace(0, seq_len - 1, k)).astype(np.int64)
+    if mode != 'energy':
+        raise ValueError(f"Unknown keyframe mode '{mode}'")
+
+    speed = np.linalg.norm(np.diff(joints.reshape(seq_len, -1, 3), axis=0), axis=-1).sum(axis=-1)
+    energy = np.concatenate([[0.0], np.cumsum(speed)])
+    if energy[-1] <= 0:
+        return select_keyframes(joints, k, 'uniform')
+    targets = np.linspace(0, energy[-1], k)
+    return np.minimum(np.searchsorted(energy, targets), seq_len - 1).astype(np.int64)
+
+
+def render_strip(joints: np.ndarray, renderer: MotionRenderer, k: int, mode: str='uniform') -> np.ndarray:
+    """
+    Render the keyframes of one clip next to each other.
+
+    :return strip:  uint8 array of shape (size + 2 * PAD, k * (size + PAD) + PAD, 3)
+    """
+    size = renderer.size
+    strip = np.full((size + 2 * PAD, k * (size + PAD) + PAD, 3), 255, dtype=np.uint8)
+    frames = renderer.render(joints, select_keyframes(joints, k, mode))
+    for i, frame in enumerate(frames):
+        x = PAD + i * (size + PAD)
+        strip[PAD:PAD + size, x:x + size] = frame
+    # a thin rule between clips keeps rows apart on dense sheets
+    strip[-1] = 200
+    return strip
+
+
+def placeholder_strip(renderer: MotionRenderer, k: int) -> np.ndarray:
+    """
+    :return strip:  light red row of the shape of render_strip, standing in for a clip that could not be rendered
+    """
+    size = renderer.size
+    strip = np.full((size + 2 * PAD, k * (size + PAD) + PAD, 3), (255, 220, 220), dtype=np.uint8)
+    strip[-1] = 200
+    return strip
+
+
+def partial_path(save_path: str) -> str:
+    """
+    Sheets with failed clips are written under another name, so the next run renders them again.
+    """
+    return save_path[:-len('.png')] + '.partial.png'
+
+
+def _render_sheet(args):
+    npy_paths, save_path, kinematic_tree, k, mode, thumb_size = args
+    renderer = MotionRenderer(kinematic_tree, size=thumb_size, radius=2.5, thickness=max(thumb_size // 64, 1))
+    strips, failures = [], []
+    for npy_path in npy_paths:
+        try:
+            strips.append(render_strip(np.load(npy_path), renderer, k, mode))
+        except Exception as e:
+            failures.append((os.path.basename(npy_path)[:-4], str(e)))
+            strips.append(placeholder_strip(renderer, k))
+    final_path = partial_path(save_path) if failures else save_path
+    tmp_path = final_path + '.tmp'
+    write_png(tmp_path, np.concatenate(strips, axis=0))
+    os.replace(tmp_path, final_path)
+    if not failures and os.path.exists(partial_path(save_path)):
+        os.remove(partial_path(save_path))
+    return save_path, failures
+
+
+def write_index(tgt_dir: str, sheets: list[tuple[str, list[str], list[tuple[str, str]]]], sheets_per_page: int):
+    """
+    Write paginated HTML pages listing the sheets, index.html being the first page.
+
+    :param tgt_dir:         string path to the output directory
+    :param sheets:          list of (sheet file name, clip names on the sheet, (clip name, error) of its failed clips)
+    :param sheets_per_page: number of sheets on one page
+    """
+    num_pages = max((len(sheets) + sheets_per_page - 1) // sheets_per_page, 1)
+    page_name = lambda page: 'index.html' if page == 0 else 'index_%04d.html' % page
+    for page in range(num_pages):
+        nav = ' '.join(['<a href="%s">%d</a>' % (page_name(p), p + 1) if p != page else '<b>%d</b>' % (p + 1)
+                        for p in range(num_pages)])
+        entries = []
+        for (sheet_name, clip_names, failures) in sheets[page * sheets_per_page:(page + 1) * sheets_per_page]:
+            # failed clips are light red rows of the partial sheet, named here
+            failed = ''.join('<p style="color:#c00">%s could not be rendered: %s</p>'
+                             % (html.escape(name), html.escape(error)) for (name, error) in failures)
+            entries.append('<div><p>%s</p>%s<img src="sheets/%s" loading="lazy"></div>'
+                           % (html.escape(', '.join(clip_names)), failed,
+                              partial_path(sheet_name) if failures else sheet_name))
+        with open(pjoin(tgt_dir, page_name(page)), 'w') as f:
+            f.write('<!DOCTYPE html>\n<html><head><meta charset="utf-8"><title>Contact sheets %d/%d</title></head>\n'
+                    '<body style="font-family:sans-serif;font-size:12px">\n<p>%s</p>\n%s\n<p>%s</p>\n</body></html>\n'
+                    % (page + 1, num_pages, nav, '\n'.join(entries), nav))
+
+
+def build_contact_sheets(src_dir: str, tgt_dir: str, kinematic_tree: list[list[int]], k: int=8, mode: str='uniform',
+                         thumb_size: int=128, clips_per_sheet: int=1, sheets_per_page: int=200, num_workers: int=None):
+    """
+    Render contact sheets of every .npy motion of a directory and an HTML index over them.
+    Sheets whose clips and settings did not change since the last run are reused.
+
+    :param src_dir:         string path to the joint positions, e.g. ./HumanML3D/new_joints/
+    :param tgt_dir:         string path to the output directory, sheets go to tgt_dir/sheets
+    :param kinematic_tree:  list of joint chains
+    :param k:               number of keyframes per clip
+    :param mode:            'uniform' or 'energy', see select_keyframes
+    :param thumb_size:      width and height of a keyframe in pixels
+    :param clips_per_sheet: number of clips, one row each, on a sheet
+    :param sheets_per_page: number of sheets on one HTML page
+    :param num_workers:     number of rendering processes, defaults to the number of cpus
+    :return failures:       list of error messages of the clips that could not be rendered
+    """
+    from tqdm import tqdm
+
+    sheet_dir = pjoin(tgt_dir, 'sheets')
+    os.makedirs(sheet_dir, exist_ok=True)
+    npy_files = sorted(f for f in os.listdir(src_dir) if f.endswith('.npy'))
+    settings = repr((k, mode, thumb_size, kinematic_tree))
+
+    sheets, jobs = [], []
+    for i in tqdm(range(0, len(npy_files), clips_per_sheet)):
+        names = npy_files[i:i + clips_per_sheet]
+        paths = [pjoin(src_dir, name) for name in names]
+        digest = hashlib.sha1((settings + ''.join(clip_hash(path) for path in paths)).encode('utf-8')).hexdigest()
+        sheet_name = digest + '.png'
+        sheets.append((sheet_name, [name[:-4] for name in names], []))
+        if not os.path.exists(pjoin(sheet_dir, sheet_name)):
+            jobs.append((paths, pjoin(sheet_dir, sheet_name), kinematic_tree, k, mode, thumb_size))
+
+    print(f"Rendering {len(jobs)} of {len(sheets)} sheets")
+    sheet_failures = {}
+    with Pool(num_workers) as pool:
+        for (save_path, clip_failures) in tqdm(pool.imap_unordered(_render_sheet, jobs), total=len(jobs)):
+            sheet_failures[os.path.basename(save_path)] = clip_failures
+    sheets = [(sheet_name, clip_names, sheet_failures.get(sheet_name, []))
+              for (sheet_name, clip_names, _) in sheets]
+    failures = [f"{name}: {error}" for (_, _, clip_failures) in sheets for (name, error) in clip_failures]
+    for error in failures:
+        print(error)
+
+    write_index(tgt_dir, sheets, sheets_per_page)
+    return failures
+
+
+if __name__ == "__main__":
+    from paramUtil import t2m_kinematic_chain
+
+    src_dir = './HumanML3D/new_joints/'
+    tgt_dir = './HumanML3D/contact_sheets/'
+    build_contact_sheets(src_dir, tgt_dir, t2m_kinematic_chain, k=8, mode='energy', clips_per_sheet=10)
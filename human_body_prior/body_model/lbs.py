@@ -161,8 +161,44 @@ def vertices2landmarks(vertices, faces, lmk_faces_idx, lmk_bary_coords):
     return landmarks
 
 
+def sparse_lbs_weights(lbs_weights, topk=None):
+    ''' Keeps the largest skinning weights of every vertex as a sparse matrix
+
+        Parameters
+        ----------
+        lbs_weights: torch.tensor V x (J + 1)
+            The dense linear blend skinning weights
+        topk: int or None, optional
+            Number of joints kept per vertex. None keeps all non-zero
+            weights, which is exact.
+
+        Returns
+        -------
+        sparse_weights: torch.sparse_coo_tensor V x (J + 1)
+            The kept weights, renormalized to the original sum per vertex
+            when weights were dropped
+        dropped: float
+            The largest weight mass dropped from a vertex, 0 when exact
+    '''
+    num_verts, num_joints = lbs_weights.shape
+    if topk is None:
+        topk = int((lbs_weights != 0).sum(dim=1).max())
+    topk = min(topk, num_joints)
+    weights, indices = torch.topk(lbs_weights, topk, dim=1)
+    dropped = float(lbs_weights.scatter(1, indices, 0).sum(dim=1).max())
+    if dropped > 0:
+        weights = weights * (lbs_weights.sum(dim=1, keepdim=True) / weights.sum(dim=1, keepdim=True))
+
+    rows = torch.arange(num_verts, device=lbs_weights.device).unsqueeze(1).expand(-1, topk)
+    keep = weights != 0
+    sparse_weights = torch.sparse_coo_tensor(torch.stack([rows[keep], indices[keep]]), weights[keep],
+                                             size=(num_verts, num_joints), check_invariants=True).coalesce()
+    return sparse_weights, dropped
+
+
 def lbs(betas, pose, v_template, shapedirs, posedirs, J_regressor, parents,
-        lbs_weights, joints = None, pose2rot=True, v_shaped=None, dtype=torch.float32):
+        lbs_weights, joints = None, pose2rot=True, v_shaped=None, dtype=torch.float32, sparse_weights=None,
+        joints_only=False):
     ''' Performs Linear Blend Skinning with the given shape and pose parameters
 
         Parameters
@@ -191,6 +227,12 @@ def lbs(betas, pose, v_template, shapedirs, posedirs, J_regressor, parents,
             should already contain rotation matrices and have a size of
             Bx(J + 1)x9
         dtype: torch.dtype, optional
+        sparse_weights: torch.sparse_coo_tensor, optional
+            The skinning weights as returned by sparse_lbs_weights. When given,
+            every vertex blends only the transforms of its non-zero joints
+        joints_only: bool, optional
+            Skip the pose blend shapes and the skinning, posedirs and
+            lbs_weights are not read and verts is None
 
         Returns
         -------
@@ -215,6 +257,14 @@ def lbs(betas, pose, v_template, shapedirs, posedirs, J_regressor, parents,
     else:
         J = vertices2joints(J_regressor, v_shaped)
 
+    if joints_only:
+        if pose2rot:
+            rot_mats = batch_rodrigues(pose.view(-1, 3), dtype=dtype).view([batch_size, -1, 3, 3])
+        else:
+            rot_mats = pose.view(batch_size, -1, 3, 3)
+        J_transformed, _ = batch_rigid_transform(rot_mats, J, parents, dtype=dtype)
+        return None, J_transformed
+
     # 3. Add pose blend shapes
     # N x J x 3 x 3
     ident = torch.eye(3, dtype=dtype, device=device)
@@ -237,12 +287,20 @@ def lbs(betas, pose, v_template, shapedirs, posedirs, J_regressor, parents,
     J_transformed, A = batch_rigid_transform(rot_mats, J, parents, dtype=dtype)
 
     # 5. Do skinning:
-    # W is N x V x (J + 1)
-    W = lbs_weights.unsqueeze(dim=0).expand([batch_size, -1, -1])
-    # (N x V x (J + 1)) x (N x (J + 1) x 16)
     num_joints = J_regressor.shape[0]
-    T = torch.matmul(W, A.view(batch_size, num_joints, 16)) \
-        .view(batch_size, -1, 4, 4)
+    if sparse_weights is not None:
+        # V x (J + 1) sparse times (J + 1) x (N * 12), only the top 3 rows of the transforms are needed
+        A_rows = A[:, :, :3, :].permute(1, 0, 2, 3).reshape(num_joints, batch_size * 12)
+        T = torch.sparse.mm(sparse_weights, A_rows).view(-1, batch_size, 3, 4)
+        v_posed = v_posed.transpose(0, 1)
+        verts = torch.einsum('vnij,vnj->vni', T[..., :3], v_posed) + T[..., 3]
+        return verts.transpose(0, 1), J_transformed
+    else:
+        # W is N x V x (J + 1)
+        W = lbs_weights.unsqueeze(dim=0).expand([batch_size, -1, -1])
+        # (N x V x (J + 1)) x (N x (J + 1) x 16)
+        T = torch.matmul(W, A.view(batch_size, num_joints, 16)) \
+            .view(batch_size, -1, 4, 4)
 
     homogen_coord = torch.ones([batch_size, v_posed.shape[1], 1],
                                dtype=dtype, device=device)
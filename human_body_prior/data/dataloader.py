@@ -23,33 +23,95 @@
 
 import glob, os
 
+import numpy as np
 import torch
 from torch.utils.data import Dataset
 from configer import Configer
 
+
+def pt2npy(data_fname):
+    '''
+    Convert a pytorch dataset field into a .npy file next to it, so that it can be memory mapped.
+    The conversion happens once; later calls reuse the .npy file as long as it is newer than the .pt file.
+    :param data_fname: path to a *.pt file holding one data field
+    :return: path to the respective *.npy file
+    '''
+    npy_fname = os.path.splitext(data_fname)[0] + '.npy'
+    if os.path.exists(npy_fname) and os.path.getmtime(npy_fname) >= os.path.getmtime(data_fname):
+        return npy_fname
+
+    data = torch.load(data_fname).type(torch.float32).numpy()
+    # write to a temporary file first so that concurrent readers never attach to a half written array
+    tmp_fname = '{}.{}.tmp'.format(npy_fname, os.getpid())
+    with open(tmp_fname, 'wb') as f:
+        np.save(f, np.ascontiguousarray(data))
+    os.replace(tmp_fname, npy_fname)
+    return npy_fname
+
+
 class VPoserDS(Dataset):
     """AMASS: a pytorch loader for unified human motion capture dataset. http://amass.is.tue.mpg.de/"""
 
-    def __init__(self, dataset_dir, data_fields=[]):
+    def __init__(self, dataset_dir, data_fields=[], memmap=False):
+        '''
+
+        :param dataset_dir: directory holding one *.pt file per data field
+        :param data_fields: data fields to load; all available fields if empty
+        :param memmap: if True, fields are memory mapped from *.npy copies of the *.pt files instead of being loaded
+                       into the process memory. the pages are shared by all DataLoader workers through the OS page cache.
+        '''
         assert os.path.exists(dataset_dir)
+        self.memmap = memmap
         self.ds = {}
+        self.ds_fnames = {}
         for data_fname in glob.glob(os.path.join(dataset_dir, '*.pt')):
             k = os.path.basename(data_fname).replace('.pt','')
             if len(data_fields) != 0 and k not in data_fields: continue
-            self.ds[k] = torch.load(data_fname).type(torch.float32)
+            if memmap:
+                self.ds_fnames[k] = pt2npy(data_fname)
+            else:
+                self.ds[k] = torch.load(data_fname).type(torch.float32)
 
         dataset_ps_fname = glob.glob(os.path.join(dataset_dir, '..', '*.ini'))
         if len(dataset_ps_fname):
             self.ps = Configer(default_ps_fname=dataset_ps_fname[0], dataset_dir=dataset_dir)
 
+    def _attach(self):
+        # memory maps are opened lazily so that every worker process attaches to the files on its own
+        if self.memmap and len(self.ds) == 0:
+            self.ds = {k: np.load(fname, mmap_mode='r') for k, fname in self.ds_fnames.items()}
+        return self.ds
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        # never pickle memory mapped arrays to the workers, they would be copied in full
+        if self.memmap: state['ds'] = {}
+        return state
+
     def __len__(self):
-        k = list(self.ds.keys())[0]
-        return len(self.ds[k])
+        ds = self._attach()
+        k = list(ds.keys())[0]
+        return len(ds[k])
 
     def __getitem__(self, idx):
         return self.fetch_data(idx)
 
+    def __getitems__(self, indices):
+        '''
+        Fetch a whole batch of indices with one gather per data field instead of one read per sample.
+        Returns the list of per sample dictionaries that the default collate_fn of a DataLoader expects.
+        '''
+        ds = self._attach()
+        indices = np.asarray(indices, dtype=np.int64)
+        if self.memmap:
+            batch = {k: torch.from_numpy(np.ascontiguousarray(ds[k][indices])) for k in ds.keys()}
+        else:
+            batch = {k: ds[k].index_select(0, torch.from_numpy(indices)) for k in ds.keys()}
+        return [{k: batch[k][i] for k in batch.keys()} for i in range(len(indices))]
+
     def fetch_data(self, idx):
-        data = {k: self.ds[k][idx] for k in self.ds.keys()}
+        ds = self._attach()
+        if self.memmap:
+            return {k: torch.from_numpy(np.array(ds[k][idx])) for k in ds.keys()}
+        data = {k: ds[k][idx] for k in ds.keys()}
         return data
-
@@ -33,7 +33,8 @@ from datetime import datetime
 import torch
 from human_body_prior.tools.rotation_tools import noisy_zrot
 import os.path as osp
-import numpy as np
+import zlib
+from multiprocessing import Pool
 from human_body_prior.tools.omni_tools import logger_sequencer
 import pickle
 from configer import Configer
@@ -66,7 +67,77 @@ def dataset_exists(dataset_dir, split_names=None):
             done.append(os.path.exists(outfname))
     return np.all(done)
 
-def prepare_vposer_datasets(vposer_dataset_dir, amass_splits, amass_dir, logger=None):
+def sample_amass_seq(npz_fname, keep_rate=0.3, rnd_seed=100):
+    '''
+    Randomly pick a subset of frames of one AMASS sequence.
+    The random generator is seeded by the file name, hence the selection is reproducible no matter
+    in which order or on which worker the sequences are processed.
+    :param npz_fname: path to an AMASS *_poses.npz file
+    :param keep_rate: ratio of the frames to be kept
+    :param rnd_seed: global seed of the dataset
+    :return: dictionary of data fields or None if the sequence is too short
+    '''
+    poses = np.load(npz_fname)['poses']
+    N = len(poses)
+
+    # skip first and last frames to avoid initial standard poses, e.g. T pose
+    frame_ids = np.arange(int(0.1 * N), int(0.9 * N))
+    num_keep = int(keep_rate * 0.8 * N)
+    if num_keep < 1 or num_keep > len(frame_ids): return None
+
+    fname_seed = zlib.crc32('/'.join(npz_fname.split(os.sep)[-3:]).encode('utf-8'))
+    rng = np.random.default_rng([rnd_seed, fname_seed])
+    cdata_ids = np.sort(rng.choice(frame_ids, num_keep, replace=False))
+
+    fullpose = poses[cdata_ids].astype(np.float32)
+    return {'pose_body': fullpose[:,3:66], 'root_orient': fullpose[:,:3]}
+
+
+def _sample_amass_seq(args):
+    return sample_amass_seq(*args)
+
+
+class npy_appender():
+    '''
+    Grow a 2D float32 array on disk chunk by chunk and finally expose it as a .npy file,
+    so that memory use does not depend on the size of the dataset.
+    '''
+    def __init__(self, outpath):
+        self.outpath = outpath
+        self.partpath = outpath + '.part'
+        self.fhandle = open(self.partpath, 'wb')
+        self.num_rows = 0
+        self.num_cols = None
+
+    def append(self, data):
+        data = np.ascontiguousarray(data, dtype=np.float32)
+        if self.num_cols is None: self.num_cols = data.shape[1]
+        assert data.shape[1] == self.num_cols, ValueError('Expected {} columns but got {}'.format(self.num_cols, data.shape[1]))
+        self.fhandle.write(data.tobytes())
+        self.num_rows += len(data)
+
+    def close(self, num_cols=0):
+        self.fhandle.close()
+        if self.num_cols is None: self.num_cols = num_cols
+        header = {'descr': np.lib.format.dtype_to_descr(np.dtype(np.float32)),
+                  'fortran_order': False,
+                  'shape': (self.num_rows, self.num_cols)}
+        tmppath = self.outpath + '.tmp'
+        with open(tmppath, 'wb') as fout, open(self.partpath, 'rb') as fin:
+            np.lib.format.write_array_header_1_0(fout, header)
+            shutil.copyfileobj(fin, fout, 16 * 1024 * 1024)
+        os.replace(tmppath, self.outpath)
+        os.remove(self.partpath)
+        return self.outpath
+
+
+def prepare_vposer_datasets(vposer_dataset_dir, amass_splits, amass_dir, logger=None, keep_rate=0.3, rnd_seed=100, num_workers=None):
+    '''
+    Turn AMASS npz files into per split pytorch data fields.
+    Each sequence is read exactly once by a pool of workers and the sampled frames are streamed into on-disk arrays,
+    hence building the dataset is linear in the size of AMASS and does not need to hold it in memory.
+    :param num_workers: number of reading processes. defaults to the number of cpus
+    '''
 
     if dataset_exists(vposer_dataset_dir):
         if logger is not None: logger('VPoser dataset already exists at {}'.format(vposer_dataset_dir))
@@ -80,55 +151,45 @@ def prepare_vposer_datasets(vposer_dataset_dir, amass_splits, amass_dir, logger=
 
     shutil.copy2(__file__, vposer_dataset_dir)
 
-    # class AMASS_ROW(pytables.IsDescription):
-    #
-    #     # gender = pytables.Int16Col(1)  # 1-character String
-    #     root_orient = pytables.Float32Col(3)  # float  (single-precision)
-    #     pose_body = pytables.Float32Col(21 * 3)  # float  (single-precision)
-    #     # pose_hand = pytables.Float32Col(2 * 15 * 3)  # float  (single-precision)
-    #
-    #     # betas = pytables.Float32Col(16)  # float  (single-precision)
-    #     # trans = pytables.Float32Col(3)  # float  (single-precision)
-
-    def fetch_from_amass(ds_names):
-        keep_rate = 0.3
+    field_dims = {'pose_body': 63, 'root_orient': 3}
 
+    def amass_fnames(ds_names):
         npz_fnames = []
         for ds_name in ds_names:
-            mosh_stageII_fnames = glob.glob(osp.join(amass_dir, ds_name, '*/*_poses.npz'))
+            mosh_stageII_fnames = sorted(glob.glob(osp.join(amass_dir, ds_name, '*/*_poses.npz')))
             npz_fnames.extend(mosh_stageII_fnames)
             logger('Found {} sequences from {}.'.format(len(mosh_stageII_fnames), ds_name))
+        # a dataset listed twice should not be loaded twice
+        return list(dict.fromkeys(npz_fnames))
 
-            for npz_fname in npz_fnames:
-                cdata = np.load(npz_fname)
-                N = len(cdata['poses'])
-
-                # skip first and last frames to avoid initial standard poses, e.g. T pose
-                cdata_ids = np.random.choice(list(range(int(0.1 * N), int(0.9 * N), 1)), int(keep_rate * 0.8 * N), replace=False)
-                if len(cdata_ids) < 1: continue
-                fullpose = cdata['poses'][cdata_ids].astype(np.float32)
-                yield {'pose_body': fullpose[:,3:66], 'root_orient': fullpose[:,:3]}
+    with Pool(num_workers) as pool:
+        for split_name, ds_names in amass_splits.items():
+            if dataset_exists(vposer_dataset_dir, split_names=[split_name]): continue
+            logger('Preparing VPoser data for split {}'.format(split_name))
 
-    for split_name, ds_names in amass_splits.items():
-        if dataset_exists(vposer_dataset_dir, split_names=[split_name]): continue
-        logger('Preparing VPoser data for split {}'.format(split_name))
+            npz_fnames = amass_fnames(ds_names)
 
-        data_fields = {}
-        for data in fetch_from_amass(ds_names):
-            for k in data.keys():
-                if k not in data_fields: data_fields[k] = []
-                data_fields[k].append(data[k])
+            writers = {k: npy_appender(makepath(vposer_dataset_dir, split_name, '{}.npy'.format(k), isfile=True)) for k in field_dims}
+            jobs = [(npz_fname, keep_rate, rnd_seed) for npz_fname in npz_fnames]
+            # imap keeps the order of the files, so the output does not depend on scheduling
+            for data in tqdm(pool.imap(_sample_amass_seq, jobs, chunksize=4), total=len(jobs)):
+                if data is None: continue
+                for k, v in data.items(): writers[k].append(v)
 
-        for k, v in data_fields.items():
-            outpath = makepath(vposer_dataset_dir, split_name, '{}.pt'.format(k), isfile=True)
-            v = np.concatenate(v)
-            torch.save(torch.tensor(v), outpath)
+            for k, writer in writers.items():
+                npy_fname = writer.close(num_cols=field_dims[k])
+                outpath = makepath(vposer_dataset_dir, split_name, '{}.pt'.format(k), isfile=True)
+                torch.save(torch.from_numpy(np.load(npy_fname, mmap_mode='c')), outpath)
+                # keep the .npy newer than the .pt so that memory mapped loaders reuse it
+                os.utime(npy_fname)
 
-        logger('{} datapoints dumped for split {}. ds_meta_pklpath: {}'.format(len(v), split_name, osp.join(vposer_dataset_dir, split_name)))
+            logger('{} datapoints dumped for split {}. ds_meta_pklpath: {}'.format(writers['pose_body'].num_rows, split_name, osp.join(vposer_dataset_dir, split_name)))
 
     Configer(**{
         'amass_splits':amass_splits.toDict(),
         'amass_dir': amass_dir,
+        'keep_rate': keep_rate,
+        'rnd_seed': rnd_seed,
     }).dump_settings(makepath(vposer_dataset_dir, 'settings.ini', isfile=True))
 
-    logger('Dumped final pytorch dataset at %s' % vposer_dataset_dir)
\ No newline at end of file
+    logger('Dumped final pytorch dataset at %s' % vposer_dataset_dir)
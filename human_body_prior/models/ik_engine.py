@@ -47,10 +47,12 @@ from human_body_prior.tools.omni_tools import flatten_list
 def visualize(points, bm_f, mvs, kpts_colors, verbosity=2, logger=None):
     from human_body_prior.tools.omni_tools import log2file
 
+    # no callback at all, so the optimization does not prepare anything for it
+    if verbosity <= 0: return None
+
     if logger is None: logger = log2file()
 
     def view(opt_objs, body_v, virtual_markers, opt_it):
-        if verbosity <= 0: return
         opt_objs_cpu = {k: c2c(v) for k, v in opt_objs.items()}
 
         total_loss = np.sum([np.sum(v) for k, v in opt_objs_cpu.items()])
@@ -61,6 +63,7 @@ def visualize(points, bm_f, mvs, kpts_colors, verbosity=2, logger=None):
             np.random.seed(100)
             frame_ids = list(range(bs)) if bs <= len(mvs) else np.random.choice(bs , size=len(mvs), replace=False).tolist()
             if bs > len(mvs): message += ' -- [frame_ids: {}]'.format(frame_ids)
+            body_v, virtual_markers = c2c(body_v), c2c(virtual_markers)
             for dispId, fId in enumerate(frame_ids): # check for the number of frames in mvs and show a randomly picked number of frames in body if there is more to show than row*cols available
                 new_body_v = rotateXYZ(body_v[fId], [-90,0,0])
 
@@ -84,26 +87,65 @@ def visualize(points, bm_f, mvs, kpts_colors, verbosity=2, logger=None):
 
 
 class AdamInClosure():
-    def __init__(self, var_list, lr, max_iter=100, tolerance_change=1e-5):
+    def __init__(self, var_list, lr, max_iter=100, tolerance_change=1e-5, per_sample=False):
+        '''
+        :param per_sample: track convergence per sample. The closure reports through sample_losses the loss every
+                           sample would have if it were fitted alone, and through sample_shares its share in the
+                           batch loss. A sample whose own loss changes less than tolerance_change is frozen and left
+                           out of the closure through active, the batch stops as before when its loss, with the
+                           frozen shares held, changes less than tolerance_change
+        '''
+        self.var_list = var_list
         self.optimizer = torch.optim.Adam(var_list, lr)
         self.max_iter = max_iter
         self.tolerance_change = tolerance_change
+        self.per_sample = per_sample
+        # bool mask of the samples still optimized, None while every sample is
+        self.active = None
+        self.sample_losses = None
+        self.sample_shares = None
 
 
     def step(self, closure):
         prev_loss = None
+        prev_sample_losses = None
+        sample_shares = None
+        self.active = None
         for it in range(self.max_iter):
+            self.sample_losses = None
             loss = closure()
-            self.optimizer.step()
-            if prev_loss is None:
-                prev_loss = loss
-                continue
             if torch.isnan(loss):
                 # breakpoint()
                 break
-            if abs(loss - prev_loss) <  self.tolerance_change:
+
+            frozen = None if self.active is None else ~self.active
+            if frozen is not None:
+                # adam momentum would keep moving frozen samples with zero gradients, so their values are restored
+                frozen_values = [v.detach()[frozen].clone() if v.shape[0] == frozen.shape[0] else None for v in self.var_list]
+            self.optimizer.step()
+            if frozen is not None:
+                with torch.no_grad():
+                    for v, value in zip(self.var_list, frozen_values):
+                        if value is not None: v[frozen] = value
+
+            if self.per_sample and self.sample_losses is not None:
+                sample_losses = self.sample_losses.detach()
+                if prev_sample_losses is not None:
+                    converged = torch.abs(sample_losses - prev_sample_losses) < self.tolerance_change
+                    self.active = ~converged if self.active is None else self.active & ~converged
+                    if not self.active.any():
+                        break
+                # frozen samples keep their last loss
+                prev_sample_losses = sample_losses if prev_sample_losses is None \
+                    else torch.where(torch.isnan(sample_losses), prev_sample_losses, sample_losses)
+                sample_shares = self.sample_shares.detach() if sample_shares is None \
+                    else torch.where(torch.isnan(self.sample_shares), sample_shares, self.sample_shares.detach())
+                loss = sample_shares.sum()
+
+            if prev_loss is not None and abs(loss - prev_loss) <  self.tolerance_change:
                 print('abs(loss - prev_loss) <  self.tolerance_change')
                 break
+            prev_loss = loss
 
     def zero_grad(self):
         self.optimizer.zero_grad()
@@ -114,22 +156,60 @@ def ik_fit(optimizer, source_kpts_model, static_vars, vp_model, extra_params={},
     # data_loss =
     # data_loss = torch.nn.L1Loss(reduction='mean')#change with SmoothL1
 
+    # per sample losses need the elementwise data loss, available from torch losses with mean reduction.
+    # shared betas and the smoothness term couple the samples, so they are never frozen apart
+    per_sample = getattr(optimizer, 'per_sample', False) and getattr(data_loss, 'reduction', None) == 'mean' \
+                 and 'subject_ids' not in static_vars and 'smooth_mask' not in static_vars
+    if per_sample:
+        import copy
+        elementwise_loss = copy.copy(data_loss)
+        elementwise_loss.reduction = 'none'
+
     def fit(weights, free_vars):
 
         fit.gstep += 1
         optimizer.zero_grad()
 
-        free_vars['pose_body'] = vp_model.decode(free_vars['poZ_body'])['pose_body'].contiguous().view(-1, 63)
-        nonan_mask = torch.isnan(free_vars['poZ_body']).sum(-1) == 0
+        active = getattr(optimizer, 'active', None) if per_sample else None
+        if active is None:
+            ids = None
+            free_vars['pose_body'] = vp_model.decode(free_vars['poZ_body'])['pose_body'].contiguous().view(-1, 63)
+            sample_vars, target_kpts = free_vars, static_vars['target_kpts']
+        else:
+            # only the samples that did not converge yet are evaluated
+            ids = torch.nonzero(active)[:, 0]
+            sample_vars = {k: v[ids] for k, v in free_vars.items() if k != 'pose_body'}
+            sample_vars['pose_body'] = vp_model.decode(sample_vars['poZ_body'])['pose_body'].contiguous().view(-1, 63)
+            pose_body = free_vars['pose_body'].detach().clone()
+            pose_body[ids] = sample_vars['pose_body']
+            free_vars['pose_body'] = pose_body
+            target_kpts = static_vars['target_kpts'][ids]
+        if 'subject_betas' in free_vars:
+            # one shape per subject, shared by all of its frames
+            free_vars['betas'] = free_vars['subject_betas'][static_vars['subject_ids']]
+        nonan_mask = torch.isnan(sample_vars['poZ_body']).sum(-1) == 0
 
         opt_objs = {}
 
-        res = source_kpts_model(free_vars)
+        res = source_kpts_model(sample_vars)
 
-        opt_objs['data'] = data_loss(res['source_kpts'], static_vars['target_kpts'])
+        if per_sample:
+            # mean over the whole batch, frozen samples count with a zero loss
+            batch_size = static_vars['target_kpts'].shape[0]
+            data_elements = elementwise_loss(res['source_kpts'], target_kpts).reshape(len(target_kpts), -1)
+            sample_data = data_elements.mean(1) / batch_size
+            opt_objs['data'] = sample_data.sum()
+        else:
+            opt_objs['data'] = data_loss(res['source_kpts'], target_kpts)
 
-        opt_objs['betas'] = torch.pow(free_vars['betas'][nonan_mask],2).sum()
-        opt_objs['poZ_body'] = torch.pow(free_vars['poZ_body'][nonan_mask],2).sum()
+        opt_objs['betas'] = torch.pow(sample_vars['betas'][nonan_mask],2).sum()
+        opt_objs['poZ_body'] = torch.pow(sample_vars['poZ_body'][nonan_mask],2).sum()
+
+        if 'smooth_mask' in static_vars:
+            # squared velocities between consecutive frames of the same sequence
+            smooth_mask = static_vars['smooth_mask']
+            opt_objs['smooth'] = torch.sum(torch.stack([torch.pow(free_vars[k][1:] - free_vars[k][:-1], 2)[smooth_mask].sum()
+                                                        for k in ['pose_body', 'root_orient', 'trans']]))
 
 
         opt_objs = {k: opt_objs[k]*v for k, v in weights.items() if k in opt_objs.keys()}
@@ -138,8 +218,23 @@ def ik_fit(optimizer, source_kpts_model, static_vars, vp_model, extra_params={},
 
         loss_total.backward()
 
+        if per_sample:
+            with torch.no_grad():
+                sample_regs = weights.get('betas', 0.) * torch.pow(sample_vars['betas'], 2).sum(-1) \
+                              + weights.get('poZ_body', 0.) * torch.pow(sample_vars['poZ_body'], 2).sum(-1)
+                # the loss each sample would have if it were fitted alone, and its share in loss_total
+                sample_losses = weights.get('data', 0.) * sample_data * batch_size + sample_regs
+                sample_shares = weights.get('data', 0.) * sample_data + sample_regs
+                if ids is not None:
+                    unset = torch.full([batch_size], float('nan'), device=sample_losses.device)
+                    sample_losses = unset.index_copy(0, ids, sample_losses)
+                    sample_shares = unset.index_copy(0, ids, sample_shares)
+            optimizer.sample_losses = sample_losses
+            optimizer.sample_shares = sample_shares
+
         if on_step is not None:
-            on_step(opt_objs, c2c(res['body'].v), c2c(res['source_kpts']), fit.gstep)
+            # detached tensors, the callback copies what it displays
+            on_step(opt_objs, None if res['body'].v is None else res['body'].v.detach(), res['source_kpts'].detach(), fit.gstep)
 
         fit.free_vars = {k:v for k,v in free_vars.items()}# if k in IK_Engine.fields_to_optimize}
         # fit.nonan_mask = nonan_mask
@@ -169,7 +264,7 @@ class IK_Engine(nn.Module):
 
         :param vposer_expr_dir: The vposer directory that holds the settings and model snapshot
         :param data_loss: should be a pytorch callable (source, target) that returns the accumulated loss
-        :param optimizer_args: arguments for optimizers
+        :param optimizer_args: arguments for optimizers, for ADAM per_sample=True opts in to freezing converged samples
         :param stepwise_weights: list of dictionaries. each list element defines weights for one full step of optimization
                                  if a weight value is left out, its respective object item will be removed as well. imagine optimizing without data term!
         :param display_rc: number of row and columns in case verbosity > 1
@@ -243,6 +338,20 @@ class IK_Engine(nn.Module):
                        # 'poZ_body': initial_body_params['poZ_body'].detach()
                        }
 
+        closure = self._optimize(source_kpts, static_vars, free_vars, self.stepwise_weights, on_step)
+
+        # if closure.final_loss is None or torch.isnan(closure.final_loss) or torch.any(torch.isnan(free_vars['trans'])):
+        #     if self.verbosity > 0:
+        #         self.logger('NaN observed in the optimization results. you might want to restart the refinment procedure.')
+        #     breakpoint()
+        #     return None
+
+        return closure.free_vars#, closure.nonan_mask
+
+    def _optimize(self, source_kpts, static_vars, free_vars, stepwise_weights, on_step, gstep=0):
+        '''
+        Run the annealed optimization steps on free_vars, returns the closure holding the results.
+        '''
         if self.optimizer_args['type'].upper() == 'LBFGS':
             optimizer = torch.optim.LBFGS(list(free_vars.values()),
                                           lr=self.optimizer_args.get('lr', 1),
@@ -257,11 +366,11 @@ class IK_Engine(nn.Module):
                                       lr=self.optimizer_args.get('lr', 1e-3),
                                       max_iter=self.optimizer_args.get('max_iter', 100),
                                       tolerance_change=self.optimizer_args.get('tolerance_change', 1e-5),
+                                      per_sample=self.optimizer_args.get('per_sample', False),
                                       )
         else:
             raise ValueError('optimizer_type not recognized.')
 
-        gstep = 0
         closure = ik_fit(optimizer,
                          source_kpts_model=source_kpts,
                          static_vars=static_vars,
@@ -271,17 +380,99 @@ class IK_Engine(nn.Module):
                          gstep=gstep)
         # try:
 
-        for wts in self.stepwise_weights:
+        for wts in stepwise_weights:
             optimizer.step(lambda: closure(wts, free_vars))
             free_vars = closure.free_vars
         # except:
         #
         #     pass
 
-        # if closure.final_loss is None or torch.isnan(closure.final_loss) or torch.any(torch.isnan(free_vars['trans'])):
-        #     if self.verbosity > 0:
-        #         self.logger('NaN observed in the optimization results. you might want to restart the refinment procedure.')
-        #     breakpoint()
-        #     return None
+        return closure
 
-        return closure.free_vars#, closure.nonan_mask
+    def fit_sequences(self, source_kpts, target_sequences, window_size=64, overlap=8, smoothness_weight=None,
+                      initial_betas=None):
+        '''
+        Fit motion sequences in overlapping windows of frames. Each window starts from the solution of the
+        previous one, its new frames from the last solved frame, and the windows of all sequences are
+        optimized together as one batch. Every sequence is one subject with one shared betas.
+
+        :param source_kpts: as for forward, a function of the body parameters that computes the source key points
+        :param target_sequences: list of TxKx3 target key point tensors, one per sequence
+        :param window_size: number of frames optimized at once per sequence
+        :param overlap: number of frames shared by consecutive windows, refit with the next window as context
+        :param smoothness_weight: optional weight of the squared frame to frame velocities of pose_body,
+                                  root_orient and trans, added to every step of stepwise_weights. None or 0 skips the term
+        :param initial_betas: optional SxB initial betas of the sequences, B defaults to the number of betas of source_kpts.bm
+        :return: list of dictionaries with per frame pose_body, poZ_body, root_orient, trans and the betas of each sequence
+        '''
+        assert 0 <= overlap < window_size, ValueError('overlap should be smaller than window_size.')
+
+        comp_device = target_sequences[0].device
+        stride = window_size - overlap
+        num_windows = [1 + max(0, int(np.ceil((len(target) - window_size) / stride))) for target in target_sequences]
+        # the body model of the source key points decides the number of shape parameters
+        num_betas = 10
+        if initial_betas is not None: num_betas = initial_betas.shape[-1]
+        elif hasattr(source_kpts, 'bm'): num_betas = source_kpts.bm.shapedirs.shape[-1]
+
+        results = []
+        for sId, target in enumerate(target_sequences):
+            T = len(target)
+            results.append({
+                'poZ_body': self.vp_model.encode(torch.zeros([1, 63], device=comp_device)).mean.detach().repeat(T, 1),
+                'root_orient': torch.zeros([T, 3], device=comp_device),
+                'trans': torch.zeros([T, 3], device=comp_device),
+                'betas': torch.zeros([num_betas], device=comp_device) if initial_betas is None else initial_betas[sId].detach().clone(),
+            })
+
+        stepwise_weights = self.stepwise_weights
+        if smoothness_weight:
+            stepwise_weights = [dict(wts, smooth=smoothness_weight) for wts in stepwise_weights]
+
+        gstep = 0
+        for wId in range(max(num_windows)):
+            active = [sId for sId in range(len(target_sequences)) if wId < num_windows[sId]]
+            frames = [np.arange(wId * stride, min(wId * stride + window_size, len(target_sequences[sId]))) for sId in active]
+
+            init = {k: [] for k in ['poZ_body', 'root_orient', 'trans']}
+            for sId, fIds in zip(active, frames):
+                # warm start, frames not solved yet start from the last solved frame
+                solved = min(fIds[-1], wId * stride + overlap - 1) if wId > 0 else fIds[-1]
+                for k in init:
+                    init[k].append(results[sId][k][np.minimum(fIds, solved)])
+
+            subject_ids = torch.cat([torch.full([len(fIds)], i, dtype=torch.long) for i, fIds in enumerate(frames)]).to(comp_device)
+            free_vars = {k: torch.nn.Parameter(torch.cat(v).detach(), requires_grad=True) for k, v in init.items()}
+            free_vars['subject_betas'] = torch.nn.Parameter(torch.stack([results[sId]['betas'] for sId in active]).detach(), requires_grad=True)
+            static_vars = {
+                'target_kpts': torch.cat([target_sequences[sId][fIds] for sId, fIds in zip(active, frames)]),
+                'subject_ids': subject_ids,
+            }
+            if smoothness_weight:
+                static_vars['smooth_mask'] = subject_ids[1:] == subject_ids[:-1]
+
+            on_step = visualize(static_vars['target_kpts'],
+                                kpts_colors=source_kpts.kpts_colors,
+                                bm_f=source_kpts.bm_f,
+                                mvs=self.mvs,
+                                verbosity=self.verbosity,
+                                logger=self.logger)
+
+            closure = self._optimize(source_kpts, static_vars, free_vars, stepwise_weights, on_step, gstep=gstep)
+            if self.verbosity > 0:
+                self.logger('window {} -- {} sequences, {} frames, {} iterations'.format(wId, len(active), len(subject_ids), closure.gstep - gstep))
+            gstep = closure.gstep
+
+            start = 0
+            for i, (sId, fIds) in enumerate(zip(active, frames)):
+                # the first half of the overlap keeps the previous window's solution
+                keep = overlap // 2 if wId > 0 else 0
+                for k in init:
+                    results[sId][k][fIds[keep:]] = closure.free_vars[k][start + keep:start + len(fIds)].detach()
+                results[sId]['betas'] = closure.free_vars['subject_betas'][i].detach()
+                start += len(fIds)
+
+        with torch.no_grad():
+            for res in results:
+                res['pose_body'] = self.vp_model.decode(res['poZ_body'])['pose_body'].contiguous().view(-1, 63)
+        return results
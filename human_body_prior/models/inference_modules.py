@@ -0,0 +1,280 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2019 Max-Planck-Gesellschaft zur Förderung der Wissenschaften e.V. (MPG),
+# acting on behalf of its Max Planck Institute for Intelligent Systems and the
+# Max Planck Institute for Biological Cybernetics. All rights reserved.
+#
+# Max-Planck-Gesellschaft zur Förderung der Wissenschaften e.V. (MPG) is holder of all proprietary rights
+# on this computer program. You can only use this computer program if you have closed a license agreement
+# with MPG or you get the right to use the computer program from someone who is authorized to grant you that right.
+# Any use of the computer program without a valid license is prohibited and liable to prosecution.
+# Contact: ps-license@tuebingen.mpg.de
+#
+#
+# If you use this code in a research publication please consider citing the following:
+#
+# Expressive Body Capture: 3D Hands, Face, and Body from a Single Image <https://arxiv.org/abs/1904.05866>
+#
+'''
+Specialized inference modules of BodyModel and VPoser for TorchScript export.
+
+Every module has a fixed signature and no Python branching on model types or
+None defaults, so torch.jit.script compiles it as a whole and the exported file
+loads with torch.jit.load alone:
+
+    from human_body_prior.models.inference_modules import BodyJointsModule, export_inference_module
+    export_inference_module(BodyJointsModule(bm), 'smplh_joints.pt')
+    joints = torch.jit.load('smplh_joints.pt')(root_orient, pose_body, pose_hand, betas, trans)
+'''
+
+import weakref
+from typing import List
+
+import torch
+from torch import nn
+from torch.nn import functional as F
+
+from human_body_prior.tools.rotation_tools import matrot2aa
+
+
+def rodrigues(rot_vecs: torch.Tensor, epsilon: float = 1e-8) -> torch.Tensor:
+    '''
+    :param rot_vecs: Nx3 axis-angle rotations
+    :return: Nx3x3 rotation matrices, as lbs.batch_rodrigues computes them
+    '''
+    angle = torch.norm(rot_vecs + epsilon, dim=1, keepdim=True)
+    rot_dir = rot_vecs / angle
+    cos = torch.cos(angle).unsqueeze(1)
+    sin = torch.sin(angle).unsqueeze(1)
+
+    rx, ry, rz = torch.split(rot_dir, 1, dim=1)
+    zeros = torch.zeros_like(rx)
+    K = torch.cat([zeros, -rz, ry, rz, zeros, -rx, -ry, rx, zeros], dim=1).view(-1, 3, 3)
+
+    ident = torch.eye(3, dtype=rot_vecs.dtype, device=rot_vecs.device).unsqueeze(0)
+    return ident + sin * K + (1 - cos) * torch.bmm(K, K)
+
+
+class BodyJointsModule(nn.Module):
+    '''
+    Joint locations of a SMPL/SMPL-H BodyModel, equal to BodyModel.forward(..., joints_only=True).Jtr.
+    The joint regressor is applied to the template and shape directions once here, and the kinematic chain
+    is evaluated one tree level at a time instead of one joint at a time. DMPLs are taken as zero.
+    '''
+
+    def __init__(self, bm):
+        super(BodyJointsModule, self).__init__()
+
+        if bm.model_type not in ['smpl', 'smplh']: raise (
+            NotImplementedError('BodyJointsModule only works with SMPL/SMPLH models for now.'))
+
+        with torch.no_grad():
+            J_regressor = bm.J_regressor
+            shapedirs = bm.shapedirs[..., :bm.init_betas.shape[1]]
+            self.register_buffer('J_template', torch.einsum('jv,vk->jk', J_regressor, bm.init_v_template[0]).clone())
+            self.register_buffer('J_shapedirs', torch.einsum('jv,vkl->jkl', J_regressor, shapedirs).clone())
+
+        parents = bm.kintree_table[0].long().tolist()
+        depth = [0] * len(parents)
+        for i in range(1, len(parents)):
+            depth[i] = depth[parents[i]] + 1
+        self.parents: List[int] = parents
+        self.level_joints: List[List[int]] = [[i for i in range(len(parents)) if depth[i] == d]
+                                              for d in range(1, max(depth) + 1)]
+        self.level_parents: List[List[int]] = [[parents[i] for i in joints] for joints in self.level_joints]
+
+    def forward(self, root_orient: torch.Tensor, pose_body: torch.Tensor, pose_hand: torch.Tensor,
+                betas: torch.Tensor, trans: torch.Tensor) -> torch.Tensor:
+        '''
+        :param root_orient: Nx3
+        :param pose_body: Nx63
+        :param pose_hand: Nx90 for SMPL-H, Nx6 for SMPL
+        :param betas: Nxnum_betas
+        :param trans: Nx3
+        :return: NxJx3 joint locations
+        '''
+        batch_size = root_orient.shape[0]
+        full_pose = torch.cat([root_orient, pose_body, pose_hand], dim=-1)
+        rot_mats = rodrigues(full_pose.view(-1, 3)).view(batch_size, -1, 3, 3)
+
+        J = self.J_template + torch.einsum('bl,jkl->bjk', betas, self.J_shapedirs)
+        rel_joints = J[:, 1:] - J[:, self.parents[1:]]
+
+        global_rot = torch.empty_like(rot_mats)
+        posed = torch.empty_like(J)
+        global_rot[:, 0] = rot_mats[:, 0]
+        posed[:, 0] = J[:, 0]
+        for joints, parents in zip(self.level_joints, self.level_parents):
+            parent_rot = global_rot[:, parents]
+            global_rot[:, joints] = torch.matmul(parent_rot, rot_mats[:, joints])
+            posed[:, joints] = torch.matmul(parent_rot, rel_joints[:, [j - 1 for j in joints]].unsqueeze(-1)).squeeze(-1) \
+                               + posed[:, parents]
+
+        return posed + trans.unsqueeze(dim=1)
+
+
+class VPoserDecodeAA(nn.Module):
+    '''
+    VPoser decoder from latent codes to axis-angle body poses, equal to VPoser.decode(Zin)['pose_body'] in eval mode.
+    '''
+
+    def __init__(self, vp):
+        super(VPoserDecodeAA, self).__init__()
+
+        import copy
+        # the dropout of the decoder is the identity at inference, the 6D to matrix step is done in forward
+        self.decoder_net = nn.Sequential(*[copy.deepcopy(layer) for layer in vp.decoder_net
+                                           if isinstance(layer, (nn.Linear, nn.LeakyReLU))])
+        self.num_joints: int = vp.num_joints
+
+    def forward(self, Zin: torch.Tensor) -> torch.Tensor:
+        '''
+        :param Zin: NxlatentD
+        :return: Nxnum_jointsx3
+        '''
+        batch_size = Zin.shape[0]
+        reshaped_input = self.decoder_net(Zin).view(-1, 3, 2)
+
+        b1 = F.normalize(reshaped_input[:, :, 0], dim=1)
+        dot_prod = torch.sum(b1 * reshaped_input[:, :, 1], dim=1, keepdim=True)
+        b2 = F.normalize(reshaped_input[:, :, 1] - dot_prod * b1, dim=-1)
+        b3 = torch.cross(b1, b2, dim=1)
+
+        return matrot2aa(torch.stack([b1, b2, b3], dim=-1)).view(batch_size, self.num_joints, 3)
+
+
+def export_inference_module(module, fname=None):
+    '''
+    Script and freeze one of the modules above, and save it when fname is given.
+
+    :param module: BodyJointsModule or VPoserDecodeAA
+    :param fname: optional path of the exported file, loadable with torch.jit.load
+    :return: the frozen scripted module
+    '''
+    scripted = torch.jit.freeze(torch.jit.script(module.eval()))
+    if fname is not None:
+        scripted.save(fname)
+    return scripted
+
+
+def quantize_decoder(decoder):
+    '''
+    :param decoder: VPoserDecodeAA
+    :return: a copy with int8 weights and dynamically quantized activations in its linear layers, for CPU
+    '''
+    return torch.ao.quantization.quantize_dynamic(decoder.eval(), {nn.Linear}, dtype=torch.qint8)
+
+
+class VPoserSampler(object):
+    '''
+    Pose samples of the VPoser prior, decoded in batches into preallocated buffers. Latent codes are always drawn
+    from a torch.Generator a full batch at a time, and the codes one call leaves over are used first by the next
+    call on the same stream, so the same seed gives the same poses whatever num_poses is split into, up to the float
+    rounding of decoding them in differently sized batches.
+    '''
+
+    def __init__(self, vp, batch_size=1024, seed=None, quantize=False, script=True):
+        '''
+        :param vp: VPoser model
+        :param batch_size: number of poses decoded at once, small enough for the activations to stay in cache
+        :param seed: seed of the default stream, None for a random one
+        :param quantize: decode with int8 weights, see quantization_report for its accuracy and speed
+        :param script: decode with the scripted and frozen module
+        '''
+        decoder = VPoserDecodeAA(vp)
+        if quantize:
+            decoder = quantize_decoder(decoder)
+        self.decoder = export_inference_module(decoder) if script else decoder.eval()
+
+        some_weight = [a for a in vp.parameters()][0]
+        self.device = some_weight.device
+        self.dtype = some_weight.dtype
+        self.latentD = vp.latentD
+        self.num_joints = vp.num_joints
+        self.batch_size = batch_size
+        self.generator = self.new_stream(seed)
+        # per stream, the buffer of the last drawn batch of latent codes and the number of them already decoded
+        self._codes = weakref.WeakKeyDictionary()
+
+    def new_stream(self, seed=None):
+        '''
+        :return: torch.Generator for sample or stream, seeded for reproducible independent streams
+        '''
+        generator = torch.Generator(device=self.device)
+        if seed is None:
+            generator.seed()
+        else:
+            generator.manual_seed(seed)
+        return generator
+
+    def stream(self, num_poses=None, generator=None):
+        '''
+        Yield batches of at most batch_size poses, a batch is shorter at the end of num_poses and where the codes
+        left over by an earlier call run out. Every batch is a view of one reused buffer, copy what is kept beyond
+        the next iteration.
+
+        :param num_poses: total number of poses, None for an endless stream
+        :param generator: stream to draw from, the default stream of the sampler by default
+        :return: iterator of Bx21x3 axis-angle body poses
+        '''
+        generator = self.generator if generator is None else generator
+        pose_body = torch.empty([self.batch_size, self.num_joints, 3], dtype=self.dtype, device=self.device)
+        done = 0
+        codes = self._codes.get(generator)
+        if codes is None:
+            codes = [torch.empty([self.batch_size, self.latentD], dtype=self.dtype, device=self.device), self.batch_size]
+            self._codes[generator] = codes
+        while num_poses is None or done < num_poses:
+            Zgen, used = codes
+            # no_grad only around the sampling, not around the yield, so the caller's loop keeps its grad mode
+            with torch.no_grad():
+                if used == self.batch_size:
+                    torch.randn([self.batch_size, self.latentD], generator=generator, out=Zgen)
+                    used = 0
+                bs = self.batch_size - used if num_poses is None else min(self.batch_size - used, num_poses - done)
+                pose_body[:bs].copy_(self.decoder(Zgen[used:used + bs]))
+            codes[1] = used + bs
+            done += bs
+            yield pose_body[:bs]
+
+    def sample(self, num_poses, generator=None, out=None):
+        '''
+        :param num_poses: number of poses
+        :param generator: stream to draw from, the default stream of the sampler by default
+        :param out: optional preallocated num_posesx21x3 tensor to write into
+        :return: num_posesx21x3 axis-angle body poses
+        '''
+        if out is None:
+            out = torch.empty([num_poses, self.num_joints, 3], dtype=self.dtype, device=self.device)
+        start = 0
+        for pose_body in self.stream(num_poses, generator):
+            out[start:start + len(pose_body)] = pose_body
+            start += len(pose_body)
+        return out
+
+
+def quantization_report(vp, num_poses=65536, batch_size=1024, seed=100):
+    '''
+    Decode the same latent codes with the float and the int8 VPoserSampler.
+
+    :return: dictionary with the poses per second of both, and the geodesic angle in degrees between their joint
+             rotations as mean, 99th percentile and max
+    '''
+    import time
+
+    poses = {}
+    report = {}
+    for quantize in (False, True):
+        sampler = VPoserSampler(vp, batch_size=batch_size, seed=seed, quantize=quantize)
+        sampler.sample(batch_size)
+        start = time.perf_counter()
+        poses[quantize] = sampler.sample(num_poses, generator=sampler.new_stream(seed))
+        report['int8_poses_per_sec' if quantize else 'fp32_poses_per_sec'] = num_poses / (time.perf_counter() - start)
+
+    R_fp32 = rodrigues(poses[False].view(-1, 3))
+    R_int8 = rodrigues(poses[True].view(-1, 3))
+    cos = ((torch.matmul(R_fp32.transpose(1, 2), R_int8).diagonal(dim1=1, dim2=2).sum(-1) - 1) / 2).clamp(-1, 1)
+    angle = torch.rad2deg(torch.acos(cos))
+    report.update({'angle_mean_deg': float(angle.mean()), 'angle_p99_deg': float(torch.quantile(angle[:2 ** 24], 0.99)),
+                   'angle_max_deg': float(angle.max())})
+    return report
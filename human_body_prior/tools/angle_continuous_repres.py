@@ -59,12 +59,9 @@ class geodesic_loss_R(nn.Module):
 
     # batch geodesic loss for rotation matrices
     def bgdR(self,m1,m2):
-        batch = m1.shape[0]
-        m = torch.bmm(m1, m2.transpose(1, 2))  # batch*3*3
-
-        cos = (m[:, 0, 0] + m[:, 1, 1] + m[:, 2, 2] - 1) / 2
-        cos = torch.min(cos, m1.new(np.ones(batch)))
-        cos = torch.max(cos, m1.new(np.ones(batch)) * -1)
+        # trace(m1 m2^T) is the elementwise product summed, without the full batch*3*3 product
+        cos = ((m1 * m2).sum(dim=(1, 2)) - 1) / 2
+        cos = cos.clamp(-1, 1)
 
         return torch.acos(cos)
 
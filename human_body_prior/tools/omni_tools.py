@@ -118,38 +118,19 @@ def matrot2axisangle(matrots):
     :param matrots: N*T*num_joints*9
     :return: N*T*num_joints*3
     '''
-    import cv2
-    N = matrots.shape[0]
-    T = matrots.shape[1]
-    n_joints = matrots.shape[2]
-    out_axisangle = []
-    for tIdx in range(T):
-        T_axisangle = []
-        for mIdx in range(N):
-            cur_axisangle = []
-            for jIdx in range(n_joints):
-                cur_axisangle.append(cv2.Rodrigues(matrots[mIdx, tIdx, jIdx:jIdx + 1, :].reshape(3, 3))[0].T)
-            T_axisangle.append(np.vstack(cur_axisangle)[np.newaxis])
-        out_axisangle.append(np.vstack(T_axisangle).reshape([N,1, -1,3]))
-    return np.concatenate(out_axisangle, axis=1)
+    from human_body_prior.tools.rotation_tools import matrot2aa_np
+    matrots = np.asarray(matrots)
+    return matrot2aa_np(matrots.reshape(matrots.shape[:3] + (3, 3)))
 
 def axisangle2matrots(axisangle):
     '''
-    :param matrots: N*1*num_joints*3
-    :return: N*num_joints*9
+    :param axisangle: N*1*num_joints*3
+    :return: N*1*num_joints*9
     '''
-    import cv2
+    from human_body_prior.tools.rotation_tools import aa2matrot_np
     batch_size = axisangle.shape[0]
-    axisangle = axisangle.reshape([batch_size,1,-1,3])
-    out_matrot = []
-    for mIdx in range(axisangle.shape[0]):
-        cur_axisangle = []
-        for jIdx in range(axisangle.shape[2]):
-            a = cv2.Rodrigues(axisangle[mIdx, 0, jIdx:jIdx + 1, :].reshape(1, 3))[0].T
-            cur_axisangle.append(a)
-
-        out_matrot.append(np.array(cur_axisangle).reshape([batch_size,1,-1,9]))
-    return np.vstack(out_matrot)
+    axisangle = np.asarray(axisangle).reshape([batch_size, 1, -1, 3])
+    return aa2matrot_np(axisangle).reshape([batch_size, 1, -1, 9])
 
 
 def apply_mesh_tranfsormations_(meshes, transf):
@@ -22,23 +22,51 @@
 # 2020.12.12
 import numpy as np
 
-from torch.nn import functional as F
-from human_body_prior.tools import tgm_conversion as tgm
 import torch
 
 def local2global_pose(local_pose, kintree):
+    '''
+    Chain local joint rotations to global ones, one kinematic tree level at a time.
+
+    :param local_pose: bsxnum_jointsx3x3 or bsx(num_joints*9) local rotation matrices
+    :param kintree: parent index per joint, negative for the roots
+    :return: bsxnum_jointsx3x3 global rotation matrices
+    '''
     bs = local_pose.shape[0]
 
-    local_pose = local_pose.view(bs, -1, 3, 3)
+    # joints first, so a level gathers and scatters whole bsx3x3 blocks
+    local_pose = local_pose.view(bs, -1, 3, 3).transpose(0, 1)
+
+    global_pose = local_pose.clone(memory_format=torch.contiguous_format)
 
-    global_pose = local_pose.clone()
+    for joints, parents in kintree_levels(kintree):
+        joints = torch.tensor(joints, device=local_pose.device)
+        parents = torch.tensor(parents, device=local_pose.device)
+        global_pose.index_copy_(0, joints, torch.matmul(global_pose.index_select(0, parents),
+                                                        local_pose.index_select(0, joints)))
+
+    return global_pose.transpose(0, 1).contiguous()
+
+def kintree_levels(kintree):
+    '''
+    :param kintree: parent index per joint, negative for the roots
+    :return: list of (joints, parents) index lists per tree level below the roots, parents before children
+    '''
+    parents = [int(p) for p in kintree]
+    depth = [None] * len(parents)
 
-    for jId in range(len(kintree)):
-        parent_id = kintree[jId]
-        if parent_id >= 0:
-            global_pose[:, jId] = torch.matmul(global_pose[:, parent_id], global_pose[:, jId])
+    def joint_depth(jId):
+        if depth[jId] is None:
+            depth[jId] = 0 if parents[jId] < 0 else joint_depth(parents[jId]) + 1
+        return depth[jId]
 
-    return global_pose
+    for jId in range(len(parents)):
+        joint_depth(jId)
+    levels = []
+    for d in range(1, max(depth, default=0) + 1):
+        joints = [jId for jId in range(len(parents)) if depth[jId] == d]
+        levels.append((joints, [parents[jId] for jId in joints]))
+    return levels
 
 def em2euler(em):
     '''
@@ -70,82 +98,199 @@ def remove_zrot(pose):
     pose[:3] = euler2em(noZ).copy()
     return pose
 
-def matrot2aa(pose_matrot):
+# Closed form conversions between axis-angle (...x3), quaternions with the real part first (...x4),
+# rotation matrices (...x3x3) and the continuous 6D representation (...x6, the first two matrix columns).
+# They take any leading shape, have no data dependent branches and compile with torch.jit.script.
+# The _np variants run the same kernels on numpy arrays and keep their dtype.
+
+def aa2quat(aa: torch.Tensor, eps: float = 1e-6) -> torch.Tensor:
     '''
-    :param pose_matrot: Nx3x3
-    :return: Nx3
+    :param aa: ...x3 axis-angle rotations
+    :return: ...x4 unit quaternions
     '''
-    bs = pose_matrot.size(0)
-    homogen_matrot = F.pad(pose_matrot, [0,1])
-    pose = tgm.rotation_matrix_to_angle_axis(homogen_matrot)
-    return pose
+    angle = torch.norm(aa, dim=-1, keepdim=True)
+    small = angle < eps
+    # sin(angle / 2) / angle, with its Taylor expansion where the division is ill conditioned
+    safe_angle = torch.where(small, torch.ones_like(angle), angle)
+    scale = torch.where(small, 0.5 - angle * angle / 48., torch.sin(0.5 * safe_angle) / safe_angle)
+    return torch.cat([torch.cos(0.5 * angle), aa * scale], dim=-1)
+
+
+def quat2aa(quat: torch.Tensor, eps: float = 1e-6) -> torch.Tensor:
+    '''
+    :param quat: ...x4 quaternions, need not be normalized
+    :return: ...x3 axis-angle rotations with angles in [0, pi]
+    '''
+    quat = torch.where(quat[..., :1] < 0, -quat, quat)
+    w, xyz = quat[..., :1], quat[..., 1:]
+    sin_half = torch.norm(xyz, dim=-1, keepdim=True)
+    small = sin_half < eps
+    # angle / sin(angle / 2), which tends to 2 / w for small angles
+    safe_sin_half = torch.where(small, torch.ones_like(sin_half), sin_half)
+    scale = torch.where(small, 2. / w.clamp_min(eps), 2. * torch.atan2(safe_sin_half, w) / safe_sin_half)
+    return xyz * scale
+
+
+def quat2matrot(quat: torch.Tensor) -> torch.Tensor:
+    '''
+    :param quat: ...x4 quaternions, need not be normalized
+    :return: ...x3x3 rotation matrices
+    '''
+    r, i, j, k = torch.unbind(quat, -1)
+    two_s = 2.0 / (quat * quat).sum(-1)
+
+    o = torch.stack(
+        (
+            1 - two_s * (j * j + k * k),
+            two_s * (i * j - k * r),
+            two_s * (i * k + j * r),
+            two_s * (i * j + k * r),
+            1 - two_s * (i * i + k * k),
+            two_s * (j * k - i * r),
+            two_s * (i * k - j * r),
+            two_s * (j * k + i * r),
+            1 - two_s * (i * i + j * j),
+        ),
+        -1,
+    )
+    return o.reshape(list(quat.shape[:-1]) + [3, 3])
+
+
+def matrot2quat(matrot: torch.Tensor, eps: float = 1e-8) -> torch.Tensor:
+    '''
+    Shepperd's method: the quaternion is computed from its largest component, picked per rotation with a gather.
+
+    :param matrot: ...x3x3 rotation matrices
+    :return: ...x4 unit quaternions with a non negative real part
+    '''
+    m = matrot.reshape(-1, 9)
+    m00, m01, m02 = m[:, 0], m[:, 1], m[:, 2]
+    m10, m11, m12 = m[:, 3], m[:, 4], m[:, 5]
+    m20, m21, m22 = m[:, 6], m[:, 7], m[:, 8]
+
+    # 4 * q_k^2 for each component, and the four candidates scaled by 4 * |q_k|
+    t = torch.stack([1 + m00 + m11 + m22, 1 + m00 - m11 - m22, 1 - m00 + m11 - m22, 1 - m00 - m11 + m22], dim=1)
+    candidates = torch.stack([
+        torch.stack([t[:, 0], m21 - m12, m02 - m20, m10 - m01], dim=1),
+        torch.stack([m21 - m12, t[:, 1], m10 + m01, m02 + m20], dim=1),
+        torch.stack([m02 - m20, m10 + m01, t[:, 2], m21 + m12], dim=1),
+        torch.stack([m10 - m01, m02 + m20, m21 + m12, t[:, 3]], dim=1),
+    ], dim=1)
+    best = torch.argmax(t, dim=1)
+    quat = candidates.gather(1, best.view(-1, 1, 1).expand(-1, 1, 4)).squeeze(1)
+    quat = quat / (2 * torch.sqrt(t.gather(1, best.view(-1, 1)).clamp_min(eps)))
+    quat = torch.where(quat[:, :1] < 0, -quat, quat)
+    return quat.reshape(list(matrot.shape[:-2]) + [4])
+
+
+def matrot2aa(pose_matrot: torch.Tensor) -> torch.Tensor:
+    '''
+    :param pose_matrot: ...x3x3
+    :return: ...x3
+    '''
+    return quat2aa(matrot2quat(pose_matrot))
+
+
+def aa2matrot(pose: torch.Tensor) -> torch.Tensor:
+    '''
+    :param pose: ...x3
+    :return: pose_matrot: ...x3x3
+    '''
+    return quat2matrot(aa2quat(pose))
+
+
+def cont6d2matrot(cont6d: torch.Tensor) -> torch.Tensor:
+    '''
+    :param cont6d: ...x6, the first two columns of the rotation matrix before orthonormalization
+    :return: ...x3x3 rotation matrices
+    '''
+    x_raw = cont6d[..., 0:3]
+    y_raw = cont6d[..., 3:6]
+
+    x = x_raw / torch.norm(x_raw, dim=-1, keepdim=True)
+    z = torch.cross(x, y_raw, dim=-1)
+    z = z / torch.norm(z, dim=-1, keepdim=True)
+    y = torch.cross(z, x, dim=-1)
+
+    return torch.stack([x, y, z], dim=-1)
 
-def aa2matrot(pose):
+
+def matrot2cont6d(matrot: torch.Tensor) -> torch.Tensor:
     '''
-    :param Nx3
-    :return: pose_matrot: Nx3x3
+    :param matrot: ...x3x3 rotation matrices
+    :return: ...x6
     '''
-    bs = pose.size(0)
-    num_joints = pose.size(1)//3
-    pose_body_matrot = tgm.angle_axis_to_rotation_matrix(pose)[:, :3, :3].contiguous()#.view(bs, num_joints*9)
-    return pose_body_matrot
+    return torch.cat([matrot[..., 0], matrot[..., 1]], dim=-1)
+
+
+def _on_numpy(fn, array):
+    return fn(torch.from_numpy(np.ascontiguousarray(array))).numpy()
 
-def noisy_zrot(rot_in):
+
+def aa2quat_np(aa):
+    return _on_numpy(aa2quat, aa)
+
+def quat2aa_np(quat):
+    return _on_numpy(quat2aa, quat)
+
+def quat2matrot_np(quat):
+    return _on_numpy(quat2matrot, quat)
+
+def matrot2quat_np(matrot):
+    return _on_numpy(matrot2quat, matrot)
+
+def matrot2aa_np(pose_matrot):
+    return _on_numpy(matrot2aa, pose_matrot)
+
+def aa2matrot_np(pose):
+    return _on_numpy(aa2matrot, pose)
+
+def cont6d2matrot_np(cont6d):
+    return _on_numpy(cont6d2matrot, cont6d)
+
+def matrot2cont6d_np(matrot):
+    return _on_numpy(matrot2cont6d, matrot)
+
+
+def noisy_zrot(rot_in, per_sample=False):
     '''
 
     :param rot_in: np.array Nx3 rotations in axis-angle representation
+    :param per_sample: draw a z rotation per rotation instead of one for the whole batch
     :return:
-        will add a degree from a full circle to the zrotations
+        will add a degree from a full circle to the zrotations, as a rotation about the global z axis
     '''
     is_batched = False
     if rot_in.ndim == 2: is_batched = True
     if not is_batched:
         rot_in = rot_in[np.newaxis]
 
-    rnd_zrot = np.random.uniform(-np.pi, np.pi)
-    rot_out = []
-    for bId in range(len(rot_in)):
-        pose_cpu = rot_in[bId]
-        pose_euler = em2euler(pose_cpu)
-
-        pose_euler[2] += rnd_zrot
+    rnd_zrot = np.random.uniform(-np.pi, np.pi, size=len(rot_in) if per_sample else None)
+    # adding to the static z euler angle is a left multiplication with a rotation about z
+    zrot = np.zeros([len(rot_in), 3])
+    zrot[:, 2] = rnd_zrot
 
-        pose_aa = euler2em(pose_euler)
-        rot_out.append(pose_aa.copy())
-
-    return np.array(rot_out)
+    return matrot2aa_np(np.matmul(aa2matrot_np(zrot), aa2matrot_np(np.asarray(rot_in, dtype=np.float64))))
 
 def rotate_points_xyz(mesh_v, Rxyz):
     '''
 
     :param mesh_v: Nxnum_vx3
-    :param Rxyz: Nx3
-    :return:
+    :param Rxyz: Nx3 rotation angles in degrees, applied about x, then y, then z
+    :return: Nxnum_vx3
     '''
+    angles = np.radians(np.asarray(Rxyz, dtype=np.float64))
+    cos, sin = np.cos(angles), np.sin(angles)
+    ones, zeros = np.ones(len(angles)), np.zeros(len(angles))
+
+    rx = np.stack([ones, zeros, zeros,
+                   zeros, cos[:, 0], -sin[:, 0],
+                   zeros, sin[:, 0], cos[:, 0]], axis=-1).reshape(-1, 3, 3)
+    ry = np.stack([cos[:, 1], zeros, sin[:, 1],
+                   zeros, ones, zeros,
+                   -sin[:, 1], zeros, cos[:, 1]], axis=-1).reshape(-1, 3, 3)
+    rz = np.stack([cos[:, 2], -sin[:, 2], zeros,
+                   sin[:, 2], cos[:, 2], zeros,
+                   zeros, zeros, ones], axis=-1).reshape(-1, 3, 3)
 
-    mesh_v_rotated = []
-
-    for fId in range(mesh_v.shape[0]):
-        angle = np.radians(Rxyz[fId, 0])
-        rx = np.array([
-            [1., 0., 0.           ],
-            [0., np.cos(angle), -np.sin(angle)],
-            [0., np.sin(angle), np.cos(angle) ]
-        ])
-
-        angle = np.radians(Rxyz[fId, 1])
-        ry = np.array([
-            [np.cos(angle), 0., np.sin(angle)],
-            [0., 1., 0.           ],
-            [-np.sin(angle), 0., np.cos(angle)]
-        ])
-
-        angle = np.radians(Rxyz[fId, 2])
-        rz = np.array([
-            [np.cos(angle), -np.sin(angle), 0. ],
-            [np.sin(angle), np.cos(angle), 0. ],
-            [0., 0., 1. ]
-        ])
-        mesh_v_rotated.append(rz.dot(ry.dot(rx.dot(mesh_v[fId].T))).T)
-
-    return np.array(mesh_v_rotated)
\ No newline at end of file
+    return np.matmul(mesh_v, np.matmul(rz, np.matmul(ry, rx)).transpose(0, 2, 1))
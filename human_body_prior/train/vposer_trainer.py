@@ -109,7 +109,8 @@ class VPoserTrainer(LightningModule):
         split_name = split_name.replace('vald', 'vald')
 
         assert dataset_exists(self.dataset_dir), FileNotFoundError('Dataset does not exist dataset_dir = {}'.format(self.dataset_dir))
-        dataset = VPoserDS(osp.join(self.dataset_dir, split_name), data_fields = ['pose_body'])
+        dataset = VPoserDS(osp.join(self.dataset_dir, split_name), data_fields = ['pose_body'],
+                           memmap=self.vp_ps.data_parms.get('memmap_dataset', False))
 
         assert len(dataset) != 0, ValueError('Dataset has nothing in it!')
 
@@ -0,0 +1,247 @@
+"""
+Clip-level motion descriptors and a nearest-neighbour index over new_joint_vecs.
+
+Every clip is summarised by one unit-length vector that joins two parts:
+    - pooled statistics, the per-feature mean and standard deviation over time
+      of the features normalized with the dataset Mean.npy / Std.npy
+    - a trajectory signature, the root path resampled to a fixed number of
+      points, recovered from either root convention of build_vector
+      (absolute angle and position, or velocities), see ROOT_CONVENTIONS
+Both parts are normalized on their own and weighted so that the cosine
+similarity of two descriptors is POOLED_WEIGHT times the similarity of their
+statistics plus TRAJECTORY_WEIGHT times the similarity of their paths.
+
+The index is exact: all descriptors are kept in one float32 matrix saved as
+.npz, and a top-k query is a single matrix-vector product.
+"""
+
+import csv
+import os
+from multiprocessing import Pool
+from os.path import join as pjoin
+
+import numpy as np
+
+import build_vector
+
+POOLED_WEIGHT = 0.7
+TRAJECTORY_WEIGHT = 0.3
+NUM_TRAJECTORY_POINTS = 16
+EPS = 1e-8
+
+
+def root_trajectory(vec: np.ndarray, root: str='auto') -> np.ndarray:
+    """
+    Root positions of a clip. Features with the 'abs' root convention are converted with
+    build_vector.relative_root first, then the velocities are integrated as recover_root_rot_pos does.
+
+    :param vec:     feature array of shape (seq_len, dim)
+    :param root:    root convention of vec, one of build_vector.ROOT_CONVENTIONS
+    :return r_pos:  root positions of shape (seq_len, 3)
+    """
+    vec = build_vector.relative_root(vec, root)
+    r_rot_ang = np.zeros(len(vec))
+    r_rot_ang[1:] = vec[:-1, 0]
+    r_rot_ang = np.cumsum(r_rot_ang)
+
+    '''Rotate the local XZ velocities by the inverse root rotation, a turn of -2 * angle around Y'''
+    vel_x = np.zeros(len(vec))
+    vel_z = np.zeros(len(vec))
+    vel_x[1:], vel_z[1:] = vec[:-1, 1], vec[:-1, 2]
+    cos, sin = np.cos(2 * r_rot_ang), np.sin(2 * r_rot_ang)
+    r_pos = np.zeros((len(vec), 3))
+    r_pos[:, 0] = np.cumsum(cos * vel_x - sin * vel_z)
+    r_pos[:, 2] = np.cumsum(sin * vel_x + cos * vel_z)
+    r_pos[:, 1] = vec[:, 3]
+    return r_pos
+
+
+def descriptor(vec: np.ndarray, mean: np.ndarray, std: np.ndarray, num_points: int=NUM_TRAJECTORY_POINTS,
+               root: str='auto') -> np.ndarray:
+    """
+    :param vec:         feature array of shape (seq_len, dim)
+    :param mean:        dataset mean of shape (dim,)
+    :param std:         dataset standard deviation of shape (dim,)
+    :param num_points:  number of points of the trajectory signature
+    :param root:        root convention of vec, one of build_vector.ROOT_CONVENTIONS
+    :return desc:       float32 unit vector of shape (2 * dim + 3 * num_points,)
+    """
+    norm_vec = (vec - mean) / std
+    pooled = np.concatenate([norm_vec.mean(axis=0), norm_vec.std(axis=0)])
+    pooled = pooled / (np.linalg.norm(pooled) + EPS)
+
+    r_pos = root_trajectory(vec, root)
+    t = np.linspace(0, 1, len(r_pos)) if len(r_pos) > 1 else np.zeros(1)
+    samples = np.linspace(0, 1, num_points)
+    trajectory = np.stack([np.interp(samples, t, r_pos[:, i]) for i in range(3)], axis=-1).reshape(-1)
+    trajectory = trajectory / (np.linalg.norm(trajectory) + EPS)
+
+    desc = np.concatenate([np.sqrt(POOLED_WEIGHT) * pooled, np.sqrt(TRAJECTORY_WEIGHT) * trajectory])
+    return desc.astype(np.float32)
+
+
+def mirror_name(name: str) -> str:
+    """
+    :param name:    clip name, e.g. 000021 or M000021
+    :return name:   name of its mirrored copy written by raw_pose_processing.ipynb
+    """
+    return name[1:] if name.startswith('M') else 'M' + name
+
+
+def _clip_descriptor(args):
+    path, mean, std, num_points, root = args
+    vec = np.load(path)
+    if len(vec) == 0 or np.isnan(vec).any():
+        return None
+    return descriptor(vec, mean, std, num_points, root)
+
+
+class MotionIndex:
+    """
+    Exact nearest-neighbour index over clip descriptors, compared by cosine similarity.
+    """
+
+    def __init__(self, names: list[str], descriptors: np.ndarray, num_points: int=NUM_TRAJECTORY_POINTS):
+        """
+        :param names:       list of clip names
+        :param descriptors: float32 array of shape (num_clips, desc_dim) of unit vectors
+        :param num_points:  number of trajectory points the descriptors were built with
+        """
+        self.names = list(names)
+        self.descriptors = np.ascontiguousarray(descriptors, dtype=np.float32)
+        self.num_points = num_points
+        self.positions = {name: i for (i, name) in enumerate(self.names)}
+
+    @classmethod
+    def build(cls, vec_dir: str, mean: np.ndarray, std: np.ndarray, num_points: int=NUM_TRAJECTORY_POINTS,
+              num_workers: int=None, root: str='auto') -> 'MotionIndex':
+        """
+        Compute the descriptors of every .npy clip of a directory, skipping empty clips and clips with NaNs.
+
+        :param vec_dir:     string path to the feature vectors, e.g. ./HumanML3D/new_joint_vecs/
+        :param mean:        dataset mean of shape (dim,)
+        :param std:         dataset standard deviation of shape (dim,)
+        :param num_points:  number of points of the trajectory signature
+        :param num_workers: number of processes, defaults to the number of cpus
+        :param root:        root convention of the clips, one of build_vector.ROOT_CONVENTIONS,
+                            'auto' uses the one recorded in vec_dir and only detects it per clip when there is none
+        """
+        from tqdm import tqdm
+
+        root = build_vector.read_root_convention(vec_dir, root)
+        npy_files = sorted(f for f in os.listdir(vec_dir) if f.endswith('.npy'))
+        jobs = [(pjoin(vec_dir, f), mean, std, num_points, root) for f in npy_files]
+        names, descriptors = [], []
+        with Pool(num_workers) as pool:
+            for (npy_file, desc) in zip(npy_files, tqdm(pool.imap(_clip_descriptor, jobs, chunksize=64), total=len(jobs))):
+                if desc is None:
+                    print(f"Skipping {npy_file}")
+                    continue
+                names.append(npy_file[:-4])
+                descriptors.append(desc)
+        return cls(names, np.stack(descriptors), num_points)
+
+    def save(self, index_file: str):
+        np.savez(index_file, names=np.array(self.names), descriptors=self.descriptors, num_points=self.num_points)
+
+    @classmethod
+    def load(cls, index_file: str) -> 'MotionIndex':
+        data = np.load(index_file)
+        return cls(data['names'].tolist(), data['descriptors'], int(data['num_points']))
+
+    def query(self, desc: np.ndarray, k: int=10, exclude: str=None) -> list[tuple[str, float]]:
+        """
+        :param desc:    descriptor of shape (desc_dim,)
+        :param k:       number of neighbours
+        :param exclude: optional clip name left out of the results, e.g. the query clip itself
+        :return result: list of (clip name, cosine similarity), most similar first
+        """
+        sims = self.descriptors @ desc.astype(np.float32)
+        if exclude is not None and exclude in self.positions:
+            sims[self.positions[exclude]] = -np.inf
+        k = min(k, len(sims))
+        top = np.argpartition(-sims, k - 1)[:k]
+        top = top[np.argsort(-sims[top])]
+        return [(self.names[i], float(sims[i])) for i in top if np.isfinite(sims[i])]
+
+    def query_clip(self, name: str, k: int=10) -> list[tuple[str, float]]:
+        """
+        :param name:    name of an indexed clip
+        :param k:       number of neighbours, the clip itself excluded
+        """
+        return self.query(self.descriptors[self.positions[name]], k, exclude=name)
+
+    def near_duplicates(self, threshold: float=0.98, include_mirrored: bool=False,
+                        block_size: int=1024) -> list[tuple[str, str, float]]:
+        """
+        Find all pairs of clips whose similarity reaches a threshold, comparing blocks of clips at a time.
+
+        Every clip X has a mirrored copy MX, and any duplicate pair (A, B) repeats as (MA, MB).
+        Unless include_mirrored is set, mirrored copies are therefore left out of the comparison.
+
+        :param threshold:           minimum cosine similarity
+        :param include_mirrored:    compare the M copies too
+        :param block_size:          number of clips compared against all others at a time
+        :return pairs:              list of (clip a, clip b, similarity), most similar first
+        """
+        keep = np.array([include_mirrored or not name.startswith('M') for name in self.names])
+        ids = np.nonzero(keep)[0]
+        descriptors = self.descriptors[ids]
+        pairs = []
+        for start in range(0, len(ids), block_size):
+            sims = descriptors[start:start + block_size] @ descriptors.T
+            rows, cols = np.nonzero(sims >= threshold)
+            rows = rows + start
+            upper = cols > rows
+            for (i, j) in zip(rows[upper], cols[upper]):
+                pairs.append((self.names[ids[i]], self.names[ids[j]], float(sims[i - start, j])))
+        pairs.sort(key=lambda pair: -pair[2])
+        return pairs
+
+
+def write_dedup_report(index: MotionIndex, report_file: str, threshold: float=0.98, include_mirrored: bool=False,
+                       index_csv: str=None) -> int:
+    """
+    Write the near-duplicate pairs of an index as CSV.
+
+    :param index:               MotionIndex to search
+    :param report_file:         string path to the output CSV file
+    :param threshold:           minimum cosine similarity
+    :param include_mirrored:    compare the M copies too
+    :param index_csv:           optional path to index.csv, adds the AMASS / KIT / humanact12 source of each clip
+    :return num_pairs:          number of pairs written
+    """
+    sources = {}
+    if index_csv is not None:
+        with open(index_csv) as f:
+            for row in csv.DictReader(f):
+                sources[row['new_name'][:-4]] = row['source_path']
+
+    pairs = index.near_duplicates(threshold, include_mirrored)
+    with open(report_file, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['clip_a', 'clip_b', 'similarity', 'kind', 'source_a', 'source_b'])
+        for (a, b, sim) in pairs:
+            kind = 'mirror' if mirror_name(a) == b else 'duplicate'
+            writer.writerow([a, b, '%.5f' % sim, kind,
+                             sources.get(a.lstrip('M'), ''), sources.get(b.lstrip('M'), '')])
+    return len(pairs)
+
+
+if __name__ == "__main__":
+    data_dir = './HumanML3D/'
+    # 'abs' for build_vector.py / amass_pipeline.py features, 'rel' for rel_motion_representation.ipynb ones,
+    # 'auto' reads build_vector.ROOT_CONVENTION_FILE next to the features
+    root = 'auto'
+    index_file = pjoin(data_dir, 'motion_index.npz')
+
+    if os.path.exists(index_file):
+        index = MotionIndex.load(index_file)
+    else:
+        mean = np.load(pjoin(data_dir, 'Mean.npy'))
+        std = np.load(pjoin(data_dir, 'Std.npy'))
+        index = MotionIndex.build(pjoin(data_dir, 'new_joint_vecs'), mean, std, root=root)
+        index.save(index_file)
+
+    num_pairs = write_dedup_report(index, pjoin(data_dir, 'dedup_report.csv'), index_csv='./index.csv')
+    print(f"{len(index.names)} clips indexed, {num_pairs} near-duplicate pairs")
@@ -0,0 +1,261 @@
+"""
+Per-clip motion quality metrics over new_joints / new_joint_vecs, for filtering training splits.
+
+Every clip is read once and all metrics are computed from its two arrays:
+    skate       horizontal speed of the feet while the foot contact channels of
+                the features mark them in contact, as a mean speed in m/s and
+                the share of contact frames faster than SKATE_SPEED
+    penetration depth of the lowest joint below the floor at y = 0, as a max in
+                meters and the share of frames deeper than PENETRATION_DEPTH
+    jitter      energy of the third derivative of the joint positions, the mean
+                squared jerk in m^2/s^6, and the max jerk in m/s^3
+    bone        standard deviation over time of every bone length, from
+                Skeleton.get_offsets_joints_batch, as a mean and max in meters
+    ric         error of recover_from_ric on the features against new_joints,
+                as a mean and max joint distance in meters, after converting
+                absolute root channels with build_vector.relative_root, by the
+                convention recorded next to the features when there is one
+The clips are spread over a worker pool and the metrics are gathered into one
+table with a column per metric, written as .npz, .csv or .parquet (pandas).
+Clips that fail have NaN metrics and the exception in the error column.
+
+    python motion_quality.py --data_dir ./HumanML3D/ --output ./HumanML3D/motion_quality.npz
+    python motion_quality.py --table ./HumanML3D/motion_quality.npz --split ./HumanML3D/train.txt \\
+        --filtered ./HumanML3D/train_clean.txt --max skate_ratio=0.3
+"""
+
+import argparse
+import os
+from multiprocessing import Pool
+from os.path import join as pjoin
+
+import numpy as np
+
+import build_vector
+from common.lazy_import import lazy_import
+
+torch = lazy_import('torch')
+
+FPS = 20
+SKATE_SPEED = 0.2           # m/s, 1 cm per frame at 20 fps
+PENETRATION_DEPTH = 0.01    # m
+
+METRICS = ['frames', 'contact_ratio', 'skate_speed', 'skate_ratio', 'penetration_max', 'penetration_ratio',
+           'jitter', 'jerk_max', 'bone_std_mean', 'bone_std_max', 'ric_error_mean', 'ric_error_max']
+
+# largest accepted value per metric, metrics left out are not filtered on. The foot contact channels mark
+# feet that move less than sqrt(feet_thre) per frame, so skating is bounded by construction and is only
+# filtered on when asked for, e.g. --max skate_ratio=0.3
+THRESHOLDS = {
+    'penetration_max': 0.05,
+    'bone_std_max': 0.02,
+    'ric_error_max': 1e-3,
+}
+
+
+def clip_metrics(joints: np.ndarray, vec: np.ndarray, skel, fps: int=FPS, root: str='auto') -> dict:
+    """
+    Metrics of one clip, set_rig must be called first.
+
+    :param joints:  new_joints array of shape (seq_len, joints_num, 3)
+    :param vec:     new_joint_vecs array of shape (seq_len, dim), the last 4 channels are the foot contacts
+    :param skel:    common.skeleton.Skeleton of the rig
+    :param fps:     frame rate of the clip
+    :param root:    root convention of vec, one of build_vector.ROOT_CONVENTIONS
+    :return result: dictionary with a value per name of METRICS
+    """
+    joints = joints[:, :build_vector.joints_num].astype(np.float64)
+    result = dict.fromkeys(METRICS, np.nan)
+    result['frames'] = len(joints)
+
+    '''Foot skating, foot_detect marks frame t when the foot barely moves to frame t + 1'''
+    feet = build_vector.fid_l + build_vector.fid_r
+    contact = vec[:-1, -4:] > 0.5
+    foot_speed = np.linalg.norm(joints[1:, feet][..., [0, 2]] - joints[:-1, feet][..., [0, 2]], axis=-1) * fps
+    if contact.size:
+        result['contact_ratio'] = contact.mean()
+        result['skate_speed'] = foot_speed[contact].mean() if contact.any() else 0.
+        result['skate_ratio'] = (foot_speed[contact] > SKATE_SPEED).mean() if contact.any() else 0.
+
+    '''Ground penetration below the floor the clips are put on'''
+    depth = np.maximum(-joints[..., 1].min(axis=1), 0)
+    result['penetration_max'] = depth.max()
+    result['penetration_ratio'] = (depth > PENETRATION_DEPTH).mean()
+
+    '''Jitter'''
+    if len(joints) > 3:
+        jerk = np.linalg.norm(np.diff(joints, n=3, axis=0), axis=-1) * fps ** 3
+        result['jitter'] = (jerk ** 2).mean()
+        result['jerk_max'] = jerk.max()
+
+    '''Bone lengths, the raw offsets give the direction of every bone'''
+    offsets = skel.get_offsets_joints_batch(torch.from_numpy(joints).float()).numpy()
+    raw_norm = np.linalg.norm(skel._raw_offset_np[1:], axis=-1)
+    bone_std = (np.linalg.norm(offsets[:, 1:], axis=-1) / raw_norm).std(axis=0)
+    result['bone_std_mean'] = bone_std.mean()
+    result['bone_std_max'] = bone_std.max()
+
+    '''Reconstruction from the rotation invariant positions'''
+    rel_vec = build_vector.relative_root(vec, root)
+    rec_ric = build_vector.recover_from_ric(torch.from_numpy(rel_vec).float(), build_vector.joints_num)
+    error = np.linalg.norm(rec_ric.numpy() - joints, axis=-1)
+    result['ric_error_mean'] = error.mean()
+    result['ric_error_max'] = error.max()
+
+    return {name: float(value) for (name, value) in result.items()}
+
+
+def _init_worker(rig, example_data):
+    global _skel
+    from common.skeleton import Skeleton
+
+    torch.set_num_threads(1)
+    build_vector.set_rig(rig, example_data)
+    _skel = Skeleton(build_vector.n_raw_offsets, build_vector.kinematic_chain, 'cpu')
+
+
+def _clip_metrics(args):
+    name, data_dir, root = args
+    try:
+        joints = np.load(pjoin(data_dir, 'new_joints', name + '.npy'))
+        vec = np.load(pjoin(data_dir, 'new_joint_vecs', name + '.npy'))
+        if len(joints) != len(vec):
+            raise ValueError(f'{len(joints)} frames of joints but {len(vec)} of features')
+        if np.isnan(joints).any() or np.isnan(vec).any():
+            raise ValueError('NaN values')
+        return name, clip_metrics(joints, vec, _skel, root=root), ''
+    except Exception as e:
+        return name, None, str(e)
+
+
+def compute_metrics(data_dir: str, example_data: np.ndarray, rig: dict=build_vector.T2M_RIG, names: list[str]=None,
+                    num_workers: int=None, root: str='auto') -> dict:
+    """
+    :param data_dir:        string path holding new_joints/ and new_joint_vecs/, e.g. ./HumanML3D/
+    :param example_data:    joint positions of the example clip of the rig, e.g. ./joints/000021.npy
+    :param rig:             rig parameters for build_vector.set_rig
+    :param names:           optional list of clip names, all clips of new_joint_vecs/ by default
+    :param num_workers:     number of processes, defaults to the number of cpus
+    :param root:            root convention of the features, one of build_vector.ROOT_CONVENTIONS, 'auto' uses the
+                            one recorded in new_joint_vecs/ and only detects it per clip when there is none
+    :return table:          dictionary of columns, 'name' and 'error' and one float64 array per name of METRICS
+    """
+    from tqdm import tqdm
+
+    root = build_vector.read_root_convention(pjoin(data_dir, 'new_joint_vecs'), root)
+    if names is None:
+        names = sorted(f[:-4] for f in os.listdir(pjoin(data_dir, 'new_joint_vecs')) if f.endswith('.npy'))
+    table = {'name': [], 'error': []}
+    table.update({metric: [] for metric in METRICS})
+    with Pool(num_workers, initializer=_init_worker, initargs=(rig, example_data)) as pool:
+        jobs = [(name, data_dir, root) for name in names]
+        for (name, result, error) in tqdm(pool.imap(_clip_metrics, jobs, chunksize=16), total=len(names)):
+            table['name'].append(name)
+            table['error'].append(error)
+            for metric in METRICS:
+                table[metric].append(np.nan if result is None else result[metric])
+    table['name'] = np.array(table['name'])
+    table['error'] = np.array(table['error'])
+    for metric in METRICS:
+        table[metric] = np.array(table[metric], dtype=np.float64)
+    return table
+
+
+def save_table(table: dict, fname: str):
+    """
+    :param table:   dictionary of columns as returned by compute_metrics
+    :param fname:   .npz, .csv or .parquet file, the last two are written with pandas
+    """
+    if fname.endswith('.npz'):
+        np.savez(fname, **table)
+        return
+    import pandas as pd
+
+    df = pd.DataFrame(table)
+    if fname.endswith('.parquet'):
+        df.to_parquet(fname, index=False)
+    else:
+        df.to_csv(fname, index=False)
+
+
+def load_table(fname: str) -> dict:
+    if fname.endswith('.npz'):
+        data = np.load(fname)
+        return {column: data[column] for column in data.files}
+    import pandas as pd
+
+    if fname.endswith('.parquet'):
+        df = pd.read_parquet(fname)
+    else:
+        # empty errors stay empty strings, empty metrics are NaN
+        df = pd.read_csv(fname, dtype={'name': str, 'error': str}, keep_default_na=False,
+                         na_values={metric: ['', 'nan', 'NaN'] for metric in METRICS})
+    return {column: df[column].to_numpy(dtype=str if column in ('name', 'error') else np.float64)
+            for column in df.columns}
+
+
+def accepted_clips(table: dict, thresholds: dict=THRESHOLDS) -> set[str]:
+    """
+    :param table:       dictionary of columns as returned by compute_metrics
+    :param thresholds:  largest accepted value per metric
+    :return names:      clips without error whose metrics all stay within the thresholds
+    """
+    keep = table['error'] == ''
+    for (metric, threshold) in thresholds.items():
+        keep &= table[metric] <= threshold
+    return set(table['name'][keep].tolist())
+
+
+def filter_split(table: dict, split_file: str, out_file: str, thresholds: dict=THRESHOLDS) -> tuple[int, int]:
+    """
+    Write the clips of a split file, e.g. train.txt, that pass the thresholds. Clips missing from the table are dropped.
+
+    :return counts: number of clips kept and number of clips in the split
+    """
+    accepted = accepted_clips(table, thresholds)
+    with open(split_file) as f:
+        names = [line.strip() for line in f if line.strip()]
+    kept = [name for name in names if name in accepted]
+    with open(out_file, 'w') as f:
+        f.writelines(name + '\n' for name in kept)
+    return len(kept), len(names)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--data_dir', default='./HumanML3D/')
+    parser.add_argument('--joints_dir', default='./joints/', help='holds the example clip of the rig')
+    parser.add_argument('--rig', choices=['t2m', 'custom'], default='t2m')
+    parser.add_argument('--num_workers', type=int, default=None)
+    parser.add_argument('--root', choices=build_vector.ROOT_CONVENTIONS, default='auto',
+                        help="root channels of new_joint_vecs, 'abs' as build_vector.py writes them, "
+                             "'rel' as rel_motion_representation.ipynb does, 'auto' for the one recorded in new_joint_vecs, "
+                             "detected per clip when there is none")
+    parser.add_argument('--output', default=None, help='.npz, .csv or .parquet table, motion_quality.npz in data_dir')
+    parser.add_argument('--table', default=None, help='existing table to filter with instead of computing one')
+    parser.add_argument('--split', default=None, help='split file to filter, e.g. train.txt')
+    parser.add_argument('--filtered', default=None, help='path to write the filtered split to')
+    parser.add_argument('--max', nargs='+', default=[], metavar='METRIC=VALUE',
+                        help='thresholds added to or replacing THRESHOLDS, e.g. skate_ratio=0.3 jitter=inf')
+    args = parser.parse_args()
+
+    if args.table is not None:
+        table = load_table(args.table)
+    else:
+        rig = build_vector.T2M_RIG if args.rig == 't2m' else build_vector.CUSTOM_RIG
+        example_data = np.load(pjoin(args.joints_dir, rig['example_id'] + '.npy'))
+        table = compute_metrics(args.data_dir, example_data, rig, num_workers=args.num_workers, root=args.root)
+        output = args.output or pjoin(args.data_dir, 'motion_quality.npz')
+        save_table(table, output)
+        print(f"{len(table['name'])} clips, {int((table['error'] != '').sum())} failed, written to {output}")
+
+    if args.split is not None:
+        filtered = args.filtered or args.split[:-4] + '_filtered.txt'
+        thresholds = dict(THRESHOLDS)
+        for item in args.max:
+            (metric, value) = item.split('=')
+            if metric not in METRICS:
+                parser.error(f'unknown metric {metric}, one of {", ".join(METRICS)}')
+            thresholds[metric] = float(value)
+        (num_kept, num_clips) = filter_split(table, args.split, filtered, thresholds)
+        print(f"{num_kept} of {num_clips} clips of {args.split} kept in {filtered}")
@@ -0,0 +1,339 @@
+"""
+Render skeleton animations without matplotlib.
+
+Joints are projected with a fixed pinhole camera in NumPy, the floor plane and
+the bones of the kinematic chain are rasterized straight into RGB frame buffers,
+and the frames are piped to ffmpeg (mp4), saved as a GIF (needs Pillow) or
+written as PNG images. Whole directories are rendered over a process pool, so
+preview generation for the corpus is bounded by the encoder.
+"""
+
+import os
+import shutil
+import struct
+import subprocess
+import zlib
+from multiprocessing import Pool
+from os.path import join as pjoin
+
+import numpy as np
+
+# same palette as plot_3d_motion in animation.ipynb
+CHAIN_COLORS = {
+    'red': (255, 0, 0),
+    'blue': (0, 0, 255),
+    'black': (0, 0, 0),
+    'darkblue': (0, 0, 139),
+    'darkred': (139, 0, 0),
+}
+CHAIN_COLOR_NAMES = ['red', 'blue', 'black', 'red', 'blue',
+                     'darkblue', 'darkblue', 'darkblue', 'darkblue', 'darkblue',
+                     'darkred', 'darkred', 'darkred', 'darkred', 'darkred']
+BACKGROUND_COLOR = (255, 255, 255)
+FLOOR_COLOR = (128, 128, 128)
+TRAJECTORY_COLOR = (0, 0, 255)
+
+
+def prepare_motion(joints: np.ndarray) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Put a motion on the floor and follow the root, as plot_3d_motion does.
+
+    :param joints:  array of shape (seq_len, joints_num * 3) or (seq_len, joints_num, 3)
+    :return data:   joints of shape (seq_len, joints_num, 3) with the root at the XZ origin in every frame
+    :return trajec: root XZ trajectory of shape (seq_len, 2)
+    :return mins:   minimum of the original joint positions per axis
+    :return maxs:   maximum of the original joint positions per axis
+    """
+    data = joints.copy().reshape(len(joints), -1, 3).astype(np.float64)
+    mins = data.min(axis=0).min(axis=0)
+    maxs = data.max(axis=0).max(axis=0)
+    data[:, :, 1] -= mins[1]
+    trajec = data[:, 0, [0, 2]].copy()
+    data[..., 0] -= data[:, 0:1, 0]
+    data[..., 2] -= data[:, 0:1, 2]
+    return data, trajec, mins, maxs
+
+
+class MotionRenderer:
+    """
+    Rasterize skeleton frames seen by a fixed camera that follows the root.
+    """
+
+    def __init__(self, kinematic_tree: list[list[int]], size: int=480, radius: float=4.0,
+                 elev: float=20.0, azim: float=30.0, fov: float=40.0, thickness: int=4):
+        """
+        :param kinematic_tree:  list of joint chains, e.g. t2m_kinematic_chain
+        :param size:            width and height of the frames in pixels
+        :param radius:          extent of the scene in meters, sets the camera distance
+        :param elev:            camera elevation in degrees
+        :param azim:            camera azimuth around the vertical axis in degrees, 0 looks along -Z
+        :param fov:             vertical field of view in degrees
+        :param thickness:       line width of the first five chains in pixels, other chains use half of it
+        """
+        self.kinematic_tree = kinematic_tree
+        self.size = size
+        self.thickness = thickness
+
+        elev, azim = np.radians(elev), np.radians(azim)
+        target = np.array([0.0, radius / 4, 0.0])
+        eye = target + radius * 1.25 * np.array([np.sin(azim) * np.cos(elev), np.sin(elev), np.cos(azim) * np.cos(elev)])
+        forward = (target - eye) / np.linalg.norm(target - eye)
+        right = np.cross(forward, np.array([0.0, 1.0, 0.0]))
+        right = right / np.linalg.norm(right)
+        up = np.cross(right, forward)
+        # world to camera rotation, rows are the camera axes
+        self.rotation = np.stack([right, up, forward])
+        self.eye = eye
+        self.focal = (size / 2) / np.tan(np.radians(fov) / 2)
+
+        self.colors = [np.array(CHAIN_COLORS[name], dtype=np.uint8) for name in CHAIN_COLOR_NAMES]
+        self._brushes = {}
+
+    def project(self, points: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        """
+        :param points:  array of shape (..., 3) in world coordinates
+        :return pixels: array of shape (..., 2) with x, y pixel coordinates
+        :return depth:  array of shape (...) with the distance along the viewing direction
+        """
+        cam = (points - self.eye) @ self.rotation.T
+        depth = cam[..., 2]
+        safe_depth = np.maximum(depth, 1e-6)
+        pixels = np.stack([self.size / 2 + self.focal * cam[..., 0] / safe_depth,
+                           self.size / 2 - self.focal * cam[..., 1] / safe_depth], axis=-1)
+        return pixels, depth
+
+    def _brush(self, thickness: int) -> np.ndarray:
+        if thickness not in self._brushes:
+            r = max(thickness / 2, 0.5)
+            offsets = np.arange(-int(np.ceil(r)), int(np.ceil(r)) + 1)
+            grid = np.stack(np.meshgrid(offsets, offsets), axis=-1).reshape(-1, 2)
+            self._brushes[thickness] = grid[(grid ** 2).sum(axis=-1) <= r * r + 0.5]
+        return self._brushes[thickness]
+
+    def draw_segments(self, frame: np.ndarray, starts: np.ndarray, ends: np.ndarray, color: np.ndarray, thickness: int):
+        """
+        Draw thick line segments into a frame in place.
+
+        :param frame:       uint8 array of shape (size, size, 3)
+        :param starts:      array of shape (num_segments, 2) in pixel coordinates
+        :param ends:        array of shape (num_segments, 2) in pixel coordinates
+        :param color:       uint8 array of shape (3,)
+        :param thickness:   line width in pixels
+        """
+        if len(starts) == 0:
+            return
+        num_samples = int(np.ceil(np.linalg.norm(ends - starts, axis=-1).max())) + 1
+        num_samples = min(num_samples, 4 * self.size)
+        t = np.linspace(0.0, 1.0, num_samples)[None, :, None]
+        samples = (starts[:, None] + t * (ends - starts)[:, None]).reshape(-1, 1, 2)
+        pixels = np.rint(samples + self._brush(thickness)[None]).astype(np.int64).reshape(-1, 2)
+        inside = (pixels[:, 0] >= 0) & (pixels[:, 0] < self.size) & (pixels[:, 1] >= 0) & (pixels[:, 1] < self.size)
+        pixels = pixels[inside]
+        frame[pixels[:, 1], pixels[:, 0]] = color
+
+    def fill_polygon(self, frame: np.ndarray, corners: np.ndarray, color: np.ndarray, alpha: float=0.5):
+        """
+        Blend a convex polygon into a frame in place.
+
+        :param frame:   uint8 array of shape (size, size, 3)
+        :param corners: array of shape (num_corners, 2) in pixel coordinates, in order around the polygon
+        :param color:   uint8 array of shape (3,)
+        :param alpha:   opacity of the polygon
+        """
+        x0, y0 = np.maximum(np.floor(corners.min(axis=0)).astype(int), 0)
+        x1, y1 = np.minimum(np.ceil(corners.max(axis=0)).astype(int) + 1, self.size)
+        if x0 >= x1 or y0 >= y1:
+            return
+        xs, ys = np.meshgrid(np.arange(x0, x1) + 0.5, np.arange(y0, y1) + 0.5)
+        edges = np.roll(corners, -1, axis=0) - corners
+        # sign of the cross product tells on which side of every edge a pixel lies
+        cross = edges[:, 0, None, None] * (ys[None] - corners[:, 1, None, None]) \
+            - edges[:, 1, None, None] * (xs[None] - corners[:, 0, None, None])
+        inside = np.all(cross >= 0, axis=0) | np.all(cross <= 0, axis=0)
+        region = frame[y0:y1, x0:x1]
+        region[inside] = (alpha * color + (1 - alpha) * region[inside]).astype(np.uint8)
+
+    def render_frame(self, data: np.ndarray, trajec: np.ndarray, mins: np.ndarray, maxs: np.ndarray, index: int) -> np.ndarray:
+        """
+        Render one frame of a motion prepared by prepare_motion.
+
+        :return frame:  uint8 array of shape (size, size, 3)
+        """
+        frame = np.empty((self.size, self.size, 3), dtype=np.uint8)
+        frame[:] = BACKGROUND_COLOR
+
+        '''Floor plane'''
+        minx, maxx = mins[0] - trajec[index, 0], maxs[0] - trajec[index, 0]
+        minz, maxz = mins[2] - trajec[index, 1], maxs[2] - trajec[index, 1]
+        floor = np.array([[minx, 0, minz], [minx, 0, maxz], [maxx, 0, maxz], [maxx, 0, minz]])
+        floor_pixels, floor_depth = self.project(floor)
+        if (floor_depth > 0).all():
+            self.fill_polygon(frame, floor_pixels, np.array(FLOOR_COLOR, dtype=np.uint8))
+
+        '''Root trajectory'''
+        if index > 1:
+            past = np.zeros((index, 3))
+            past[:, 0] = trajec[:index, 0] - trajec[index, 0]
+            past[:, 2] = trajec[:index, 1] - trajec[index, 1]
+            pixels, depth = self.project(past)
+            visible = (depth[:-1] > 0) & (depth[1:] > 0)
+            self.draw_segments(frame, pixels[:-1][visible], pixels[1:][visible],
+                               np.array(TRAJECTORY_COLOR, dtype=np.uint8), 1)
+
+        '''Bones'''
+        pixels, depth = self.project(data[index])
+        for i, (chain, color) in enumerate(zip(self.kinematic_tree, self.colors)):
+            chain = np.asarray(chain)
+            visible = (depth[chain[:-1]] > 0) & (depth[chain[1:]] > 0)
+            thickness = self.thickness if i < 5 else max(self.thickness // 2, 1)
+            self.draw_segments(frame, pixels[chain[:-1]][visible], pixels[chain[1:]][visible], color, thickness)
+
+        return frame
+
+    def render(self, joints: np.ndarray, frame_ids: list[int]=None):
+        """
+        Yield rendered frames of a motion one at a time.
+
+        :param joints:      array of shape (seq_len, joints_num, 3)
+        :param frame_ids:   frames to render, all frames by default
+        """
+        data, trajec, mins, maxs = prepare_motion(joints)
+        if frame_ids is None:
+            frame_ids = range(len(data))
+        for index in frame_ids:
+            yield self.render_frame(data, trajec, mins, maxs, index)
+
+
+def write_png(save_path: str, image: np.ndarray):
+    """
+    Save an RGB image as PNG using only the standard library.
+
+    :param save_path:   string path to the output file
+    :param image:       uint8 array of shape (height, width, 3)
+    """
+    height, width = image.shape[:2]
+
+    def chunk(tag, payload):
+        return struct.pack('>I', len(payload)) + tag + payload + struct.pack('>I', zlib.crc32(tag + payload) & 0xffffffff)
+
+    # every scanline starts with filter type 0
+    raw = np.concatenate([np.zeros((height, 1), dtype=np.uint8), image.reshape(height, -1)], axis=1)
+    with open(save_path, 'wb') as f:
+        f.write(b'\x89PNG\r\n\x1a\n')
+        f.write(chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)))
+        f.write(chunk(b'IDAT', zlib.compress(raw.tobytes(), 6)))
+        f.write(chunk(b'IEND', b''))
+
+
+class FFmpegWriter:
+    """
+    Pipe raw RGB frames to an ffmpeg process that encodes them with libx264.
+    """
+
+    def __init__(self, save_path: str, size: int, fps: int):
+        self.process = subprocess.Popen(
+            ['ffmpeg', '-y', '-loglevel', 'error',
+             '-f', 'rawvideo', '-pix_fmt', 'rgb24', '-s', f'{size}x{size}', '-r', str(fps), '-i', '-',
+             '-an', '-vcodec', 'libx264', '-pix_fmt', 'yuv420p', save_path],
+            stdin=subprocess.PIPE)
+
+    def write(self, frame: np.ndarray):
+        self.process.stdin.write(frame.tobytes())
+
+    def close(self):
+        self.process.stdin.close()
+        if self.process.wait() != 0:
+            raise RuntimeError(f'ffmpeg exited with code {self.process.returncode}')
+
+
+def save_motion(save_path: str, renderer: MotionRenderer, joints: np.ndarray, fps: int=20):
+    """
+    Render a motion and save it by the extension of save_path:
+    .mp4 through ffmpeg, .gif through Pillow, anything else as a directory of PNG frames.
+    The output is written under a temporary name and moved into place once complete, so an
+    interrupted render never leaves a file or directory that render_corpus would skip.
+
+    :param save_path:   string path to the output file or directory
+    :param renderer:    MotionRenderer to draw the frames with
+    :param joints:      array of shape (seq_len, joints_num, 3)
+    :param fps:         frames per second of the output
+    """
+    root, ext = os.path.splitext(save_path)
+    # keep the extension last, ffmpeg picks the container from it
+    tmp_path = f'{root}.{os.getpid()}.tmp{ext}'
+    frames = renderer.render(joints)
+    try:
+        if ext == '.mp4':
+            writer = FFmpegWriter(tmp_path, renderer.size, fps)
+            try:
+                for frame in frames:
+                    writer.write(frame)
+            finally:
+                writer.close()
+        elif ext == '.gif':
+            from PIL import Image
+            images = [Image.fromarray(frame) for frame in frames]
+            images[0].save(tmp_path, save_all=True, append_images=images[1:], duration=1000 / fps, loop=0)
+        else:
+            os.makedirs(tmp_path, exist_ok=True)
+            for index, frame in enumerate(frames):
+                write_png(pjoin(tmp_path, '%05d.png' % index), frame)
+            if os.path.isdir(save_path):
+                shutil.rmtree(save_path)
+        os.replace(tmp_path, save_path)
+    except BaseException:
+        if os.path.isdir(tmp_path):
+            shutil.rmtree(tmp_path, ignore_errors=True)
+        elif os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def _render_one(args):
+    src_path, save_path, kinematic_tree, fps, renderer_args = args
+    try:
+        save_motion(save_path, MotionRenderer(kinematic_tree, **renderer_args), np.load(src_path), fps=fps)
+    except Exception as e:
+        return f"{src_path}: {e}"
+    return None
+
+
+def render_corpus(src_dir: str, tgt_dir: str, kinematic_tree: list[list[int]], ext: str='mp4', fps: int=20,
+                  num_workers: int=None, renderer_args: dict=None):
+    """
+    Render every .npy motion of a directory over a process pool, skipping outputs that already exist.
+
+    :param src_dir:         string path to the joint positions, e.g. ./HumanML3D/new_joints/
+    :param tgt_dir:         string path to the output directory
+    :param kinematic_tree:  list of joint chains
+    :param ext:             'mp4', 'gif' or 'png' for a directory of frames per motion
+    :param fps:             frames per second of the outputs
+    :param num_workers:     number of rendering processes, defaults to the number of cpus
+    :param renderer_args:   keyword arguments for MotionRenderer
+    :return failures:       list of error messages of the motions that could not be rendered
+    """
+    from tqdm import tqdm
+
+    os.makedirs(tgt_dir, exist_ok=True)
+    jobs = []
+    for npy_file in sorted(os.listdir(src_dir)):
+        if not npy_file.endswith('.npy'):
+            continue
+        save_path = pjoin(tgt_dir, npy_file[:-4] + ('' if ext == 'png' else '.' + ext))
+        if os.path.exists(save_path):
+            continue
+        jobs.append((pjoin(src_dir, npy_file), save_path, kinematic_tree, fps, renderer_args or {}))
+
+    with Pool(num_workers) as pool:
+        failures = [error for error in tqdm(pool.imap_unordered(_render_one, jobs), total=len(jobs)) if error is not None]
+    for error in failures:
+        print(error)
+    return failures
+
+
+if __name__ == "__main__":
+    from paramUtil import t2m_kinematic_chain
+
+    src_dir = './HumanML3D/new_joints/'
+    tgt_ani_dir = './HumanML3D/animations/'
+    render_corpus(src_dir, tgt_ani_dir, t2m_kinematic_chain, ext='mp4', fps=20)
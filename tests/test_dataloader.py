@@ -0,0 +1,47 @@
+"""
+VPoserDS gives the same batches through a plain DataLoader whether its fields are loaded or memory mapped.
+"""
+
+import os
+
+import pytest
+
+torch = pytest.importorskip('torch')
+
+from torch.utils.data import DataLoader
+
+from human_body_prior.data.dataloader import VPoserDS
+
+
+@pytest.fixture
+def dataset_dir(tmp_path):
+    generator = torch.Generator().manual_seed(0)
+    torch.save(torch.randn([37, 63], generator=generator, dtype=torch.float64), os.path.join(tmp_path, 'pose_body.pt'))
+    torch.save(torch.randn([37, 3], generator=generator), os.path.join(tmp_path, 'root_orient.pt'))
+    return str(tmp_path)
+
+
+@pytest.mark.parametrize('memmap', [False, True])
+def test_default_collate_batches(dataset_dir, memmap):
+    dataset = VPoserDS(dataset_dir, memmap=memmap)
+    batches = list(DataLoader(dataset, batch_size=4))
+    assert len(batches) == 10
+    assert batches[0]['pose_body'].shape == (4, 63) and batches[-1]['pose_body'].shape == (1, 63)
+    assert batches[0]['pose_body'].dtype == torch.float32
+    torch.testing.assert_close(batches[2]['root_orient'], torch.stack([dataset[i]['root_orient'] for i in range(8, 12)]))
+
+
+def test_memmap_matches_loaded(dataset_dir):
+    indices = [5, 0, 36, 5, 17]
+    loaded = VPoserDS(dataset_dir, data_fields=['pose_body'])
+    mapped = VPoserDS(dataset_dir, data_fields=['pose_body'], memmap=True)
+    assert len(loaded) == len(mapped) == 37
+    for (a, b) in zip(loaded.__getitems__(indices), mapped.__getitems__(indices)):
+        assert a.keys() == b.keys() == {'pose_body'}
+        torch.testing.assert_close(a['pose_body'], b['pose_body'], rtol=0, atol=0)
+    for idx in indices:
+        torch.testing.assert_close(loaded[idx]['pose_body'], mapped[idx]['pose_body'], rtol=0, atol=0)
+    shuffled = DataLoader(mapped, batch_size=8, shuffle=True, generator=torch.Generator().manual_seed(1))
+    reference = DataLoader(loaded, batch_size=8, shuffle=True, generator=torch.Generator().manual_seed(1))
+    for (a, b) in zip(shuffled, reference):
+        torch.testing.assert_close(a['pose_body'], b['pose_body'], rtol=0, atol=0)
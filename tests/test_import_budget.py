@@ -0,0 +1,43 @@
+"""
+build_vector and common.skeleton are imported by every worker process, and the text scripts
+only need spaCy once they tag, so their imports must not pull in the heavy dependencies that
+only some code paths use.
+"""
+
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+HEAVY_MODULES = ['torch', 'scipy', 'spacy']
+# seconds, numpy alone takes about 0.1 s
+IMPORT_BUDGET = 1.0
+
+
+def _import_report(module: str) -> dict:
+    code = ("import json, sys, time\n"
+            "start = time.perf_counter()\n"
+            f"import {module}\n"
+            "seconds = time.perf_counter() - start\n"
+            "print(json.dumps({'seconds': seconds, 'modules': sorted(sys.modules)}))\n")
+    out = subprocess.run([sys.executable, '-c', code], cwd=REPO_DIR, capture_output=True, text=True, check=True)
+    return json.loads(out.stdout.strip().splitlines()[-1])
+
+
+@pytest.mark.parametrize('module', ['build_vector', 'common.skeleton', 'annotate_texts', 'text_process'])
+def test_import_is_light(module):
+    report = _import_report(module)
+    loaded = [name for name in HEAVY_MODULES if name in report['modules']]
+    assert not loaded, f'importing {module} loads {loaded}'
+    assert report['seconds'] < IMPORT_BUDGET, f"importing {module} took {report['seconds']:.2f} s"
+
+
+def test_common_quaternion_defers_rotation_tools():
+    # common.quaternion uses the rotation kernels of human_body_prior, only once a conversion is called
+    report = _import_report('common.quaternion')
+    loaded = [name for name in report['modules'] if name.split('.')[0] in ['human_body_prior', 'torch']]
+    assert not loaded, f'importing common.quaternion loads {loaded}'
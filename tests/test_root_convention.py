@@ -0,0 +1,54 @@
+"""
+build_vector tells the root conventions apart by the root velocity, and a convention recorded next to the features wins.
+"""
+
+import os
+import warnings
+
+import numpy as np
+import pytest
+
+import build_vector
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'HumanML3D')
+
+
+@pytest.fixture(scope='module')
+def clips():
+    '''The shipped 'rel' features of 012314 and the 'abs' ones featurize writes for the same joints'''
+    joints = np.load(os.path.join(DATA_DIR, 'new_joints', '012314.npy'))
+    build_vector.set_rig(build_vector.T2M_RIG, joints)
+    _, abs_vec = build_vector.featurize(joints, 0.002)
+    return np.load(os.path.join(DATA_DIR, 'new_joint_vecs', '012314.npy')), abs_vec
+
+
+def test_detects_both_conventions(clips):
+    rel_vec, abs_vec = clips
+    with warnings.catch_warnings():
+        warnings.simplefilter('error')
+        assert build_vector.root_convention(rel_vec) == 'rel'
+        assert build_vector.root_convention(abs_vec) == 'abs'
+
+
+def test_rel_clip_starting_at_rest(clips):
+    rel_vec = clips[0].copy()
+    rel_vec[0, :3] = 0
+    assert build_vector.root_convention(rel_vec) == 'rel'
+    np.testing.assert_array_equal(build_vector.relative_root(rel_vec), rel_vec)
+
+
+def test_static_clip_is_abs_without_warning(clips):
+    static = clips[1].copy()
+    static[:, :3] = 0
+    with warnings.catch_warnings():
+        warnings.simplefilter('error')
+        assert build_vector.root_convention(static) == 'abs'
+
+
+def test_recorded_convention(tmp_path):
+    assert build_vector.read_root_convention(str(tmp_path)) == 'auto'
+    build_vector.write_root_convention(str(tmp_path), 'rel')
+    assert build_vector.read_root_convention(str(tmp_path)) == 'rel'
+    assert build_vector.read_root_convention(str(tmp_path), 'abs') == 'abs'
+    with pytest.raises(ValueError):
+        build_vector.write_root_convention(str(tmp_path), 'auto')
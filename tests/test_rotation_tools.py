@@ -0,0 +1,228 @@
+"""
+Numerical checks of the closed form rotation conversions of human_body_prior.tools.rotation_tools,
+against scipy in float64, over the angles where the formulas switch branches or lose precision, and of the
+batched helpers built on them against scipy and the per-joint loop they replaced.
+"""
+
+import numpy as np
+import pytest
+
+torch = pytest.importorskip('torch')
+Rotation = pytest.importorskip('scipy.spatial.transform').Rotation
+
+from human_body_prior.tools import rotation_tools
+
+# zero, below and above the Taylor expansion threshold, near and at pi, and beyond pi and 2 pi
+ANGLES = [0., 1e-12, 1e-7, 1e-4, 0.5, 1., 2., np.pi - 1e-4, np.pi - 1e-6, np.pi, 4., 2 * np.pi - 0.1, 7.]
+# absolute tolerance per dtype on rotation matrix entries and quaternion / axis-angle components
+ATOL = {torch.float64: 1e-10, torch.float32: 2e-6}
+KERNELS = ['aa2quat', 'quat2aa', 'quat2matrot', 'matrot2quat', 'matrot2aa', 'aa2matrot', 'cont6d2matrot',
+           'matrot2cont6d']
+
+
+def _axis_angles(seed=0):
+    rng = np.random.default_rng(seed)
+    axes = rng.normal(size=(len(ANGLES), 4, 3))
+    axes /= np.linalg.norm(axes, axis=-1, keepdims=True)
+    return (axes * np.array(ANGLES)[:, None, None]).reshape(-1, 3)
+
+
+def _canonical(quat):
+    # quaternions with real part first and w >= 0, the sign is ambiguous only at an angle of pi
+    return np.where(quat[..., :1] < 0, -quat, quat)
+
+
+@pytest.mark.parametrize('dtype', [torch.float64, torch.float32])
+def test_aa2matrot_matches_scipy(dtype):
+    aa = _axis_angles()
+    matrot = rotation_tools.aa2matrot(torch.from_numpy(aa).to(dtype))
+    assert matrot.dtype == dtype
+    np.testing.assert_allclose(matrot.double().numpy(), Rotation.from_rotvec(aa).as_matrix(), rtol=0, atol=ATOL[dtype])
+
+
+@pytest.mark.parametrize('dtype', [torch.float64, torch.float32])
+def test_matrot2aa_round_trip(dtype):
+    rotations = Rotation.from_rotvec(_axis_angles())
+    matrot = torch.from_numpy(rotations.as_matrix()).to(dtype)
+    aa = rotation_tools.matrot2aa(matrot)
+    assert aa.dtype == dtype
+    angle = aa.double().norm(dim=-1).numpy()
+    assert np.all(angle <= np.pi + ATOL[dtype])
+    np.testing.assert_allclose(rotation_tools.aa2matrot(aa).double().numpy(), rotations.as_matrix(), rtol=0,
+                               atol=4 * ATOL[dtype])
+    # away from pi the axis-angle vector is unique, scipy returns it with an angle in [0, pi] as well
+    unique = rotations.magnitude() < np.pi - 1e-3
+    np.testing.assert_allclose(aa.double().numpy()[unique], rotations.as_rotvec()[unique], rtol=0, atol=4 * ATOL[dtype])
+
+
+@pytest.mark.parametrize('dtype', [torch.float64, torch.float32])
+def test_quaternions_match_scipy(dtype):
+    rotations = Rotation.from_rotvec(_axis_angles())
+    expected = _canonical(rotations.as_quat()[:, [3, 0, 1, 2]])
+
+    from_aa = rotation_tools.aa2quat(torch.from_numpy(rotations.as_rotvec()).to(dtype)).double().numpy()
+    from_matrot = rotation_tools.matrot2quat(torch.from_numpy(rotations.as_matrix()).to(dtype)).double().numpy()
+    assert np.all(from_matrot[:, 0] >= 0)
+    for quat in (from_aa, from_matrot):
+        # q and -q are the same rotation, compare with the sign that matches
+        sign = np.where((quat * expected).sum(-1, keepdims=True) < 0, -1., 1.)
+        np.testing.assert_allclose(quat * sign, expected, rtol=0, atol=4 * ATOL[dtype])
+
+    matrot = rotation_tools.quat2matrot(torch.from_numpy(expected).to(dtype)).double().numpy()
+    np.testing.assert_allclose(matrot, rotations.as_matrix(), rtol=0, atol=4 * ATOL[dtype])
+    aa = rotation_tools.quat2aa(torch.from_numpy(expected).to(dtype))
+    np.testing.assert_allclose(rotation_tools.aa2matrot(aa).double().numpy(), rotations.as_matrix(), rtol=0,
+                               atol=4 * ATOL[dtype])
+
+
+@pytest.mark.parametrize('dtype', [torch.float64, torch.float32])
+def test_cont6d_round_trip(dtype):
+    matrot = torch.from_numpy(Rotation.from_rotvec(_axis_angles()).as_matrix()).to(dtype)
+    cont6d = rotation_tools.matrot2cont6d(matrot)
+    torch.testing.assert_close(rotation_tools.cont6d2matrot(cont6d), matrot, rtol=0, atol=4 * ATOL[dtype])
+
+    # any 6D vector with independent halves maps to a proper rotation
+    noisy = rotation_tools.cont6d2matrot(cont6d * 3 + 0.1 * torch.randn(cont6d.shape, dtype=dtype))
+    eye = torch.eye(3, dtype=dtype).expand_as(noisy)
+    torch.testing.assert_close(noisy.transpose(-1, -2) @ noisy, eye, rtol=0, atol=10 * ATOL[dtype])
+    torch.testing.assert_close(torch.det(noisy), torch.ones(len(noisy), dtype=dtype), rtol=0, atol=10 * ATOL[dtype])
+
+
+def test_leading_dimensions_are_kept():
+    aa = torch.from_numpy(_axis_angles()[:24]).view(2, 3, 4, 3)
+    matrot = rotation_tools.aa2matrot(aa)
+    assert matrot.shape == (2, 3, 4, 3, 3)
+    assert rotation_tools.matrot2aa(matrot).shape == (2, 3, 4, 3)
+    assert rotation_tools.matrot2quat(matrot).shape == (2, 3, 4, 4)
+    assert rotation_tools.matrot2cont6d(matrot).shape == (2, 3, 4, 6)
+    torch.testing.assert_close(rotation_tools.matrot2aa(matrot).view(-1, 3),
+                               rotation_tools.matrot2aa(matrot.view(-1, 3, 3)))
+
+
+@pytest.mark.parametrize('dtype', [torch.float64, torch.float32])
+def test_gradients_are_finite_at_the_identity(dtype):
+    for angle in (0., 1e-7):
+        aa = torch.full([4, 3], angle, dtype=dtype, requires_grad=True)
+        rotation_tools.aa2matrot(aa).sum().backward()
+        assert torch.isfinite(aa.grad).all()
+
+        matrot = torch.eye(3, dtype=dtype).repeat(4, 1, 1).requires_grad_()
+        rotation_tools.matrot2aa(matrot).sum().backward()
+        assert torch.isfinite(matrot.grad).all()
+
+        quat = torch.tensor([[1., 0., 0., 0.]], dtype=dtype, requires_grad=True)
+        rotation_tools.quat2aa(quat).sum().backward()
+        assert torch.isfinite(quat.grad).all()
+
+
+def test_gradients_match_finite_differences():
+    aa = torch.from_numpy(_axis_angles()).requires_grad_()
+    assert torch.autograd.gradcheck(rotation_tools.aa2matrot, (aa,))
+    # at exactly pi the axis flips sign under any perturbation, matrot2aa has no derivative there
+    not_pi = np.repeat(np.array(ANGLES) != np.pi, 4)
+    matrot = rotation_tools.aa2matrot(aa.detach()[not_pi]).requires_grad_()
+    assert torch.autograd.gradcheck(rotation_tools.matrot2aa, (matrot,))
+
+
+@pytest.mark.filterwarnings('ignore:`torch.jit.script` is deprecated:FutureWarning')
+@pytest.mark.parametrize('name', KERNELS)
+def test_kernels_script(name):
+    kernel = getattr(rotation_tools, name)
+    rotations = Rotation.from_rotvec(_axis_angles())
+    inputs = {
+        'aa': rotations.as_rotvec(),
+        'quat': rotations.as_quat()[:, [3, 0, 1, 2]],
+        'matrot': rotations.as_matrix(),
+        'cont6d': rotations.as_matrix()[..., :2].transpose(0, 2, 1).reshape(-1, 6),
+    }
+    x = torch.from_numpy(next(array for (prefix, array) in inputs.items() if name.startswith(prefix))).float()
+    torch.testing.assert_close(torch.jit.script(kernel)(x), kernel(x), rtol=0, atol=1e-6)
+
+
+@pytest.mark.parametrize('dtype', [np.float64, np.float32])
+def test_np_variants_keep_dtype(dtype):
+    aa = _axis_angles().astype(dtype)
+    matrot = rotation_tools.aa2matrot_np(aa)
+    assert matrot.dtype == dtype
+    np.testing.assert_array_equal(matrot, rotation_tools.aa2matrot(torch.from_numpy(aa)).numpy())
+    assert rotation_tools.matrot2aa_np(matrot).dtype == dtype
+    assert rotation_tools.matrot2quat_np(matrot).dtype == dtype
+    assert rotation_tools.matrot2cont6d_np(matrot).dtype == dtype
+
+
+def test_common_quaternion_delegates():
+    from common import quaternion
+
+    rotations = Rotation.from_rotvec(_axis_angles())
+    quat = torch.from_numpy(_canonical(rotations.as_quat()[:, [3, 0, 1, 2]])).float()
+    matrot = quaternion.quaternion_to_matrix(quat)
+    torch.testing.assert_close(matrot, rotation_tools.quat2matrot(quat))
+    cont6d = quaternion.quaternion_to_cont6d(quat)
+    torch.testing.assert_close(quaternion.cont6d_to_matrix(cont6d), matrot, rtol=0, atol=1e-5)
+    from_matrot = quaternion.matrix_to_quat(matrot)
+    assert torch.all(from_matrot[:, 0] >= 0)
+    from_cont6d = quaternion.cont6d_to_quat(cont6d)
+    # w = 0 at an angle of pi, where q and -q both have a non negative real part
+    sign = torch.where((from_cont6d * from_matrot).sum(-1, keepdim=True) < 0, -1., 1.)
+    torch.testing.assert_close(from_cont6d * sign, from_matrot, rtol=0, atol=1e-5)
+    # features are computed with these, keep them within float32 precision of scipy
+    np.testing.assert_allclose(quaternion.quaternion_to_matrix_np(quat.numpy()), rotations.as_matrix(), rtol=0, atol=2e-6)
+
+
+# parents of the 24 SMPL joints
+SMPL_PARENTS = [-1, 0, 0, 0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 9, 9, 12, 13, 14, 16, 17, 18, 19, 20, 21]
+
+
+def _rotvecs(num, seed=0):
+    rng = np.random.default_rng(seed)
+    return Rotation.random(num, random_state=rng).as_rotvec()
+
+
+@pytest.mark.parametrize('per_sample', [False, True])
+def test_noisy_zrot_matches_scipy(per_sample):
+    aa = _rotvecs(64)
+    np.random.seed(3)
+    noisy = rotation_tools.noisy_zrot(aa, per_sample=per_sample)
+    np.random.seed(3)
+    zrot = np.random.uniform(-np.pi, np.pi, size=len(aa) if per_sample else None)
+    expected = Rotation.from_euler('z', np.broadcast_to(zrot, len(aa))[:, None]) * Rotation.from_rotvec(aa)
+    np.testing.assert_allclose(Rotation.from_rotvec(noisy).as_matrix(), expected.as_matrix(), rtol=0, atol=8e-16)
+    assert not np.isnan(rotation_tools.noisy_zrot(np.zeros(3))).any()
+
+
+def test_rotate_points_xyz_matches_scipy():
+    rng = np.random.default_rng(0)
+    points = rng.normal(size=(50, 20, 3))
+    points /= np.linalg.norm(points, axis=-1, keepdims=True)
+    degrees = rng.uniform(-180, 180, size=(50, 3))
+    # extrinsic x, y, z: about x first, then y, then z
+    expected = np.stack([Rotation.from_euler('xyz', d, degrees=True).apply(p) for (p, d) in zip(points, degrees)])
+    np.testing.assert_allclose(rotation_tools.rotate_points_xyz(points, degrees), expected, rtol=0, atol=8e-16)
+
+
+def test_local2global_pose_matches_per_joint_loop():
+    local_pose = torch.from_numpy(Rotation.from_rotvec(_rotvecs(8 * 24)).as_matrix()).view(8, 24, 3, 3)
+    local_pose.requires_grad_(True)
+    global_pose = rotation_tools.local2global_pose(local_pose.view(8, -1), SMPL_PARENTS)
+
+    expected = [local_pose[:, 0]]
+    for jId in range(1, 24):
+        expected.append(torch.matmul(expected[SMPL_PARENTS[jId]], local_pose[:, jId]))
+    expected = torch.stack(expected, dim=1)
+    assert torch.equal(global_pose, expected)
+
+    weights = torch.randn(global_pose.shape, dtype=global_pose.dtype)
+    grad, = torch.autograd.grad((global_pose * weights).sum(), local_pose)
+    expected_grad, = torch.autograd.grad((expected * weights).sum(), local_pose)
+    torch.testing.assert_close(grad, expected_grad)
+
+
+def test_axisangle2matrots_is_not_transposed():
+    from human_body_prior.tools.omni_tools import axisangle2matrots, matrot2axisangle
+
+    aa = _rotvecs(4 * 21).reshape(4, 1, 21, 3)
+    matrots = axisangle2matrots(aa)
+    assert matrots.shape == (4, 1, 21, 9)
+    np.testing.assert_allclose(matrots.reshape(-1, 3, 3), Rotation.from_rotvec(aa.reshape(-1, 3)).as_matrix(),
+                               rtol=0, atol=1e-15)
+    np.testing.assert_allclose(matrot2axisangle(matrots), aa, rtol=0, atol=1e-12)
@@ -0,0 +1,39 @@
+"""
+Sparse skinning of BodyModel gives the vertices of the dense path, exactly with all weights and within the dropped mass with top-k.
+"""
+
+import os
+
+import pytest
+
+torch = pytest.importorskip('torch')
+
+from benchmark import write_synthetic_body_model
+from human_body_prior.body_model.body_model import BodyModel
+
+
+@pytest.fixture(scope='module')
+def bm_fname(tmp_path_factory):
+    bm_fname = os.path.join(tmp_path_factory.mktemp('body_model'), 'model.npz')
+    write_synthetic_body_model(bm_fname, num_verts=500)
+    return bm_fname
+
+
+def test_sparse_matches_dense(bm_fname):
+    bm = BodyModel(bm_fname, num_betas=10, dtype=torch.float64, sparse_skinning=True)
+    assert bm.lbs_dropped_weight == 0
+    assert bm.check_sparse_skinning() < 1e-12
+    assert bm.sparse_skinning
+
+
+def test_topk_reports_dropped_weight(bm_fname):
+    bm = BodyModel(bm_fname, num_betas=10, dtype=torch.float64, sparse_skinning=True, lbs_topk=2)
+    assert bm.lbs_dropped_weight > 0
+    assert 0 < bm.check_sparse_skinning() < 1
+
+
+def test_dense_by_default(bm_fname):
+    bm = BodyModel(bm_fname, num_betas=10)
+    assert not bm.sparse_skinning
+    with pytest.raises(AssertionError):
+        bm.check_sparse_skinning()
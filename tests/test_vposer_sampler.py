@@ -0,0 +1,59 @@
+"""
+VPoserSampler draws latent codes a full batch at a time, so splitting a number of poses into
+several calls on one stream must give the poses of a single call.
+"""
+
+import pytest
+
+torch = pytest.importorskip('torch')
+
+from human_body_prior.models.inference_modules import VPoserSampler
+from human_body_prior.models.vposer_model import VPoser
+
+
+class _Params(object):
+    pass
+
+
+def _vposer(latentD=32, num_neurons=64):
+    model_ps = _Params()
+    model_ps.model_params = _Params()
+    model_ps.model_params.num_neurons = num_neurons
+    model_ps.model_params.latentD = latentD
+    torch.manual_seed(0)
+    return VPoser(model_ps).eval()
+
+
+@pytest.mark.parametrize('latentD', [32, 5])
+@pytest.mark.parametrize('splits', [[10, 30], [16, 24], [1, 15, 3, 21]])
+def test_sample_splits_give_the_same_poses(latentD, splits):
+    sampler = VPoserSampler(_vposer(latentD), batch_size=16, script=False)
+    whole = sampler.sample(sum(splits), generator=sampler.new_stream(7))
+    stream = sampler.new_stream(7)
+    parts = torch.cat([sampler.sample(num_poses, generator=stream) for num_poses in splits])
+    torch.testing.assert_close(parts, whole, rtol=0, atol=1e-5)
+
+
+def test_streams_are_independent():
+    sampler = VPoserSampler(_vposer(), batch_size=16, script=False)
+    first, second = sampler.new_stream(7), sampler.new_stream(7)
+    a = torch.cat([sampler.sample(10, generator=first), sampler.sample(30, generator=first)])
+    # interleaving another stream does not disturb the codes left over on the first one
+    first, other = sampler.new_stream(7), sampler.new_stream(8)
+    b = sampler.sample(10, generator=first)
+    sampler.sample(5, generator=other)
+    b = torch.cat([b, sampler.sample(30, generator=first)])
+    torch.testing.assert_close(b, a, rtol=0, atol=1e-5)
+    torch.testing.assert_close(sampler.sample(40, generator=second), a, rtol=0, atol=1e-5)
+
+
+def test_stream_keeps_the_grad_mode_of_the_caller():
+    sampler = VPoserSampler(_vposer(), batch_size=16, script=False)
+    weight = torch.ones(1, requires_grad=True)
+    for pose_body in sampler.stream(40, generator=sampler.new_stream(7)):
+        assert torch.is_grad_enabled()
+        assert not pose_body.requires_grad
+        assert (pose_body * weight).requires_grad
+    with torch.no_grad():
+        for _ in sampler.stream(20):
+            assert not torch.is_grad_enabled()
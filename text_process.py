@@ -1,52 +1,78 @@
-import spacy
-
-from tqdm import tqdm
+import os
 import codecs as cs
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from os.path import join as pjoin
 
-nlp = spacy.load('en_core_web_sm')
+from tqdm import tqdm
+
+from text_tagger import TagCache, tag_sentences, format_tokens
+
+TAG_CACHE_FILE = './cache/tag_cache.sqlite'
+
 def process_text(sentence):
-    sentence = sentence.replace('-', '')
-    doc = nlp(sentence)
-    word_list = []
-    pos_list = []
-    for token in doc:
-        word = token.text
-        if not word.isalpha():
-            continue
-        if (token.pos_ == 'NOUN' or token.pos_ == 'VERB') and (word != 'left'):
-            word_list.append(token.lemma_)
-        else:
-            word_list.append(word)
-        pos_list.append(token.pos_)
-    return word_list, pos_list
-
-def process_humanml3d(corpus):
+    return tag_sentences([sentence])[0]
+
+def group_lines(names, captions, starts, ends, cache=None):
+    '''
+    Tag all captions in one batch and group the resulting lines by target file, keeping the corpus order.
+    '''
+    tagged = tag_sentences(captions, cache=cache)
+    lines_per_file = defaultdict(list)
+    for name, caption, (word_list, pos_list), start, end in zip(names, captions, tagged, starts, ends):
+        tokens = format_tokens(word_list, pos_list)
+        lines_per_file[name].append('%s#%s#%s#%s\n' % (caption, tokens, start, end))
+    return lines_per_file
+
+def write_text_file(path, lines, rebuild=True):
+    '''
+    Write all lines of one text file at once through a temporary file, so readers never see a partial file.
+    With rebuild=False the lines are merged into an existing file, skipping lines it already holds.
+    '''
+    if not rebuild and os.path.exists(path):
+        with cs.open(path, 'r') as f:
+            existing = f.readlines()
+        known = set(existing)
+        lines = existing + [line for line in lines if line not in known]
+    tmp_path = path + '.tmp'
+    with cs.open(tmp_path, 'w') as f:
+        f.writelines(lines)
+    os.replace(tmp_path, path)
+
+def write_text_files(text_save_path, lines_per_file, rebuild=True, num_workers=8):
+    os.makedirs(text_save_path, exist_ok=True)
+    with ThreadPoolExecutor(num_workers) as pool:
+        jobs = [pool.submit(write_text_file, pjoin(text_save_path, fname), lines, rebuild)
+                for fname, lines in lines_per_file.items()]
+        for job in tqdm(jobs):
+            job.result()
+
+def process_humanml3d(corpus, cache=None, rebuild=True, num_workers=8):
     text_save_path = './dataset/pose_data_raw/texts'
     desc_all = corpus
-    for i in tqdm(range(len(desc_all))):
-        caption = desc_all.iloc[i]['caption']
-        start = desc_all.iloc[i]['from']
-        end = desc_all.iloc[i]['to']
-        name = desc_all.iloc[i]['new_joint_name']
-        word_list, pose_list = process_text(caption)
-        tokens = ' '.join(['%s/%s'%(word_list[i], pose_list[i]) for i in range(len(word_list))])
-        with cs.open(pjoin(text_save_path, name.replace('npy', 'txt')), 'a+') as f:
-            f.write('%s#%s#%s#%s\n'%(caption, tokens, start, end))
-
-def process_kitml(corpus):
+    names = [name.replace('npy', 'txt') for name in desc_all['new_joint_name'].tolist()]
+    lines_per_file = group_lines(names,
+                                 desc_all['caption'].tolist(),
+                                 desc_all['from'].tolist(),
+                                 desc_all['to'].tolist(),
+                                 cache=cache)
+    write_text_files(text_save_path, lines_per_file, rebuild=rebuild, num_workers=num_workers)
+
+def process_kitml(corpus, cache=None, rebuild=True, num_workers=8):
     text_save_path = './dataset/kit_mocap_dataset/texts'
     desc_all = corpus
-    for i in tqdm(range(len(desc_all))):
-        caption = desc_all.iloc[i]['desc']
-        start = 0.0
-        end = 0.0
-        name = desc_all.iloc[i]['data_id']
-        word_list, pose_list = process_text(caption)
-        tokens = ' '.join(['%s/%s' % (word_list[i], pose_list[i]) for i in range(len(word_list))])
-        with cs.open(pjoin(text_save_path, name + '.txt'), 'a+') as f:
-            f.write('%s#%s#%s#%s\n' % (caption, tokens, start, end))
+    names = [str(name) + '.txt' for name in desc_all['data_id'].tolist()]
+    lines_per_file = group_lines(names,
+                                 desc_all['desc'].tolist(),
+                                 [0.0] * len(desc_all),
+                                 [0.0] * len(desc_all),
+                                 cache=cache)
+    write_text_files(text_save_path, lines_per_file, rebuild=rebuild, num_workers=num_workers)
 
 if __name__ == "__main__":
+    import pandas as pd
     corpus = pd.read_csv('./dataset/kit_mocap_dataset/desc_final.csv')
-    process_humanml3d(corpus)
\ No newline at end of file
+    cache = TagCache(TAG_CACHE_FILE)
+    process_humanml3d(corpus, cache=cache)
+    print('Tag cache: %s' % cache.stats())
+    cache.close()
@@ -0,0 +1,207 @@
+"""
+Tag action descriptions with lemmas and parts-of-speech (POS) tags in batches.
+
+Only the tagger, attribute ruler and lemmatizer of the spaCy pipeline are
+needed, so the dependency parser and named entity recognizer are excluded
+and sentences are streamed through nlp.pipe, optionally over several
+worker processes. Tagged sentences can be kept in a persistent TagCache
+so that re-running the annotation only tags sentences it has not seen.
+"""
+
+import hashlib
+import os
+import sqlite3
+from importlib import metadata
+
+MODEL_NAME = 'en_core_web_sm'
+UNUSED_COMPONENTS = ['parser', 'ner']
+
+_nlp = None
+
+
+def load_nlp():
+    """
+    Return the shared spaCy pipeline, loading it on first use.
+
+    :return nlp:    spaCy language pipeline without the unused components
+    """
+    global _nlp
+    if _nlp is None:
+        # spaCy itself takes seconds to import, so it is only imported once tagging is needed
+        import spacy
+        _nlp = spacy.load(MODEL_NAME, exclude=UNUSED_COMPONENTS)
+    return _nlp
+
+
+def clean_sentence(sentence: str) -> str:
+    """
+    Prepare a sentence for tagging, hyphenated words are joined together.
+
+    :param sentence:    string to be tagged
+    :return cleaned:    string handed to the spaCy pipeline
+    """
+    return sentence.replace('-', '')
+
+
+def words_and_tags(doc) -> tuple[list[str], list[str]]:
+    """
+    Return lists of words and their POS tags for a tagged spaCy document.
+    Nouns and verbs are reduced to their lemma, except for 'left'.
+
+    :param doc:         spaCy Doc of one sentence
+    :return word_list:  list of tokens found in the sentence
+    :return pos_list:   list of part-of-speech tags by token
+    """
+    word_list = []
+    pos_list = []
+    for token in doc:
+        word = token.text
+        if not word.isalpha():
+            continue
+        if (token.pos_ in ("NOUN", "VERB")) and (word != 'left'):
+            word_list.append(token.lemma_)
+        else:
+            word_list.append(word)
+        pos_list.append(token.pos_)
+    return (word_list, pos_list)
+
+
+def normalize_sentence(sentence: str) -> str:
+    """
+    Reduce a sentence to the form that decides its tags, used as the cache key.
+
+    :param sentence:    string to be tagged
+    :return normalized: cleaned sentence with collapsed whitespace
+    """
+    return ' '.join(clean_sentence(sentence).split())
+
+
+class TagCache:
+    """
+    Persistent mapping from normalized sentences to their words and POS tags,
+    stored in an SQLite file. Keys also depend on the spaCy model version, so
+    upgrading the model never returns stale tags.
+    """
+
+    def __init__(self, cache_file: str):
+        """
+        :param cache_file:  string path to the SQLite file, created if missing
+        """
+        cache_dir = os.path.dirname(cache_file)
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+        self.connection = sqlite3.connect(cache_file)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS tags (key TEXT PRIMARY KEY, words TEXT, pos TEXT)")
+        try:
+            model_version = metadata.version(MODEL_NAME)
+        except metadata.PackageNotFoundError:
+            model_version = 'unknown'
+        self.namespace = f"{MODEL_NAME}-{model_version}#"
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, sentence: str) -> str:
+        """
+        :param sentence:    string to be tagged
+        :return key:        hex digest identifying the sentence for the current model
+        """
+        return hashlib.sha1((self.namespace + normalize_sentence(sentence)).encode('utf-8')).hexdigest()
+
+    def get_many(self, keys: list[str]) -> dict[str, tuple[list[str], list[str]]]:
+        """
+        Look up many keys at once, counting hits and misses.
+
+        :param keys:    list of keys as returned by key()
+        :return found:  dictionary from key to (word_list, pos_list) for the keys in the cache
+        """
+        found = {}
+        unique_keys = list(dict.fromkeys(keys))
+        for i in range(0, len(unique_keys), 500):
+            chunk = unique_keys[i:i + 500]
+            rows = self.connection.execute(
+                f"SELECT key, words, pos FROM tags WHERE key IN ({','.join('?' * len(chunk))})", chunk)
+            for (key, words, pos) in rows:
+                found[key] = (words.split(), pos.split())
+        self.hits += len(found)
+        self.misses += len(unique_keys) - len(found)
+        return found
+
+    def put_many(self, items: dict[str, tuple[list[str], list[str]]]):
+        """
+        Store tagged sentences.
+
+        :param items:   dictionary from key to (word_list, pos_list)
+        """
+        with self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO tags (key, words, pos) VALUES (?, ?, ?)",
+                [(key, ' '.join(words), ' '.join(tags)) for (key, (words, tags)) in items.items()])
+
+    def stats(self) -> dict:
+        """
+        :return stats:  dictionary with hits, misses and hit_rate of the distinct sentences looked up
+        """
+        total = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses, 'hit_rate': self.hits / total if total else 0.0}
+
+    def close(self):
+        self.connection.close()
+
+
+def tag_sentences(sentences: list[str], batch_size: int=1000, n_process: int=1, cache: TagCache=None) -> list[tuple[list[str], list[str]]]:
+    """
+    Tag many sentences at once through nlp.pipe.
+    Repeated sentences are tagged once, and sentences found in the cache are not tagged at all.
+
+    :param sentences:   list of strings to be tagged
+    :param batch_size:  number of sentences handed to the pipeline at a time
+    :param n_process:   number of worker processes, -1 uses all cpus
+    :param cache:       optional TagCache to read from and to store new results in
+    :return result:     list of (word_list, pos_list) in the order of the input sentences
+    """
+    if cache is not None:
+        keys = [cache.key(sentence) for sentence in sentences]
+        found = cache.get_many(keys)
+    else:
+        keys = [normalize_sentence(sentence) for sentence in sentences]
+        found = {}
+
+    missing = {}
+    for (key, sentence) in zip(keys, sentences):
+        if key not in found and key not in missing:
+            missing[key] = normalize_sentence(sentence)
+
+    if missing:
+        nlp = load_nlp()
+        docs = nlp.pipe(list(missing.values()), batch_size=batch_size, n_process=n_process)
+        tagged = {key: words_and_tags(doc) for (key, doc) in zip(missing.keys(), docs)}
+        if cache is not None:
+            cache.put_many(tagged)
+        found.update(tagged)
+
+    return [found[key] for key in keys]
+
+
+def format_tokens(words: list[str], tags: list[str]) -> str:
+    """
+    Join words and tags into the word/POS form used in the text files.
+
+    :param words:   list of tokens
+    :param tags:    list of part-of-speech tags by token
+    :return tokens: string of space separated word/POS pairs
+    """
+    return ' '.join([f"{word}/{tag}" for (word, tag) in zip(words, tags)])
+
+
+def format_line(sentence: str, words: list[str], tags: list[str], start_time: float=0.0, end_time: float=0.0) -> str:
+    """
+    Build one line of a text file in the caption#tokens#from#to format.
+
+    :param sentence:    string containing the original sentence
+    :param words:       list of tokens found in the sentence
+    :param tags:        list of part-of-speech tags by token
+    :param start_time:  float representing start time of the description
+    :param end_time:    float representing end time of the description
+    :return line:       string containing sentence#tagged_sentence#start_time#end_time
+    """
+    return f"{sentence}#{format_tokens(words, tags)}#{start_time}#{end_time}\n"
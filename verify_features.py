@@ -0,0 +1,176 @@
+"""
+Regression checks of the featurization against references and its own inverses.
+
+A sampled subset of clips is re-featurized with build_vector.featurize and
+compared three ways:
+    reference   against the shipped new_joints / new_joint_vecs files of the same clip, when present
+    ric         recover_from_ric of the features against the processed ground truth joint positions
+    rot         recover_from_rot of the features against the same positions
+Each check reports its max and mean absolute deviation, the ric and rot checks
+also per joint, next to the featurization throughput. The run fails when a
+deviation exceeds its tolerance, so optimized kernels can be adopted once the
+harness passes on a large sample.
+
+    python verify_features.py --joints_dir ./joints --ref_dir ./HumanML3D --num_clips 500
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+from multiprocessing import Pool
+from os.path import join as pjoin
+
+import numpy as np
+
+import build_vector
+from common.lazy_import import lazy_import
+
+torch = lazy_import('torch')
+
+# absolute deviations, in meters for positions
+TOLERANCES = {
+    'reference_joints': 1e-4,
+    'reference_vecs': 1e-4,
+    'ric': 1e-4,
+    'rot': 5e-2,
+}
+
+
+def _deviation(a: np.ndarray, b: np.ndarray) -> dict:
+    diff = np.abs(a - b)
+    return {'max': float(diff.max()), 'mean': float(diff.mean())}
+
+
+def _joint_error(a: np.ndarray, b: np.ndarray) -> dict:
+    # euclidean error per frame and joint
+    error = np.linalg.norm(a - b, axis=-1)
+    return {'max': float(error.max()), 'mean': float(error.mean()), 'per_joint_max': error.max(axis=0).tolist()}
+
+
+def verify_clip(source_data: np.ndarray, ref_joints: np.ndarray=None, ref_vecs: np.ndarray=None) -> dict:
+    """
+    Featurize one clip and run the checks, set_rig must be called first.
+
+    :param source_data: joint positions of the clip, (seq_len, joints_num, 3)
+    :param ref_joints:  optional shipped new_joints array of the clip
+    :param ref_vecs:    optional shipped new_joint_vecs array of the clip
+    :return result:     dictionary with the deviations of every check that could run, and the featurization time
+    """
+    from common.skeleton import Skeleton
+
+    source_data = source_data[:, :build_vector.joints_num]
+    start = time.perf_counter()
+    rec_ric_data, new_data = build_vector.featurize(source_data, 0.002)
+    seconds = time.perf_counter() - start
+    result = {'frames': len(new_data), 'seconds': seconds}
+
+    if ref_joints is not None:
+        result['reference_joints'] = _deviation(rec_ric_data, ref_joints) if ref_joints.shape == rec_ric_data.shape \
+            else {'max': float('inf'), 'mean': float('inf'), 'shape': list(ref_joints.shape)}
+    if ref_vecs is not None:
+        result['reference_vecs'] = _deviation(new_data, ref_vecs) if ref_vecs.shape == new_data.shape \
+            else {'max': float('inf'), 'mean': float('inf'), 'shape': list(ref_vecs.shape)}
+
+    '''Round trips against the processed positions, the features hold one frame less'''
+    data, ground_positions, positions, l_velocity = build_vector.process_file_abs_root(source_data.copy(), 0.002)
+    ground_positions = ground_positions[:-1]
+    data = torch.from_numpy(data).float()
+    rec_ric = build_vector.recover_from_ric(data, build_vector.joints_num).numpy()
+    result['ric'] = _joint_error(rec_ric, ground_positions)
+
+    skel = Skeleton(build_vector.n_raw_offsets, build_vector.kinematic_chain, 'cpu')
+    skel.set_offset(build_vector.tgt_offsets)
+    rec_rot = build_vector.recover_from_rot(data, build_vector.joints_num, skel).numpy()
+    result['rot'] = _joint_error(rec_rot, ground_positions)
+    return result
+
+
+def _init_worker(rig, example_data):
+    torch.set_num_threads(1)
+    build_vector.set_rig(rig, example_data)
+
+
+def _verify_file(args):
+    name, joints_dir, ref_dir = args
+    load_ref = lambda folder: np.load(pjoin(ref_dir, folder, name)) \
+        if ref_dir is not None and os.path.exists(pjoin(ref_dir, folder, name)) else None
+    try:
+        result = verify_clip(np.load(pjoin(joints_dir, name)), load_ref('new_joints'), load_ref('new_joint_vecs'))
+    except Exception as e:
+        return name, {'error': str(e)}
+    return name, result
+
+
+def verify(joints_dir: str, ref_dir: str=None, rig: dict=build_vector.T2M_RIG, num_clips: int=100, seed: int=0,
+           num_workers: int=None, tolerances: dict=TOLERANCES) -> dict:
+    """
+    :param joints_dir:  string path to the joint positions, e.g. ./joints/ as written by raw_pose_processing.ipynb
+    :param ref_dir:     optional path holding new_joints/ and new_joint_vecs/ references, e.g. ./HumanML3D/
+    :param rig:         rig parameters for build_vector.set_rig, its example clip must be in joints_dir
+    :param num_clips:   number of clips sampled, all clips if larger than the directory
+    :param seed:        seed of the sample
+    :param num_workers: number of processes, defaults to the number of cpus
+    :param tolerances:  largest allowed max deviation per check
+    :return report:     dictionary with the summary under 'summary', the failing checks under 'failures'
+                        and the results per clip under 'clips'
+    """
+    from tqdm import tqdm
+
+    names = sorted(f for f in os.listdir(joints_dir) if f.endswith('.npy'))
+    rng = np.random.default_rng(seed)
+    if num_clips < len(names):
+        names = sorted(rng.choice(names, num_clips, replace=False).tolist())
+    example_data = np.load(pjoin(joints_dir, rig['example_id'] + '.npy'))
+
+    start = time.perf_counter()
+    with Pool(num_workers, initializer=_init_worker, initargs=(rig, example_data)) as pool:
+        clips = dict(tqdm(pool.imap_unordered(_verify_file, [(name, joints_dir, ref_dir) for name in names]),
+                          total=len(names)))
+    wall_seconds = time.perf_counter() - start
+
+    summary = {}
+    for check in tolerances:
+        results = [result[check] for result in clips.values() if check in result]
+        if results:
+            summary[check] = {'clips': len(results),
+                              'max': max(result['max'] for result in results),
+                              'mean': float(np.mean([result['mean'] for result in results]))}
+    frames = sum(result.get('frames', 0) for result in clips.values())
+    summary['throughput'] = {
+        'frames': frames,
+        'featurize_frames_per_sec': frames / max(sum(result.get('seconds', 0) for result in clips.values()), 1e-9),
+        'wall_frames_per_sec': frames / wall_seconds,
+    }
+
+    failures = [f"{name}: {result['error']}" for (name, result) in sorted(clips.items()) if 'error' in result]
+    for (name, result) in sorted(clips.items()):
+        for (check, tolerance) in tolerances.items():
+            if check in result and not result[check]['max'] <= tolerance:
+                failures.append(f"{name}: {check} max deviation {result[check]['max']:.3g} > {tolerance:g}")
+    return {'summary': summary, 'failures': failures, 'clips': clips}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--joints_dir', default='./joints/')
+    parser.add_argument('--ref_dir', default='./HumanML3D/')
+    parser.add_argument('--rig', choices=['t2m', 'custom'], default='t2m')
+    parser.add_argument('--num_clips', type=int, default=100)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--num_workers', type=int, default=None)
+    parser.add_argument('--output', default=None, help='path to write the full JSON report to')
+    args = parser.parse_args()
+
+    rig = build_vector.T2M_RIG if args.rig == 't2m' else build_vector.CUSTOM_RIG
+    report = verify(args.joints_dir, args.ref_dir, rig, args.num_clips, args.seed, args.num_workers)
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    for (check, stats) in report['summary'].items():
+        print('%-20s %s' % (check, ', '.join('%s %.6g' % item for item in stats.items())))
+    for failure in report['failures']:
+        print(failure)
+    sys.exit(1 if report['failures'] else 0)